@@ -0,0 +1,186 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: A common interface over the query classes of the different DBMS (see ST_Queries).
+# mongoDB and postgres implement the same logical queries with different names, arguments and return shapes;
+# the adapters below expose them under the same names with normalised results, so that a benchmark
+# (see ST_Benchmark.parityRun) does not need any backend specific code.
+# Usage:
+#   backends = [postgresBackend(P), mongoBackend(M)]
+#   t, n = backends[0].sameStartEndTime()     # n: int on every backend
+
+######################################################################
+
+from collections import Counter
+
+import numpy as np
+
+
+# Every query returns (timediff, result) like the query classes; the results are normalised:
+#   counts:            int
+#   k_NN:              set of trip IDs (int)
+#   pip_TripID:        (origin zone, destination zone); None if the point is outside of all zones
+#   pip_TimeInterval:  Counter {(origin zone, destination zone): number of trips}
+#   odMatrix:          NUM_ZONES x NUM_ZONES array (see odMatrix of the query classes)
+#   journeyTimeSeries: list of (trip ID, journey time in SECONDS)
+# A backend not supporting a query raises NotImplementedError
+class SpatioTemporalBackend():
+    name = "backend"
+
+    def sameStartEndTime(self):
+        raise NotImplementedError(self.name + ": sameStartEndTime")
+
+    def totalPrice_LTE2X(self, x):
+        # x: total price in dollars
+        raise NotImplementedError(self.name + ": totalPrice_LTE2X")
+
+    def numPassengers_Equal2X(self, x):
+        raise NotImplementedError(self.name + ": numPassengers_Equal2X")
+
+    def numLongTrips(self, threshold):
+        # threshold: in SECONDS on every backend
+        raise NotImplementedError(self.name + ": numLongTrips")
+
+    def k_NN(self, tripID, k):
+        raise NotImplementedError(self.name + ": k_NN")
+
+    def pip_TripID(self, tripID):
+        raise NotImplementedError(self.name + ": pip_TripID")
+
+    def pip_TimeInterval(self, interval):
+        # interval: e.g. ('2015-01-01 10:00:00', '2015-01-01 10:05:00'), see ST_Workload.workload.intervalStrings
+        raise NotImplementedError(self.name + ": pip_TimeInterval")
+
+    def odMatrix(self, interval):
+        raise NotImplementedError(self.name + ": odMatrix")
+
+    def rangeCount(self, bbox, interval):
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        raise NotImplementedError(self.name + ": rangeCount")
+
+    def journeyTimeSeries(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend):
+        raise NotImplementedError(self.name + ": journeyTimeSeries")
+
+    def supports(self, queryName):
+        # True if the backend overrides the query of the interface
+        return getattr(type(self), queryName) is not getattr(SpatioTemporalBackend, queryName)
+
+
+class mongoBackend(SpatioTemporalBackend):
+    # M: ST_Queries.mongoDB
+    def __init__(self, M, name="mongodb"):
+        self.M = M
+        self.name = name
+
+    def sameStartEndTime(self):
+        return self.M.sameStartEndTime()
+
+    def totalPrice_LTE2X(self, x):
+        return self.M.totalPrice_LTE2X(x)
+
+    def numPassengers_Equal2X(self, x):
+        return self.M.numPassengers_Equal2X(x)
+
+    def numLongTrips(self, threshold):
+        # mongoDB.numLongTrips expects MILI SECONDS and returns the $count document
+        timediff, doc = self.M.numLongTrips(threshold * 1000)
+        return timediff, doc[u"passing_scores"]
+
+    def k_NN(self, tripID, k):
+        timediff, k_NN = self.M.k_NN(int(tripID), int(k))
+        return timediff, set(int(id) for id in k_NN)
+
+    def pip_TripID(self, tripID):
+        timediff, od = self.M.pip_TripID(int(tripID))
+        return timediff, (zoneID(od[0]), zoneID(od[1]))
+
+    def pip_TimeInterval(self, interval):
+        # mongoDB.pip_TimeInterval_v2: the OD of every trip (pip_TimeInterval keeps a single origin)
+        timediff, ods = self.M.pip_TimeInterval_v2(interval)
+        return timediff, Counter((zoneID(od[0]), zoneID(od[1])) for od in ods)
+
+    def odMatrix(self, interval):
+        return self.M.odMatrix(interval)
+
+    def rangeCount(self, bbox, interval):
+        return self.M.rangeCount(bbox, interval)
+
+
+class postgresBackend(SpatioTemporalBackend):
+    # P: ST_Queries.postgres
+    # kNNVersion: "v1" (self join) or "v2" (id insertion) - see postgres.k_NN_v1 / k_NN_v2
+    def __init__(self, P, name="postgres", kNNVersion="v2"):
+        self.P = P
+        self.name = name
+        self.kNNVersion = kNNVersion
+
+    def sameStartEndTime(self):
+        timediff, rows = self.P.sameStartEndTime()
+        return timediff, rows[0][0]
+
+    def totalPrice_LTE2X(self, x):
+        timediff, rows = self.P.totalPrice_LTE2X(x)
+        return timediff, rows[0][0]
+
+    def numPassengers_Equal2X(self, x):
+        timediff, rows = self.P.numPassengers_Equal2X(x)
+        return timediff, rows[0][0]
+
+    def numLongTrips(self, threshold):
+        timediff, rows = self.P.numLongTrips(threshold)
+        return timediff, rows[0][0]
+
+    def k_NN(self, tripID, k):
+        if self.kNNVersion == "v1":
+            return self.P.k_NN_v1(int(tripID), int(k), "id", "trips")
+        return self.P.k_NN_v2(int(tripID), int(k), "id", "trips")
+
+    def pip_TripID(self, tripID):
+        timediff, rows = self.P.pip_tripID(int(tripID))
+        if not rows:
+            return timediff, (None, None)
+        return timediff, (zoneID(rows[0][0]), zoneID(rows[0][1]))
+
+    def pip_TimeInterval(self, interval):
+        timediff, rows = self.P.pip_TimeInterval(interval, True)
+        return timediff, Counter((zoneID(row[0]), zoneID(row[1])) for row in rows)
+
+    def odMatrix(self, interval):
+        return self.P.odMatrix(interval)
+
+    def rangeCount(self, bbox, interval):
+        return self.P.rangeCount(bbox, interval)
+
+    def journeyTimeSeries(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend):
+        timediff, rows = self.P.journeyTimeSeries(od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend)
+        # postgres.journeyTimeSeries returns the journey times as timedelta
+        return timediff, [(row[0], row[1].total_seconds()) for row in rows]
+
+
+def zoneID(z):
+    # The zone IDs as int; the points outside of all zones are None ("None" in mongoDB)
+    if z is None or z == "None":
+        return None
+    return int(z)
+
+
+# --- Comparison of the results of two backends (see ST_Benchmark.parityRun)
+
+def agreement(a, b):
+    # 1.0: identical results, 0.0: nothing in common
+    #   sets (k-NN): |a & b| / max(|a|, |b|) - ties at the k-th distance could legitimately differ
+    #   Counters / arrays (OD): trips in common / max(total trips)
+    #   anything else: equality
+    if isinstance(a, (set, frozenset)):
+        n = max(len(a), len(b))
+        return len(a & b) / float(n) if n > 0 else 1.0
+
+    if isinstance(a, Counter):
+        n = max(sum(a.values()), sum(b.values()))
+        return sum((a & b).values()) / float(n) if n > 0 else 1.0
+
+    if isinstance(a, np.ndarray):
+        n = max(a.sum(), b.sum())
+        return float(np.minimum(a, b).sum()) / n if n > 0 else 1.0
+
+    return 1.0 if a == b else 0.0
@@ -0,0 +1,359 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Benchmarks comparing alternative set-ups (document layouts, backends, ...) of the same queries.
+# Each benchmark returns a dictionary that could be printed or saved as JSON.
+
+######################################################################
+
+import statistics
+
+
+def latencyStats(timediffs):
+    # Summary of the timediff values (SECONDS) returned by the query methods
+    timediffs = sorted(timediffs)
+    if not timediffs:
+        return {"n": 0}
+
+    return {"n": len(timediffs),
+            "total": sum(timediffs),
+            "mean": statistics.mean(timediffs),
+            "median": statistics.median(timediffs),
+            "p95": timediffs[min(len(timediffs) - 1, int(0.95 * len(timediffs)))],
+            "max": timediffs[-1]}
+
+
+def compareMongoLayouts(mongoGeoJSON, mongoCompact, tripIDs, k=10, x=5):
+    # Storage size and query latency of the same trips in the "geojson" and "compact" layouts
+    # mongoGeoJSON / mongoCompact: mongoDB objects with layout="geojson" / layout="compact"
+    # tripIDs: e.g. a saved ST_Workload.workload's tripIDs
+    # The OD zones of pip_TripID must be the same in both layouts (e.g. a compact collection without the zones
+    # answers every PIP with "None" - fast but wrong): the differing trips are reported in pipMismatches
+    result = {}
+    ods = {}
+    for name, M in (("geojson", mongoGeoJSON), ("compact", mongoCompact)):
+        kNN = [M.k_NN(int(tripID), k)[0] for tripID in tripIDs]
+        pip = []
+        ods[name] = []
+        for tripID in tripIDs:
+            timediff, od = M.pip_TripID(int(tripID))
+            pip.append(timediff)
+            ods[name].append(od)
+
+        result[name] = {"storage": M.collectionSize(),
+                        "sameStartEndTime": M.sameStartEndTime()[0],
+                        "totalPrice_LTE2X": M.totalPrice_LTE2X(x)[0],
+                        "k_NN": latencyStats(kNN),
+                        "pip_TripID": latencyStats(pip)}
+
+    result["storageRatio"] = result["compact"]["storage"]["storageSize"] / float(result["geojson"]["storage"]["storageSize"])
+    result["pipMismatches"] = [(int(tripID), a, b) for tripID, a, b in zip(tripIDs, ods["geojson"], ods["compact"]) if a != b]
+    result["pipAgree"] = not result["pipMismatches"]
+
+    return result
+
+
+def timeFormatThroughput(n=200000, tripsPerSecond=20):
+    # Micro benchmark of the timestamp formatting of the exporters (rows per SECOND)
+    # The timestamps are clustered (tripsPerSecond trips start at each second) like the real trips
+    import datetime
+    import time
+    import numpy as np
+    from ST_Queries import rearrangeTimeFormat, formatISOTime, formatISOTimes
+
+    start = datetime.datetime(2015, 1, 1)
+    times = [start + datetime.timedelta(seconds=i // tripsPerSecond) for i in range(n)]
+
+    result = {}
+
+    t0 = time.perf_counter()
+    for t in times:
+        rearrangeTimeFormat(str(t))
+    result["rearrangeTimeFormat"] = n / (time.perf_counter() - t0)
+
+    formatISOTime.cache_clear()
+    t0 = time.perf_counter()
+    for t in times:
+        formatISOTime(t)
+    result["formatISOTime"] = n / (time.perf_counter() - t0)
+
+    # datetime64 input, e.g. the output of postgres.copyColumns
+    times64 = np.array(times, dtype="datetime64[s]")
+    t0 = time.perf_counter()
+    formatISOTimes(times64)
+    result["formatISOTimes"] = n / (time.perf_counter() - t0)
+
+    return result
+
+
+def workloadCalls(w, queries=("k_NN", "pip_TripID", "pip_TimeInterval")):
+    # The query calls of an ST_Workload.workload: [(queryName, args), ...]
+    # k_NN / pip_TripID use the tripIDs (and kValues), pip_TimeInterval / odMatrix the intervals
+    calls = []
+    kValues = list(w.kValues) if len(w.kValues) > 0 else [10]
+    for i, tripID in enumerate(w.tripIDs):
+        if "k_NN" in queries:
+            calls.append(("k_NN", (int(tripID), int(kValues[i % len(kValues)]))))
+        if "pip_TripID" in queries:
+            calls.append(("pip_TripID", (int(tripID),)))
+    for interval in w.intervalStrings():
+        for queryName in ("pip_TimeInterval", "odMatrix"):
+            if queryName in queries:
+                calls.append((queryName, (interval,)))
+
+    return calls
+
+
+def runCalls(backend, calls):
+    # Runs the calls one after the other on a single backend: [(timediff, result) or None if not supported]
+    results = []
+    for queryName, args in calls:
+        if not backend.supports(queryName):
+            results.append(None)
+            continue
+        results.append(getattr(backend, queryName)(*args))
+
+    return results
+
+
+def parityRun(backends, w, queries=("k_NN", "pip_TripID", "pip_TimeInterval"), maxMismatches=20):
+    # Executes the same workload on every backend (ST_Backend adapters), the backends in parallel,
+    # then compares the results of each backend with the first one (the reference) - see ST_Backend.agreement
+    # w: an ST_Workload.workload
+    # Returns {"latency": {backend: {query: latencyStats}},
+    #          "parity": {backend: {query: {"n", "meanAgreement", "mismatches", "examples"}}}}
+    import concurrent.futures
+    from ST_Backend import agreement
+
+    calls = workloadCalls(w, queries)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(backends)) as executor:
+        futures = [executor.submit(runCalls, backend, calls) for backend in backends]
+        results = [f.result() for f in futures]
+
+    report = {"latency": {}, "parity": {}}
+    for backend, backendResults in zip(backends, results):
+        timediffs = {}
+        for (queryName, args), r in zip(calls, backendResults):
+            if r is not None:
+                timediffs.setdefault(queryName, []).append(r[0])
+        report["latency"][backend.name] = dict((queryName, latencyStats(t)) for queryName, t in timediffs.items())
+
+    reference = results[0]
+    for backend, backendResults in zip(backends[1:], results[1:]):
+        parity = {}
+        for (queryName, args), r0, r in zip(calls, reference, backendResults):
+            if r0 is None or r is None:
+                continue
+            a = agreement(r0[1], r[1])
+            p = parity.setdefault(queryName, {"n": 0, "meanAgreement": 0.0, "mismatches": 0, "examples": []})
+            p["n"] += 1
+            p["meanAgreement"] += a
+            if a < 1.0:
+                p["mismatches"] += 1
+                if len(p["examples"]) < maxMismatches:
+                    p["examples"].append({"args": args, "agreement": a})
+        for p in parity.values():
+            p["meanAgreement"] /= p["n"]
+        report["parity"][backend.name] = parity
+
+    return report
+
+
+def compareZoneTables(P, tripIDs, intervals, M=None, subdivided="zones_subdivided"):
+    # Latency of the PIP queries on the full resolution zones and on the subdivided zones
+    # (postgres.buildSubdividedZones / mongoDB.buildSubdividedZones), and the trips assigned to another zone
+    # P: postgres object; M: optional mongoDB object
+    # tripIDs / intervals: e.g. a saved ST_Workload.workload's tripIDs and intervalStrings()
+    # The query cache is bypassed: the same queries are run on both zone sets
+    from collections import Counter
+
+    result = {}
+    cache, P.cache = P.cache, None
+    try:
+        runs = {}
+        for zoneTable in ("zones", subdivided):
+            P.useZones(zoneTable)
+            pip = [P.pip_tripID(int(tripID)) for tripID in tripIDs]
+            t, (ods, numRows) = P.pip_TimeIntervals(intervals)
+            runs[zoneTable] = ([r[1][:1] for r in pip], [Counter(od) for od in ods])
+            result["postgres_" + zoneTable] = {"pip_tripID": latencyStats([r[0] for r in pip]),
+                                               "pip_TimeIntervals": t}
+    finally:
+        P.useZones("zones")
+        P.cache = cache
+
+    a, b = runs["zones"], runs[subdivided]
+    result["postgres_tripMismatches"] = sum(1 for x, y in zip(a[0], b[0]) if x != y)
+    result["postgres_intervalMismatches"] = sum(sum(((x - y) + (y - x)).values()) for x, y in zip(a[1], b[1]))
+    result["postgres_speedup"] = result["postgres_zones"]["pip_tripID"]["total"] / \
+                                 max(result["postgres_" + subdivided]["pip_tripID"]["total"], 1e-9)
+
+    if M is not None:
+        cache, M.cache = M.cache, None
+        try:
+            runs = {}
+            for name, collectionName in (("zones", None), (subdivided, subdivided)):
+                M.useZones(collectionName)
+                pip = [M.pip_TripID(int(tripID)) for tripID in tripIDs]
+                runs[name] = [r[1] for r in pip]
+                result["mongodb_" + name] = {"pip_TripID": latencyStats([r[0] for r in pip])}
+        finally:
+            M.useZones(None)
+            M.cache = cache
+
+        result["mongodb_tripMismatches"] = sum(1 for x, y in zip(runs["zones"], runs[subdivided]) if x != y)
+        result["mongodb_speedup"] = result["mongodb_zones"]["pip_TripID"]["total"] / \
+                                    max(result["mongodb_" + subdivided]["pip_TripID"]["total"], 1e-9)
+
+    return result
+
+
+def parallelScanScaling(M, ruleName, x=None, workerCounts=(1, 2, 4, 8, 16), numRanges=64):
+    # Latency of mongoDB.parallelCount of the rule with an increasing number of workers
+    # (e.g. on a single server and on a sharded cluster, see mongoDB.shardCollection)
+    # The counts of all the runs must be the same; plan: the query plan of a key range (should be an IXSCAN)
+    result = {"shards": M.shardDistribution(), "plan": M.parallelCountPlan(ruleName, x, numRanges=numRanges), "runs": {}}
+    counts = set()
+    for numWorkers in workerCounts:
+        t, count = M.parallelCount(ruleName, x, numRanges=numRanges, numWorkers=numWorkers)
+        result["runs"][numWorkers] = t
+        counts.add(count)
+
+    result["count"] = counts.pop() if len(counts) == 1 else None
+    result["speedup"] = dict((n, result["runs"][workerCounts[0]] / max(t, 1e-9)) for n, t in result["runs"].items())
+
+    return result
+
+
+class cacheState():
+    # Controls and records the cache state of the benchmark runs, so that cold and warm numbers are reported apart
+    # P / M: postgres / mongoDB objects (either could be None)
+    # restartCommands: optional {"postgres": ..., "mongodb": ...} shell commands restarting the LOCAL instances
+    # with empty caches, e.g. "pg_ctl -D /data/pg restart -m fast && sync && echo 3 > /proc/sys/vm/drop_caches"
+    # Usage:
+    #   C = cacheState(P, M, restartCommands)
+    #   C.warm(); C.run("k_NN", lambda: [P.k_NN_v2(i, 10, "id", "trips")[0] for i in tripIDs])
+    #   C.cold(); C.run("k_NN", ...)
+    #   C.report()   # {"warm": {"k_NN": [...]}, "cold": {...}}
+    def __init__(self, P=None, M=None, restartCommands=None):
+        self.P = P
+        self.M = M
+        self.restartCommands = restartCommands or {}
+        self.state = "unknown"
+        self.runs = []
+
+    def warm(self):
+        # pg_prewarm of trips and its indexes; full collection and index scans in MongoDB
+        result = {}
+        if self.P is not None:
+            result["postgres"] = self.P.prewarm()
+        if self.M is not None:
+            result["mongodb"] = self.M.prewarm()
+        self.state = "warm"
+
+        return result
+
+    def cold(self):
+        # Restarts the instances having a restart command (the caches are really empty: state "cold"),
+        # otherwise only the statistics / plan caches are reset (state "cold-best-effort": the buffers stay)
+        import subprocess
+        import time
+
+        restarted = True
+        for name, D in (("postgres", self.P), ("mongodb", self.M)):
+            if D is None:
+                continue
+            command = self.restartCommands.get(name)
+            if command is None:
+                restarted = False
+                D.resetStats()
+                continue
+            subprocess.run(command, shell=True, check=True)
+            if name == "postgres":
+                # The server might need a few seconds to accept connections again
+                for attempt in range(30):
+                    try:
+                        D.reconnect()
+                        break
+                    except Exception:
+                        time.sleep(1)
+                else:
+                    D.reconnect()
+            D.resetStats()
+
+        self.state = "cold" if restarted else "cold-best-effort"
+
+        return self.state
+
+    def counters(self):
+        result = {}
+        if self.P is not None:
+            result["postgres"] = self.P.cacheStats()
+        if self.M is not None:
+            result["mongodb"] = self.M.cacheStats()
+        return result
+
+    def run(self, label, benchmark):
+        # benchmark: callable returning the result of the benchmark (e.g. a list of timediffs or a dictionary)
+        # The run is tagged with the cache state and the cache counters read during the run
+        before = self.counters()
+        result = benchmark()
+        after = self.counters()
+
+        reads = {}
+        for name in before:
+            reads[name] = dict((k, after[name][k] - before[name][k]) for k in before[name])
+
+        self.runs.append({"label": label, "cacheState": self.state, "cacheCounters": reads, "result": result})
+
+        return result
+
+    def report(self):
+        # {cache state: {label: [{"cacheCounters", "result", "latency" (if the result is a list of timediffs)}]}}
+        report = {}
+        for r in self.runs:
+            entry = {"cacheCounters": r["cacheCounters"], "result": r["result"]}
+            if isinstance(r["result"], list) and all(isinstance(t, (int, float)) for t in r["result"]):
+                entry["latency"] = latencyStats(r["result"])
+            report.setdefault(r["cacheState"], {}).setdefault(r["label"], []).append(entry)
+
+        return report
+
+
+# Run in a fresh interpreter by startupTime: the phases of the first query of a new process
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import ST_Queries
+imported = time.perf_counter()
+D = eval(sys.argv[1], vars(ST_Queries))
+constructed = time.perf_counter()
+eval(sys.argv[2], {"D": D})
+queried = time.perf_counter()
+print(json.dumps({"import": imported - start, "constructor": constructed - imported,
+                  "firstQuery": queried - constructed, "total": queried - start}))
+"""
+
+
+def startupTime(constructor, firstQuery, runs=5):
+    # Import-to-first-query time of a new process, e.g. of a CLI call or a short job
+    # constructor: expression in the namespace of ST_Queries, e.g. 'postgres("nyc", "postgres", "pswd", "localhost", 5432)'
+    # or 'mongoDB("localhost", 27017, "trips", connect="eager")'
+    # firstQuery: expression on the object D, e.g. "D.sameStartEndTime()"
+    # Returns {phase: latencyStats} for import, constructor, firstQuery and total (SECONDS)
+    import json
+    import os
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    phases = {}
+    for run in range(runs):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, constructor, firstQuery],
+                             cwd=here, check=True, capture_output=True, text=True).stdout
+        # The constructors might print: the timings are on the last line
+        for phase, seconds in json.loads(out.strip().splitlines()[-1]).items():
+            phases.setdefault(phase, []).append(seconds)
+
+    return dict((phase, latencyStats(timediffs)) for phase, timediffs in phases.items())
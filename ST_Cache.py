@@ -0,0 +1,253 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Result cache for the repeated queries of the mongoDB / postgres classes.
+# Historical trips never change, hence the results of e.g. k-NN or PIP queries can be reused.
+# Usage:
+#   C = queryCache(maxSize=10000, ttl=3600, fileName="st_cache.sqlite")
+#   P = postgres(..., cache=C)
+#   P.k_NN_v2(tripID, k, "id", "trips")   # the second call is served from the cache
+#   print(C.stats())
+
+######################################################################
+
+import copy
+import datetime
+import functools
+import hashlib
+import inspect
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-process LRU tier
+class lruCache():
+    # maxSize: max number of results kept in RAM; the least recently used one is evicted first
+    # ttl: time to live in SECONDS (None: results never expire)
+    def __init__(self, maxSize=10000, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (namespace, key) -> (created, value)
+        self.lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None:
+                return False, None
+            if self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[(namespace, key)]
+                return False, None
+            self.entries.move_to_end((namespace, key))
+            return True, entry[1]
+
+    def put(self, namespace, key, value):
+        with self.lock:
+            self.entries[(namespace, key)] = (time.time(), value)
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, namespace):
+        with self.lock:
+            for k in [k for k in self.entries if k[0] == namespace]:
+                del self.entries[k]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Optional on-disk tier (SQLite): survives the restart of the process
+class diskCache():
+    def __init__(self, fileName, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fileName, check_same_thread=False)
+        self.conn.execute("create table if not exists results ("
+                          "namespace text, "
+                          "key text, "
+                          "created real, "
+                          "value blob, "
+                          "primary key (namespace, key))")
+        self.conn.commit()
+
+    def get(self, namespace, key):
+        with self.lock:
+            row = self.conn.execute("select created, value from results where namespace = ? and key = ?",
+                                    (namespace, key)).fetchone()
+        if row is None:
+            return False, None
+        if self.ttl is not None and time.time() - row[0] > self.ttl:
+            # Expired: deleted (unless it has been replaced meanwhile)
+            with self.lock:
+                self.conn.execute("delete from results where namespace = ? and key = ? and created = ?",
+                                  (namespace, key, row[0]))
+                self.conn.commit()
+            return False, None
+        return True, pickle.loads(row[1])
+
+    def put(self, namespace, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.conn.execute("insert or replace into results values (?, ?, ?, ?)",
+                              (namespace, key, time.time(), blob))
+            self.conn.commit()
+
+    def invalidate(self, namespace):
+        with self.lock:
+            self.conn.execute("delete from results where namespace = ?", (namespace,))
+            self.conn.commit()
+
+    def purge(self):
+        # Deletes all the expired results; returns their number
+        if self.ttl is None:
+            return 0
+        with self.lock:
+            n = self.conn.execute("delete from results where created < ?", (time.time() - self.ttl,)).rowcount
+            self.conn.commit()
+        return n
+
+    def close(self):
+        self.conn.close()
+
+
+class queryCache():
+    # maxSize / ttl: see lruCache
+    # fileName: optional SQLite file for the on-disk tier (None: RAM only)
+    def __init__(self, maxSize=10000, ttl=None, fileName=None):
+        self.memory = lruCache(maxSize, ttl)
+        self.disk = diskCache(fileName, ttl) if fileName is not None else None
+
+        # The counters are updated by concurrent queries (e.g. mongoDB.k_NN_batch): guarded by a lock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def count(self, hits=0, diskHits=0, misses=0, invalidations=0):
+        with self.lock:
+            self.hits += hits
+            self.diskHits += diskHits
+            self.misses += misses
+            self.invalidations += invalidations
+
+    def get(self, namespace, key):
+        found, value = self.memory.get(namespace, key)
+        if found:
+            self.count(hits=1)
+            return True, value
+
+        if self.disk is not None:
+            found, value = self.disk.get(namespace, key)
+            if found:
+                self.count(hits=1, diskHits=1)
+                self.memory.put(namespace, key, value)
+                return True, value
+
+        self.count(misses=1)
+        return False, None
+
+    def put(self, namespace, key, value):
+        self.memory.put(namespace, key, value)
+        if self.disk is not None:
+            self.disk.put(namespace, key, value)
+
+    def invalidate(self, namespace):
+        # All the results of the namespace (a Mongo collection / a Postgres database) are dropped
+        self.count(invalidations=1)
+        self.memory.invalidate(namespace)
+        if self.disk is not None:
+            self.disk.invalidate(namespace)
+
+    def purge(self):
+        # Deletes the expired results of the disk tier (the expired results in RAM are dropped when read)
+        return self.disk.purge() if self.disk is not None else 0
+
+    def stats(self):
+        with self.lock:
+            hits, diskHits, misses, invalidations = self.hits, self.diskHits, self.misses, self.invalidations
+        total = hits + misses
+        return {"hits": hits,
+                "diskHits": diskHits,
+                "misses": misses,
+                "hitRatio": hits / total if total > 0 else 0.0,
+                "invalidations": invalidations,
+                "size": len(self.memory)}
+
+
+# --------------------------------------    Decorators used by the query classes
+
+# The query methods return (timediff, result). Only the result is cached;
+# on a hit, timediff is the time spent on the cache lookup.
+# The class must have the attributes 'cache' (None disables caching) and the method 'cacheNamespace'
+
+def cachedQuery(method):
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = getattr(self, "cache", None)
+        if cache is None:
+            return method(self, *args, **kwargs)
+
+        start_time = datetime.datetime.now()
+
+        key = queryKey(method.__name__, signature, self, args, kwargs)
+        namespace = self.cacheNamespace()
+        found, result = cache.get(namespace, key)
+        if found:
+            finish_time = datetime.datetime.now()
+            # The caller might modify the returned set/list: do not hand over the cached object
+            return (finish_time - start_time).total_seconds(), copy.deepcopy(result)
+
+        timediff, result = method(self, *args, **kwargs)
+        cache.put(namespace, key, copy.deepcopy(result))
+
+        return timediff, result
+
+    return wrapper
+
+
+def invalidatesCache(method):
+    # For the methods updating the trips (flags, new attributes, ...): cached results might be stale afterwards
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            cache = getattr(self, "cache", None)
+            if cache is not None:
+                cache.invalidate(self.cacheNamespace())
+
+    return wrapper
+
+
+def queryKey(methodName, signature, obj, args, kwargs):
+    # Keys are built from the normalised query parameters:
+    # k_NN(5, 10) and k_NN(tripID=5, k=10) share the same key
+    bound = signature.bind(obj, *args, **kwargs)
+    bound.apply_defaults()
+
+    params = tuple((name, normalize(value)) for name, value in bound.arguments.items() if value is not obj)
+
+    return hashlib.sha1(repr((methodName, params)).encode("utf-8")).hexdigest()
+
+
+def normalize(value):
+    if isinstance(value, (set, frozenset)):
+        return ("set", tuple(sorted((normalize(v) for v in value), key=repr)))
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), normalize(v)) for k, v in value.items()))
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        # NumPy scalars (e.g. IDs from ST_Workload)
+        return value.item()
+    return value
@@ -0,0 +1,299 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Embedded (in-process) DuckDB backend running the same query suite as the postgres / mongoDB classes,
+# without any database server, e.g. for CI and laptop runs. DuckDB executes each query on all the cores.
+# The spatial extension provides the zone polygons and ST_Contains.
+# Usage:
+#   D = duckDB("nyc.duckdb", threads=8)
+#   D.loadTrips("trips.parquet")            # or D.loadCompactJSON("nyc2015_compact_*.json")
+#                                           # or D.loadGeoJSONExport("nyc2015_json_*.geojson")
+#   D.loadZones("taxi_zones.geojson")
+#   t, n = D.sameStartEndTime()
+# The queries return (timediff, result) with the result types of ST_Backend.SpatioTemporalBackend,
+# hence D could be directly compared with the other backends (see ST_Benchmark.parityRun)
+
+######################################################################
+
+import datetime
+import glob
+import json
+import os
+import re
+import tempfile
+from collections import Counter
+
+import duckdb
+import numpy as np
+
+from ST_Backend import SpatioTemporalBackend, zoneID
+from ST_Cache import cachedQuery
+from ST_Profiling import instrumentClass
+from ST_Queries import NUM_ZONES
+
+
+class duckDB(SpatioTemporalBackend):
+    # fileName: DuckDB database file (":memory:" - the tables are lost when the object is deleted)
+    # threads: number of threads of a query (None: DuckDB default, all the cores)
+    # cache: optional ST_Cache.queryCache
+    # Following table names are used (the same columns as in Postgres, without the geometries of the trips):
+    #   trips: id, t_pickup, t_dropoff, num_passengers, total, l_pickup_lon, l_pickup_lat, l_dropoff_lon, l_dropoff_lat, ...
+    #          (the points are built from the coordinates in the queries)
+    #   zones: gid, geom
+    def __init__(self, fileName=":memory:", threads=None, cache=None, name="duckdb"):
+        self.fileName = fileName
+        self.cache = cache
+        self.name = name
+
+        self.conn = duckdb.connect(fileName)
+        self.conn.execute("INSTALL spatial")
+        self.conn.execute("LOAD spatial")
+        if threads is not None:
+            self.conn.execute("SET threads = {}".format(int(threads)))
+
+    def cacheNamespace(self):
+        return "duckdb:" + self.fileName
+
+    def cursor(self):
+        # A DuckDB connection must not be shared by threads: each query runs on its own cursor (duplicate connection)
+        cur = self.conn.cursor()
+        cur.execute("LOAD spatial")
+        return cur
+
+    # --------------------------------------    Loading the exports
+
+    def loadTrips(self, fileName, tableName="trips"):
+        # fileName: Parquet or CSV file(s) (globs allowed, e.g. "trips_*.parquet") having the columns of the trips table,
+        # e.g. exported with: COPY trips TO 'trips.csv' CSV HEADER (psql)
+        reader = "read_parquet" if fileName.endswith(".parquet") else "read_csv_auto"
+
+        start_time = datetime.datetime.now()
+        self.conn.execute("CREATE OR REPLACE TABLE {} AS "
+                          "SELECT * "
+                          "FROM {}('{}', union_by_name = true)".format(tableName, reader, fileName))
+        finish_time = datetime.datetime.now()
+
+        return (finish_time - start_time).total_seconds()
+
+    def loadCompactJSON(self, fileName, tableName="trips"):
+        # fileName: JSON lines exported by postgres.postgres2CompactJSON (globs allowed, e.g. "nyc2015_compact_*.json")
+        # The compact fields are mapped back to the columns of the trips table (amounts in dollars)
+        start_time = datetime.datetime.now()
+        self.conn.execute("CREATE OR REPLACE TABLE {} AS \n"
+                          "SELECT \"_id\" AS id, v AS vendorid, \n"
+                          "       strptime(tp['$date'], '%Y-%m-%dT%H:%M:%SZ') AS t_pickup, \n"
+                          "       strptime(td['$date'], '%Y-%m-%dT%H:%M:%SZ') AS t_dropoff, \n"
+                          "       pc AS num_passengers, dist AS trip_distance, \n"
+                          "       pk[1] AS l_pickup_lon, pk[2] AS l_pickup_lat, \n"
+                          "       rc AS ratecodeid, sf AS flag_store, \n"
+                          "       \"do\"[1] AS l_dropoff_lon, \"do\"[2] AS l_dropoff_lat, \n"
+                          "       pt AS payment_type, fa / 100.0 AS fare_amount, ex / 100.0 AS extra, \n"
+                          "       mta / 100.0 AS mta_tax, sur / 100.0 AS surcharge, tip / 100.0 AS tip, \n"
+                          "       tol / 100.0 AS tolls, tot / 100.0 AS total \n"
+                          "FROM read_json_auto('{}', format = 'newline_delimited')".format(tableName, fileName))
+        finish_time = datetime.datetime.now()
+
+        return (finish_time - start_time).total_seconds()
+
+    def loadGeoJSONExport(self, fileName, tableName="trips"):
+        # fileName: files written by postgres2GeoJSON (globs allowed, e.g. "nyc2015_json_*.geojson")
+        # The export is meant for mongoimport (ISODate(...), trailing commas), not JSON: each file is converted
+        # to JSON lines first (see geoJSONExportRecords), then loaded as in loadCompactJSON
+        start_time = datetime.datetime.now()
+
+        handle, jsonLines = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(handle, "w") as out:
+                for name in sorted(glob.glob(fileName)):
+                    for record in geoJSONExportRecords(name):
+                        out.write(json.dumps(record) + "\n")
+
+            self.conn.execute("CREATE OR REPLACE TABLE {} AS \n"
+                              "SELECT \"_id\" AS id, properties.nid AS nid, properties.VendorID AS vendorid, \n"
+                              "       strptime(properties.tpep_pickup_datetime, '%Y-%m-%dT%H:%M:%SZ') AS t_pickup, \n"
+                              "       strptime(properties.tpep_dropoff_datetime, '%Y-%m-%dT%H:%M:%SZ') AS t_dropoff, \n"
+                              "       properties.passenger_count AS num_passengers, properties.trip_distance, \n"
+                              "       geometry_pk.coordinates[1] AS l_pickup_lon, geometry_pk.coordinates[2] AS l_pickup_lat, \n"
+                              "       properties.RatecodeID AS ratecodeid, properties.store_and_fwd_flag AS flag_store, \n"
+                              "       geometry_do.coordinates[1] AS l_dropoff_lon, geometry_do.coordinates[2] AS l_dropoff_lat, \n"
+                              "       properties.payment_type, properties.fare_amount, properties.extra, \n"
+                              "       properties.mta_tax, properties.improvement_surcharge AS surcharge, \n"
+                              "       properties.tip_amount AS tip, properties.tolls_amount AS tolls, \n"
+                              "       properties.total_amount AS total \n"
+                              "FROM read_json_auto('{}', format = 'newline_delimited')".format(tableName, jsonLines))
+        finally:
+            os.remove(jsonLines)
+        finish_time = datetime.datetime.now()
+
+        return (finish_time - start_time).total_seconds()
+
+    def loadZones(self, fileName, idColumn="LocationID"):
+        # fileName: the TLC zones in WGS84 (EPSG:4326), in any format of ST_Read (GeoJSON, shapefile, ...)
+        start_time = datetime.datetime.now()
+        self.conn.execute("CREATE OR REPLACE TABLE zones AS "
+                          "SELECT CAST({} AS INTEGER) AS gid, geom "
+                          "FROM ST_Read('{}')".format(idColumn, fileName))
+        finish_time = datetime.datetime.now()
+
+        return (finish_time - start_time).total_seconds()
+
+    # --------------------------------------    Queries related with the data quality
+
+    def count(self, condition):
+        # count(*) of the trips satisfying the condition
+        cur = self.cursor()
+
+        query = "select count(*) " \
+                "from trips " \
+                "where {}".format(condition)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        result = cur.fetchone()[0]
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        cur.close()
+        return timediff, result
+
+    def sameStartEndTime(self):
+        return self.count("t_pickup = t_dropoff")
+
+    def totalPrice_LTE2X(self, x):
+        return self.count("total <= {}".format(x))
+
+    def numPassengers_Equal2X(self, x):
+        return self.count("num_passengers = {}".format(x))
+
+    def numLongTrips(self, threshold):
+        # threshold: in SECONDS
+        return self.count("date_diff('second', t_pickup, t_dropoff) >= {}".format(threshold))
+
+    # --------------------------------------    Spatial queries
+
+    @cachedQuery
+    def k_NN(self, tripID, k):
+        # No index: the distances of all the pickups are computed in parallel and the top k kept (ORDER BY ... LIMIT)
+        # The same planar distance in degrees as the <-> operator of postgres.k_NN_v2
+        cur = self.cursor()
+
+        query = "SELECT t.id \n" \
+                "FROM trips t, (select l_pickup_lon AS x, l_pickup_lat AS y from trips where id = {}) p \n" \
+                "ORDER BY (t.l_pickup_lon - p.x) * (t.l_pickup_lon - p.x) + (t.l_pickup_lat - p.y) * (t.l_pickup_lat - p.y) \n" \
+                "LIMIT {}".format(tripID, k)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        rows = cur.fetchall()
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        k_NN = set()
+        for row in rows:
+            k_NN.add(row[0])
+
+        cur.close()
+        return timediff, k_NN
+
+    @cachedQuery
+    def pip_TripID(self, tripID):
+        # Origin - destination zones of the trip; None if the point is outside of all zones
+        cur = self.cursor()
+
+        query = "SELECT (select gid from zones z where ST_Contains(z.geom, ST_Point(t.l_pickup_lon, t.l_pickup_lat)) limit 1), \n" \
+                "       (select gid from zones z where ST_Contains(z.geom, ST_Point(t.l_dropoff_lon, t.l_dropoff_lat)) limit 1) \n" \
+                "FROM trips t \n" \
+                "WHERE t.id = {}".format(tripID)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        row = cur.fetchone()
+        finish_time = datetime.datetime.now()
+
+        cur.close()
+        if row is None:
+            return (finish_time - start_time).total_seconds(), (None, None)
+
+        return (finish_time - start_time).total_seconds(), (zoneID(row[0]), zoneID(row[1]))
+
+    def pip_TimeInterval(self, interval):
+        # Returns timediff, Counter {(origin zone, destination zone): number of trips}
+        cur = self.cursor()
+
+        query = "SELECT z1.gid, z2.gid, count(*) \n" \
+                "FROM trips t \n" \
+                "LEFT JOIN zones z1 ON ST_Contains(z1.geom, ST_Point(t.l_pickup_lon, t.l_pickup_lat)) \n" \
+                "LEFT JOIN zones z2 ON ST_Contains(z2.geom, ST_Point(t.l_dropoff_lon, t.l_dropoff_lat)) \n" \
+                "WHERE t.t_pickup >= '{}' and t.t_pickup < '{}' \n" \
+                "GROUP BY z1.gid, z2.gid".format(interval[0], interval[1])
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        rows = cur.fetchall()
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        cur.close()
+        return timediff, Counter(dict(((zoneID(row[0]), zoneID(row[1])), row[2]) for row in rows))
+
+    def odMatrix(self, interval):
+        # Returns timediff, counts: NUM_ZONES x NUM_ZONES array; counts[o - 1, d - 1] = number of trips from o to d
+        timediff, ods = self.pip_TimeInterval(interval)
+
+        counts = np.zeros((NUM_ZONES, NUM_ZONES), dtype=np.int64)
+        for (o, d), n in ods.items():
+            if o is not None and d is not None:
+                counts[o - 1, d - 1] = n
+
+        return timediff, counts
+
+    def rangeCount(self, bbox, interval):
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        return self.count("l_pickup_lon between {} and {} AND l_pickup_lat between {} and {} "
+                          "AND t_pickup >= '{}' AND t_pickup < '{}'".format(bbox[0], bbox[2], bbox[1], bbox[3],
+                                                                            interval[0], interval[1]))
+
+    @cachedQuery
+    def journeyTimeSeries(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend):
+        # See postgres.journeyTimeSeries; returns timediff, [(trip ID, journey time in SECONDS)]
+        # dayofweek: 0 is Sunday as in Postgres
+        days = "(0, 6)" if weekend else "(1, 2, 3, 4, 5)"
+
+        cur = self.cursor()
+        query = "SELECT t.id, date_diff('second', t.t_pickup, t.t_dropoff) \n" \
+                "FROM trips t \n" \
+                "JOIN zones z1 on ST_Contains(z1.geom, ST_Point(t.l_pickup_lon, t.l_pickup_lat)) \n" \
+                "JOIN zones z2 on ST_Contains(z2.geom, ST_Point(t.l_dropoff_lon, t.l_dropoff_lat)) \n" \
+                "WHERE t.t_pickup >= '{}' and t.t_pickup < '{}' \n" \
+                "AND (hour(t.t_pickup) between {} and {}) \n" \
+                "AND (minute(t.t_pickup) between {} and {}) \n" \
+                "AND z1.gid = {} and z2.gid = {} \n" \
+                "AND dayofweek(t.t_pickup) in {}".format(analysisInterval[0], analysisInterval[1],
+                                                         timeInterval_Hour[0], timeInterval_Hour[1],
+                                                         timeInterval_Min[0], timeInterval_Min[1],
+                                                         od[0], od[1], days)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        results = cur.fetchall()
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        cur.close()
+        return timediff, results
+
+
+instrumentClass(duckDB)
+
+
+def geoJSONExportRecords(fileName):
+    # The trip documents of a postgres2GeoJSON file as dicts. The file is mongo shell syntax:
+    # ISODate("...") -> the ISO string, None -> null, the trailing commas are removed
+    with open(fileName) as f:
+        text = f.read()
+    text = re.sub(r'ISODate\(("[^"]*")\)', r"\1", text)
+    text = re.sub(r":\s*None\b", ": null", text)
+    text = re.sub(r",\s*}", "}", text)
+    text = text.strip().rstrip(",")
+
+    return json.loads("[" + text + "]") if text else []
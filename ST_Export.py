@@ -0,0 +1,183 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Streaming export of query results (k-NN sets, PIP OD lists, journey time series, ...) to files
+# for the map tools: NDJSON (one JSON object per line) or GeoJSONSeq (RFC 8142), optionally gzip/zstd compressed.
+# The records are serialised and written by a background thread, i.e. while the next rows are fetched
+# from the database; the queue between them is bounded, hence the memory use does not grow with the result.
+# Usage:
+#   with resultWriter("od.ndjson.gz", compression="gzip") as W:
+#       W.writeMany(odRecords(P.pip_TimeInterval_stream(interval)))
+#   t, n = exportStream(P.journeyTimeSeries_stream(...), "journeys.ndjson", journeyRecord)
+# orjson is used if installed (much faster than json for large results), otherwise json.
+
+######################################################################
+
+import datetime
+import gzip
+import json
+import queue
+import threading
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def toJSONValue(value):
+    # The values json/orjson can not serialise by themselves
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, "__float__"):
+        # e.g. Decimal (numeric columns of psycopg2)
+        return float(value)
+    raise TypeError("Not serialisable: {!r}".format(value))
+
+
+if orjson is not None:
+    def dumps(record):
+        return orjson.dumps(record, default=toJSONValue, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(record):
+        return json.dumps(record, default=toJSONValue, separators=(",", ":")).encode("utf-8")
+
+
+def openCompressed(fileName, compression=None, level=None):
+    # Binary file handle: compression None, "gzip" or "zstd" (needs the zstandard package)
+    if compression is None:
+        return open(fileName, "wb")
+    if compression == "gzip":
+        return gzip.open(fileName, "wb", compresslevel=6 if level is None else level)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(open(fileName, "wb"))
+    raise ValueError("Unknown compression: {} (None, gzip or zstd)".format(compression))
+
+
+class resultWriter():
+    # fileName: e.g. "knn.ndjson", "od.geojsons.gz"
+    # format: "ndjson" or "geojsonseq" (every record is preceded by the record separator 0x1E, see RFC 8142)
+    # compression: None, "gzip" or "zstd"
+    # queueSize: max number of batches waiting for the writer thread (the memory bound)
+    # batchSize: records per batch handed to the writer thread by writeMany
+    def __init__(self, fileName, format="ndjson", compression=None, level=None, queueSize=16, batchSize=1000):
+        if format not in ("ndjson", "geojsonseq"):
+            raise ValueError("Unknown format: {} (ndjson or geojsonseq)".format(format))
+
+        self.prefix = b"\x1e" if format == "geojsonseq" else b""
+        self.batchSize = batchSize
+        self.numRecords = 0
+        self.numBytes = 0
+        self.error = None
+
+        self.file = openCompressed(fileName, compression, level)
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.thread = threading.Thread(target=self.run, name="resultWriter", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # Writer thread: serialises and writes the batches until the None sentinel
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                data = b"".join(self.prefix + dumps(record) + b"\n" for record in batch)
+                self.file.write(data)
+                self.numRecords += len(batch)
+                self.numBytes += len(data)
+        except BaseException as e:
+            self.error = e
+            # Unblock the producer: the remaining batches are dropped
+            while self.queue.get() is not None:
+                pass
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def write(self, record):
+        # A single record (prefer writeMany for many records)
+        self.put([record])
+
+    def writeMany(self, records):
+        # records: any iterable/generator (e.g. a queryStream), consumed batch by batch
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batchSize:
+                self.put(batch)
+                batch = []
+        if batch:
+            self.put(batch)
+
+    def close(self):
+        # Waits for the pending batches; the error of the writer thread (if any) is raised here
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def exportStream(rows, fileName, toRecord=None, format="ndjson", compression=None, batchSize=1000):
+    # Exports any iterable of query results (lists, generators, queryStream, ...) to fileName
+    # toRecord: optional conversion of each row to the exported record (e.g. odRecord, journeyRecord)
+    # Returns timediff, number of records
+    start_time = datetime.datetime.now()
+
+    with resultWriter(fileName, format, compression, batchSize=batchSize) as W:
+        W.writeMany(rows if toRecord is None else (toRecord(row) for row in rows))
+    finish_time = datetime.datetime.now()
+    timediff = (finish_time - start_time).total_seconds()
+
+    return timediff, W.numRecords
+
+
+# --- Records of the query results
+
+def kNNRecords(results):
+    # {tripID: k-NN set} (e.g. mongoDB.k_NN_batch) -> {"tripID", "neighbours"}
+    for tripID, neighbours in results.items():
+        yield {"tripID": tripID, "neighbours": None if neighbours is None else sorted(neighbours)}
+
+
+def odRecord(row):
+    # (origin zone, destination zone) of pip_TripID / pip_TimeInterval
+    return {"origin": row[0], "destination": row[1]}
+
+
+def odRecords(rows):
+    for row in rows:
+        yield odRecord(row)
+
+
+def journeyRecord(row):
+    # (trip ID, journey time) of journeyTimeSeries
+    return {"id": row[0], "journeyTime": row[1]}
+
+
+def pointFeature(lon, lat, properties):
+    # GeoJSON point feature, e.g. a pickup of a k-NN set for the GeoJSONSeq format
+    return {"type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": properties}
@@ -0,0 +1,262 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Instrumentation of the query classes: call counts, wall/CPU time, rows processed and bytes written
+# per method. All the public methods of mongoDB and postgres are instrumented (see instrumentClass).
+# Usage:
+#   from ST_Profiling import PROFILER
+#   ... run the queries ...
+#   print(PROFILER.toPrometheus())      # or PROFILER.toJSON()
+#   PROFILER.enableProfile("postgres.postgres2GeoJSON")   # cProfile of a single method
+#   print(PROFILER.profileReport("postgres.postgres2GeoJSON"))
+# The bookkeeping is a few counters per call; set PROFILER.enabled = False to switch it off completely.
+
+######################################################################
+
+import contextlib
+import cProfile
+import functools
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+
+
+class profiler():
+    def __init__(self):
+        self.enabled = True
+        self.stats = {}       # method name -> [calls, wall, cpu, rows, bytes, errors]
+        self.profiles = {}    # method name -> cProfile.Profile / pyinstrument.Profiler
+        self.lock = threading.Lock()
+
+    def record(self, name, wall, cpu, rows, numBytes, error):
+        with self.lock:
+            s = self.stats.get(name)
+            if s is None:
+                s = self.stats[name] = [0, 0.0, 0.0, 0, 0, 0]
+            s[0] += 1
+            s[1] += wall
+            s[2] += cpu
+            s[3] += rows
+            s[4] += numBytes
+            s[5] += error
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def snapshot(self):
+        # {method: {"calls", "wallSeconds", "cpuSeconds", "rows", "bytes", "errors"}}
+        with self.lock:
+            return dict((name, {"calls": s[0],
+                                "wallSeconds": s[1],
+                                "cpuSeconds": s[2],
+                                "rows": s[3],
+                                "bytes": s[4],
+                                "errors": s[5]}) for name, s in self.stats.items())
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def toPrometheus(self, prefix="st_method"):
+        # Prometheus text exposition format
+        metrics = [("calls_total", "calls", "Number of calls"),
+                   ("wall_seconds_total", "wallSeconds", "Wall clock time in seconds"),
+                   ("cpu_seconds_total", "cpuSeconds", "CPU time of the calling thread in seconds"),
+                   ("rows_total", "rows", "Rows processed"),
+                   ("bytes_total", "bytes", "Bytes written"),
+                   ("errors_total", "errors", "Calls raising an exception")]
+        snapshot = self.snapshot()
+
+        lines = []
+        for metric, key, description in metrics:
+            lines.append("# HELP {}_{} {}".format(prefix, metric, description))
+            lines.append("# TYPE {}_{} counter".format(prefix, metric))
+            for name in sorted(snapshot):
+                lines.append("{}_{}{{method=\"{}\"}} {}".format(prefix, metric, name, snapshot[name][key]))
+
+        return "\n".join(lines) + "\n"
+
+    # --- Optional profiling of single methods
+
+    def enableProfile(self, name, tool="cProfile"):
+        # name: e.g. "postgres.pip_TimeInterval"; tool: "cProfile" or "pyinstrument" (if installed)
+        if tool == "pyinstrument":
+            import pyinstrument
+            self.profiles[name] = pyinstrument.Profiler()
+        else:
+            self.profiles[name] = cProfile.Profile()
+
+    def disableProfile(self, name):
+        self.profiles.pop(name, None)
+
+    def profileReport(self, name, numLines=30):
+        profile = self.profiles[name]
+        if isinstance(profile, cProfile.Profile):
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(numLines)
+            return stream.getvalue()
+
+        return profile.output_text()
+
+
+PROFILER = profiler()
+
+# Rows/bytes reported by the running method (innermost instrumented call of the thread)
+_calls = threading.local()
+
+
+def addRows(n):
+    stack = getattr(_calls, "stack", None)
+    if stack:
+        stack[-1][0] += n
+
+
+def addBytes(n):
+    stack = getattr(_calls, "stack", None)
+    if stack:
+        stack[-1][1] += n
+
+
+def instrument(method, name):
+    if inspect.isgeneratorfunction(method):
+        return instrumentGenerator(method, name)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            return method(*args, **kwargs)
+
+        stack = getattr(_calls, "stack", None)
+        if stack is None:
+            stack = _calls.stack = []
+        counters = [0, 0]  # rows, bytes
+        stack.append(counters)
+
+        profile = PROFILER.profiles.get(name)
+        error = 0
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            if profile is not None and len(stack) == 1:
+                # Only the outermost call is profiled: profilers can not be nested
+                if isinstance(profile, cProfile.Profile):
+                    result = profile.runcall(method, *args, **kwargs)
+                else:
+                    profile.start()
+                    try:
+                        result = method(*args, **kwargs)
+                    finally:
+                        profile.stop()
+            else:
+                result = method(*args, **kwargs)
+        except:
+            error = 1
+            raise
+        finally:
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+            stack.pop()
+            if error == 0 and hasattr(type(result), "profileName"):
+                # A lazy result (e.g. ST_Queries.queryStream) records its own iteration under the name of the
+                # outermost instrumented method returning it
+                result.profileName = name
+            else:
+                if error == 0 and counters[0] == 0:
+                    counters[0] = _resultRows(result)
+                PROFILER.record(name, wall, cpu, counters[0], counters[1], error)
+
+        return result
+
+    return wrapper
+
+
+def instrumentGenerator(method, name):
+    # Generator methods (e.g. the *_stream queries): calling them only creates the generator, hence the iteration
+    # is recorded: the wall/CPU time spent in the generator (the consumer's time between the items is excluded)
+    # until it is exhausted or closed. One row per yielded item unless the method reports rows itself (addRows).
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        generator = method(*args, **kwargs)
+        if not PROFILER.enabled:
+            return generator
+        return _instrumentedIteration(generator, name)
+
+    return wrapper
+
+
+def _instrumentedIteration(generator, name):
+    stack = getattr(_calls, "stack", None)
+    if stack is None:
+        stack = _calls.stack = []
+    counters = [0, 0]  # rows, bytes
+    numItems = 0
+    wall = 0.0
+    cpu = 0.0
+    error = 0
+    try:
+        while True:
+            stack.append(counters)
+            startWall = time.perf_counter()
+            startCPU = time.thread_time()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                cpu += time.thread_time() - startCPU
+                wall += time.perf_counter() - startWall
+                stack.pop()
+            numItems += 1
+            yield item
+    except GeneratorExit:
+        generator.close()
+        raise
+    except:
+        error = 1
+        raise
+    finally:
+        PROFILER.record(name, wall, cpu, counters[0] or numItems, counters[1], error)
+
+
+def _resultRows(result):
+    # The query methods return (timediff, result): the length of the result is the number of rows
+    if isinstance(result, tuple) and len(result) == 2 and hasattr(result[1], "__len__") \
+            and not isinstance(result[1], (str, dict)):
+        return len(result[1])
+    return 0
+
+
+def instrumentClass(cls):
+    # Instruments every public method of the class; the methods are recorded as <class>.<method>
+    for attrName, attr in list(vars(cls).items()):
+        if not attrName.startswith("_") and callable(attr) and not isinstance(attr, (staticmethod, classmethod, type)):
+            setattr(cls, attrName, instrument(attr, cls.__name__ + "." + attrName))
+
+    return cls
+
+
+@contextlib.contextmanager
+def measure(name):
+    # Instrumentation of any block of code: with measure("export"): ...
+    stack = getattr(_calls, "stack", None)
+    if stack is None:
+        stack = _calls.stack = []
+    counters = [0, 0]
+    stack.append(counters)
+
+    error = 0
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    except:
+        error = 1
+        raise
+    finally:
+        cpu = time.thread_time() - cpu
+        wall = time.perf_counter() - wall
+        stack.pop()
+        PROFILER.record(name, wall, cpu, counters[0], counters[1], error)
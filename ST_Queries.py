@@ -15,63 +15,129 @@
 ######################################################################
 
 # Import the necessary libraries
-import random
-import psycopg2
 import datetime
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
 import os
+import math
+import itertools
+import functools
+import time
+import concurrent.futures
+import json
+import uuid
+import threading
+import io
+import struct
+import statistics
+import numpy as np
+
+from ST_Workload import workload, defaultIDRanges
+from ST_Cache import cachedQuery, invalidatesCache
+from ST_Profiling import instrumentClass, instrumentGenerator, addRows, addBytes
+
+# The database drivers are imported on first use (see loadPsycopg2 / loadPymongo): importing this module does not
+# load pymongo/psycopg2, and a run using a single DBMS only needs that driver installed
+psycopg2 = None
+pymongo = None
+
+
+def loadPsycopg2():
+    global psycopg2
+    if psycopg2 is None:
+        import psycopg2.pool
+    return psycopg2
+
+
+def loadPymongo():
+    global pymongo
+    if pymongo is None:
+        import pymongo.errors
+    return pymongo
+
+
+# Connection modes of the query classes:
+#   "lazy":  nothing is done before the first query (the default; a failure is raised by the first query)
+#   "async": connects in a background thread; the first query waits for it
+#   "eager": connects (and checks the server) in the constructor, as before
+CONNECT_MODES = ("lazy", "async", "eager")
 
 
 # MongoDB class
 class mongoDB():
-    def __init__(self,host, port, dbName):
-        client = MongoClient(host, port)
-        db = client.nyc
+    # cache: optional ST_Cache.queryCache - repeated k-NN/PIP queries are then served from the cache
+    # layout: "geojson" or "compact" - the layout of the trip documents (see MONGO_LAYOUTS)
+    # keyedByID: True if _id of the trip documents is the Postgres ID (exported by postgres2GeoJSON or rekeyed
+    # by rekeyCollection); the trips are then looked up by _id. Always the case for the compact layout.
+    # databaseName: the database of the collection dbName
+    # maxPoolSize: max number of pooled connections of the client (see parallelCount, k_NN_batch)
+    # connect: "lazy", "async" or "eager" (see CONNECT_MODES); the client itself never blocks the constructor,
+    # only "eager" waits for the server (ismaster) as before
+    # timeout: server selection / connection timeout in seconds (the first query fails after it if no server)
+    def __init__(self,host, port, dbName, cache=None, layout="geojson", keyedByID=False, databaseName="nyc", maxPoolSize=100,
+                 connect="lazy", timeout=5):
+        if connect not in CONNECT_MODES:
+            raise ValueError("Unknown connect mode: {} (one of {})".format(connect, ", ".join(CONNECT_MODES)))
+        loadPymongo()
+
+        self.cache = cache
+        self.layout = layout
+        self.fields = MONGO_LAYOUTS[layout]
+        if keyedByID:
+            self.fields = dict(self.fields, key="_id")
+        # connect=False: the monitoring threads (and the connections) are started by the first operation;
+        # otherwise they start now in the background
+        client = pymongo.MongoClient(host, port, maxPoolSize=maxPoolSize, connect=(connect != "lazy"),
+                                     serverSelectionTimeoutMS=int(timeout * 1000), connectTimeoutMS=int(timeout * 1000))
+        self.client = client
+        db = client[databaseName]
         self.collection = db[dbName]
+        # The zones of the PIP queries: stored in the same collection (see useZones)
+        self.zoneCollection = self.collection
 
-        try:
-            # The ismaster command is cheap and does not require auth.
-            client.admin.command('ismaster')
-            print("Connected to MongoDB Server\n\n")
-        except ConnectionFailure:
-            print("Mongodb Server not available\n\n")
+        if connect == "eager":
+            try:
+                # The ismaster command is cheap and does not require auth.
+                client.admin.command('ismaster')
+                print("Connected to MongoDB Server\n\n")
+            except pymongo.errors.ConnectionFailure:
+                print("Mongodb Server not available\n\n")
+
+    def cacheNamespace(self):
+        # Cached results are invalidated per collection
+        return "mongodb:" + self.collection.full_name
 
 
 # ----------------------- Queries related with the data quality    ---------------------------------------
 
 #  --  How many trips have the same start and end time?
 
-    def sameStartEndTime(self):
+    def sameStartEndTime(self, approximate=False, sampleFraction=None, targetError=0.01):
         # Retrives the query result: how many trips have same start and end time
         # Assumption: the trip start/end times are under the properties field:
-        # i.e. properties.tpep_pickup_datetime, properties.tpep_dropoff_datetime
-        query = {}
-        query["$expr"] = {
-            u"$eq": [
-                u"$properties.tpep_pickup_datetime",
-                u"$properties.tpep_dropoff_datetime"
-            ]
-        }
+        # i.e. properties.tpep_pickup_datetime, properties.tpep_dropoff_datetime (tp, td in the compact layout)
+        # approximate: True -> estimated on a random sample, see approximateCount (the same for the other counts)
+        if approximate:
+            return self.approximateCount("sameStartEndTime", None, sampleFraction, targetError)
 
+        # The rule's query has the $exists guards: the zone documents (without the times) are not counted
+        query = qualityQuery_Mongo("sameStartEndTime", None, self.fields)
 
         start_time = datetime.datetime.now()
-        cursor = self.collection.find(query)
-        result = cursor.count()
+        result = self.collection.count_documents(query)
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        del cursor
         return timediff, result
 
-    def totalPrice_LTE2X(self, x):
+    def totalPrice_LTE2X(self, x, approximate=False, sampleFraction=None, targetError=0.01):
         # Total price less than or equal to the input x.
         # x: total price in dollars
-        # Assumption: the total amount field is here: properties.total_amount
+        # Assumption: the total amount field is here: properties.total_amount (tot in the compact layout)
+        if approximate:
+            return self.approximateCount("totalPrice_LTE2X", x, sampleFraction, targetError)
 
         query = {}
-        query["properties.total_amount"] = {
-            u"$lte": x
+        query[self.fields["total"]] = {
+            u"$lte": x * self.fields["amountScale"]
         }
 
         start_time = datetime.datetime.now()
@@ -83,12 +149,14 @@ class mongoDB():
         del cursor
         return timediff, result
 
-    def numPassengers_Equal2X(self, x):
+    def numPassengers_Equal2X(self, x, approximate=False, sampleFraction=None, targetError=0.01):
         # Retrives the query result: How Many "passenger in the car" equal to x value
-        # Assumption: the passenger count is here: properties.passenger_count
+        # Assumption: the passenger count is here: properties.passenger_count (pc in the compact layout)
+        if approximate:
+            return self.approximateCount("numPassengers_Equal2X", x, sampleFraction, targetError)
 
         query = {}
-        query["properties.passenger_count"] = x
+        query[self.fields["passengers"]] = x
 
         start_time = datetime.datetime.now()
         cursor = self.collection.find(query)
@@ -99,18 +167,31 @@ class mongoDB():
         del cursor
         return timediff, result
 
-    def numLongTrips(self, threshold):
+    def numLongTrips(self, threshold, approximate=False, sampleFraction=None, targetError=0.01):
         # Retrieves the query result: How many trips took place greater than or equal to the given threshold in MILI SECONDS
         # 86,400,000 MILI Seconds = 1 Day
+        if approximate:
+            return self.approximateCount("longTrips", threshold, sampleFraction, targetError)
+
+        if self.hasDuration():
+            # Index range scan of the precomputed duration (see addDuration)
+            query = {}
+            query[self.fields["duration"]] = {u"$gte": threshold / 1000.0}
+
+            start_time = datetime.datetime.now()
+            result = {u"passing_scores": self.collection.count_documents(query)}
+            finish_time = datetime.datetime.now()
+            timediff = (finish_time - start_time).total_seconds()
+
+            return timediff, result
 
         pipeline = [
             {
                 u"$project": {
-                    u"properties": 1.0,
                     u"dateDifference": {
                         u"$subtract": [
-                            u"$properties.tpep_dropoff_datetime",
-                            u"$properties.tpep_pickup_datetime"
+                            u"$" + self.fields["tDropoff"],
+                            u"$" + self.fields["tPickup"]
                         ]
                     }
                 }
@@ -137,40 +218,108 @@ class mongoDB():
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
+        # $count does not return any document if no trip matches
+        result = {u"passing_scores": 0}
         for doc in cursor:
             result = doc
 
         del cursor
         return timediff, result
 
+    @invalidatesCache
+    def addDuration(self):
+        # Precomputes the journey time in SECONDS of every trip into the duration field (properties.duration_s / dur)
+        # and indexes it: numLongTrips and the longTrips flag then run as index range scans.
+        # The exporters (postgres2GeoJSON, postgres2CompactJSON) already write the field of the new trips.
+        start_time = datetime.datetime.now()
+
+        query = {}
+        query[self.fields["tPickup"]] = {u"$exists": True}
+        self.collection.update_many(query, [{u"$set": {self.fields["duration"]: {
+            u"$divide": [{u"$subtract": [u"$" + self.fields["tDropoff"], u"$" + self.fields["tPickup"]]}, 1000]}}}])
+        self.collection.create_index([(self.fields["duration"], 1)], sparse=True)
+        # Every trip has the field from now on (see hasDuration)
+        self.durationMeta().replace_one({u"_id": self.collection.name},
+                                        {u"_id": self.collection.name, u"complete": True,
+                                         u"at": datetime.datetime.utcnow()}, upsert=True)
+        self.durationField = True
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
+
+    def durationMeta(self):
+        # A document per collection for which addDuration has completed
+        return self.collection.database[u"duration_meta"]
+
+    def hasDuration(self):
+        # Do ALL the trips have the duration field? (checked once)
+        # Only known after addDuration (or buildCompactCollection) has completed: trips inserted by the exporters
+        # into an older collection have the field, the older trips not - the field can not be used for them
+        if getattr(self, "durationField", None) is None:
+            meta = self.durationMeta().find_one({u"_id": self.collection.name})
+            self.durationField = meta is not None and meta.get(u"complete", False)
+        return self.durationField
+
+    def approximateCount(self, ruleName, x=None, sampleFraction=None, targetError=0.01, confidence=0.95, exactBelow=1000000):
+        # Estimates the number of trips satisfying the rule (see qualityQuery_Mongo) on a $sample of the collection
+        # sampleFraction: share of the documents in the sample; default: the sample size of the targetError
+        # targetError: half width of the confidence interval as a share of the collection (0.01: +-1% of the trips)
+        # exactBelow: collections smaller than this are counted exactly
+        # Returns timediff, {"count", "low", "high", "exact", "sampleSize"} (see countInterval)
+        start_time = datetime.datetime.now()
+
+        query = qualityQuery_Mongo(ruleName, x, self.fields, self.hasDuration())
+        total = self.collection.estimated_document_count()
+        if sampleFraction is None:
+            sampleSize = sampleSizeFor(targetError, confidence)
+        else:
+            sampleSize = int(math.ceil(sampleFraction * total))
+
+        if total < exactBelow or sampleSize >= total:
+            count = self.collection.count_documents(query)
+            result = {"count": count, "low": count, "high": count, "exact": True, "sampleSize": total}
+        else:
+            pipeline = [{u"$sample": {u"size": sampleSize}},
+                        {u"$match": query},
+                        {u"$count": u"n"}]
+            matched = [doc[u"n"] for doc in self.collection.aggregate(pipeline, allowDiskUse=True)]
+            result = countInterval(matched[0] if matched else 0, sampleSize, total, confidence)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, result
+
     def find_MinMax_Pickup_Date(self):
         # This query is retrieving the maximum and minimum isodates of "Pick Up" Times.
         query = {}
-        query["properties.tpep_pickup_datetime"] = {
+        query[self.fields["tPickup"]] = {
             u"$exists": True
         }
 
         projection = {}
-        projection["properties.tpep_pickup_datetime"] = 1.0
+        projection[self.fields["tPickup"]] = 1.0
 
-        sort = [(u"properties.tpep_pickup_datetime", 1)]
+        sort = [(self.fields["tPickup"], 1)]
 
         cursor = self.collection.find(query, projection=projection, sort=sort).limit(1)
-        min = cursor[0]['properties']['tpep_pickup_datetime']
+        min = getField(cursor[0], self.fields["tPickup"])
         print("The Min Date in Database: ", min)
 
         query = {}
-        query["properties.tpep_pickup_datetime"] = {
+        query[self.fields["tPickup"]] = {
             u"$exists": True
         }
 
         projection = {}
-        projection["properties.tpep_pickup_datetime"] = 1.0
+        projection[self.fields["tPickup"]] = 1.0
 
-        sort = [(u"properties.tpep_pickup_datetime", -1)]
+        sort = [(self.fields["tPickup"], -1)]
 
         cursor = self.collection.find(query, projection=projection, sort=sort).limit(1)
-        max = cursor[0]['properties']['tpep_pickup_datetime']
+        max = getField(cursor[0], self.fields["tPickup"])
 
         print("The Max Date in Database: ", max)
         del query
@@ -184,14 +333,12 @@ class mongoDB():
 
     def retrieveDocument(self, id):
         # Retrieves the trip having the the Postgres ID of 'id'
+        # If the collection is keyed by the Postgres ID, this is a lookup of _id (no secondary index)
 
         query = {}
-        query["properties.ID_Postgres"] = id
+        query[self.fields["key"]] = id
         # We need to project the output - all the fields must be set up
-        projection = {}
-        projection["geometry_pk.coordinates"] = 1.0
-        projection["geometry_do.coordinates"] = 1.0
-        projection["properties"] = 1.0
+        projection = self.fields["documentProjection"]
 
 
         cursor = self.collection.find(query, projection=projection)
@@ -201,8 +348,8 @@ class mongoDB():
         del cursor
 
         # To retrieve the coordinates of the pickup point:
-        #print(doc['geometry_pk']['coordinates'][0])
-        #print(doc['geometry_pk']['coordinates'][1])
+        #print(getField(doc, self.fields["pickupCoords"])[0])
+        #print(getField(doc, self.fields["pickupCoords"])[1])
 
         return document
 
@@ -210,15 +357,13 @@ class mongoDB():
         # We might also extract a single day, and need a document from there.
         # Retrieves the trip having the the NEW ID (nid) of 'id'
         # Assumption: The single day table has the field 'nid' starting from 1 to the number of trips on that day.
+        # (_id is the Postgres ID also in the single day exports: the nid lookup needs an index on nid)
 
 
         query = {}
-        query["properties.nid"] = id
+        query[self.fields["nid"]] = id
         # We need to project the output - all the fields must be set up
-        projection = {}
-        projection["geometry_pk.coordinates"] = 1.0
-        projection["geometry_do.coordinates"] = 1.0
-        projection["properties"] = 1.0
+        projection = self.fields["documentProjection"]
 
 
         cursor = self.collection.find(query, projection=projection)
@@ -228,23 +373,48 @@ class mongoDB():
         del cursor
 
         # To retrieve the coordinates of the pickup point:
-        #print(doc['geometry_pk']['coordinates'][0])
-        #print(doc['geometry_pk']['coordinates'][1])
+        #print(getField(doc, self.fields["pickupCoords"])[0])
+        #print(getField(doc, self.fields["pickupCoords"])[1])
 
         return document
 
+    def retrieveDocuments(self, ids, projection=None, batchSize=10000):
+        # Retrieves many trips (by their Postgres IDs) with a few $in queries instead of one query per trip
+        # projection: default: the Postgres ID and the pickup/dropoff coordinates
+        # Returns timediff, {Postgres ID: document} (missing IDs are not in the dictionary)
+        if projection is None:
+            projection = {}
+            projection[self.fields["id"]] = 1.0
+            projection[self.fields["pickupCoords"]] = 1.0
+            projection[self.fields["dropoffCoords"]] = 1.0
+
+        ids = [int(id) for id in ids]
+        documents = {}
+
+        start_time = datetime.datetime.now()
+        for i in range(0, len(ids), batchSize):
+            query = {}
+            query[self.fields["key"]] = {u"$in": ids[i:i + batchSize]}
+            for doc in self.collection.find(query, projection=projection):
+                documents[getField(doc, self.fields["id"])] = doc
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, documents
+
     # Spatial Query: point-in-polygon (pip) given the trip ID
 
+    @cachedQuery
     def pip_TripID(self,tripID):
         #This query retries the polygon in which the pickup of tripID resides
         #This query takes coordinates. And finding the polygons name which the point in inside.
 
         document = self.retrieveDocument(tripID)
-        xP = document['geometry_pk']['coordinates'][0]
-        yP = document['geometry_pk']['coordinates'][1]
+        xP = getField(document, self.fields["pickupCoords"])[0]
+        yP = getField(document, self.fields["pickupCoords"])[1]
 
-        xD = document['geometry_do']['coordinates'][0]
-        yD = document['geometry_do']['coordinates'][1]
+        xD = getField(document, self.fields["dropoffCoords"])[0]
+        yD = getField(document, self.fields["dropoffCoords"])[1]
 
         # Find the Origin Zone
         queryPickup = {}
@@ -275,7 +445,7 @@ class mongoDB():
         # Record the execution time of the query
         start_time = datetime.datetime.now()
 
-        cursorPickup = self.collection.find(queryPickup)
+        cursorPickup = self.zoneCursor(queryPickup)
 
         # It is possible for a point to be OUTSIDE of all zones
         # To handle that, we need to use a flag!
@@ -289,8 +459,10 @@ class mongoDB():
         if (flag == 0):
             od.append("None")
 
-        cursorDropoff = self.collection.find(queryDropoff)
+        cursorDropoff = self.zoneCursor(queryDropoff)
 
+        # The flag of the origin must not hide a destination outside of all zones
+        flag = 0
         for doc in cursorDropoff:
             flag = 1
             od.append(doc['properties']['LocationID'])
@@ -313,18 +485,18 @@ class mongoDB():
 
         # Find the coordinate list within the input interval
         projection = {}
-        projection["geometry_pk.coordinates"] = 1.0
-        projection["geometry_do.coordinates"] = 1.0
+        projection[self.fields["pickupCoords"]] = 1.0
+        projection[self.fields["dropoffCoords"]] = 1.0
         # ORIGIN
 
         query = {}
-        query["properties.tpep_pickup_datetime"] = {
+        query[self.fields["tPickup"]] = {
             u"$gte": datetime.datetime.strptime(str(interval[0]), "%Y-%m-%d %H:%M:%S")
         }
 
         query["$and"] = [
             {
-                "properties.tpep_pickup_datetime": {
+                self.fields["tPickup"]: {
                     u"$lt": datetime.datetime.strptime(str(interval[1]), "%Y-%m-%d %H:%M:%S")
                 }
             }
@@ -339,13 +511,13 @@ class mongoDB():
             # Pickup
             tmp = []
 
-            tmp.append(doc['geometry_pk']['coordinates'][0])
-            tmp.append(doc['geometry_pk']['coordinates'][1])
+            tmp.append(getField(doc, self.fields["pickupCoords"])[0])
+            tmp.append(getField(doc, self.fields["pickupCoords"])[1])
             coordList_Pickup.append(tmp)
             # Dropoff
             tmp = []
-            tmp.append(doc['geometry_do']['coordinates'][0])
-            tmp.append(doc['geometry_do']['coordinates'][1])
+            tmp.append(getField(doc, self.fields["dropoffCoords"])[0])
+            tmp.append(getField(doc, self.fields["dropoffCoords"])[1])
             coordList_Dropoff.append(tmp)
 
         # For each coordinate, find the polygon the point resides in
@@ -364,7 +536,7 @@ class mongoDB():
                                }
                                     }
                                 }
-            cursor = self.collection.find(query)
+            cursor = self.zoneCursor(query)
 
             # It is possible for a point to be OUTSIDE of all zones
             # To handle that, we need to use a flag!
@@ -391,7 +563,7 @@ class mongoDB():
                                }
                                     }
                                 }
-            cursor = self.collection.find(query)
+            cursor = self.zoneCursor(query)
 
             # It is possible for a point to be OUTSIDE of all zones
             # To handle that, we need to use a flag!!!
@@ -422,17 +594,17 @@ class mongoDB():
 
         # Find the coordinate list within the input interval
         projection = {}
-        projection["properties"] = 1.0
+        projection[self.fields["id"]] = 1.0
 
         # ORIGIN
         query = {}
-        query["properties.tpep_pickup_datetime"] = {
+        query[self.fields["tPickup"]] = {
             u"$gte": datetime.datetime.strptime(str(interval[0]), "%Y-%m-%d %H:%M:%S")
         }
 
         query["$and"] = [
             {
-                "properties.tpep_pickup_datetime": {
+                self.fields["tPickup"]: {
                     u"$lt": datetime.datetime.strptime(str(interval[1]), "%Y-%m-%d %H:%M:%S")
                 }
             }
@@ -442,7 +614,7 @@ class mongoDB():
 
         for doc in cursor:
             # Pickup
-            tripID = doc['properties']['ID_Postgres']
+            tripID = getField(doc, self.fields["id"])
             duration_pip_tripID, tripID_od = self.pip_TripID(tripID)
 
             od.append(tripID_od)
@@ -454,15 +626,16 @@ class mongoDB():
 
     # Spatial Query: k-NN ------------------------------------------
 
+    @cachedQuery
     def k_NN(self, tripID, k):
         # In order to find the k-NN of a tripID, we first need to find its coordinates; thus call the retrieveDocument method
         document = self.retrieveDocument(tripID)
-        x = document['geometry_pk']['coordinates'][0]
-        y = document['geometry_pk']['coordinates'][1]
+        x = getField(document, self.fields["pickupCoords"])[0]
+        y = getField(document, self.fields["pickupCoords"])[1]
         # print(x,y) - OK
 
         query = {}
-        query["geometry_pk"] = {
+        query[self.fields["pickup"]] = {
             u"$nearSphere": {
                 u"$geometry": {
                     u"type": u"Point",
@@ -481,21 +654,22 @@ class mongoDB():
 
         k_NN = set()
         for doc in cursor:
-            k_NN.add(doc['properties']['ID_Postgres'])
+            k_NN.add(getField(doc, self.fields["id"]))
 
         del cursor
         return timediff, k_NN
 
+    @cachedQuery
     def k_NN_day(self, tripID, k):
         # k-NN anaylsis working on a single day
 
         document = self.retrieveDocument_singleDay(tripID)
-        x = document['geometry_pk']['coordinates'][0]
-        y = document['geometry_pk']['coordinates'][1]
+        x = getField(document, self.fields["pickupCoords"])[0]
+        y = getField(document, self.fields["pickupCoords"])[1]
         # print(x,y) - OK
 
         query = {}
-        query["geometry_pk"] = {
+        query[self.fields["pickup"]] = {
             u"$nearSphere": {
                 u"$geometry": {
                     u"type": u"Point",
@@ -514,321 +688,1107 @@ class mongoDB():
 
         k_NN = set()
         for doc in cursor:
-            k_NN.add(doc['properties']['ID_Postgres'])
+            k_NN.add(getField(doc, self.fields["id"]))
 
         del cursor
         return timediff, k_NN
 
-#---------------------------      Update Functions     -----------------------------------------------------
+    @cachedQuery
+    def k_NN_geoNear(self, k, tripID=None, coords=None, maxDistance=None, singleDay=False):
+        # k-NN with a single $geoNear aggregation returning only the Postgres IDs of the neighbours
+        # Either the pickup coordinates (coords = [lon, lat]) or the tripID is given. For a tripID,
+        # the coordinates are first retrieved with a projected lookup (only the pickup coordinates are fetched;
+        # $geoNear only accepts a constant 'near' point, it can not be resolved within the same aggregation)
+        # maxDistance: in METERS - the neighbours further than maxDistance are pruned (i.e. fewer than k could return)
+        # singleDay: tripID is the NEW ID (nid) of a single day collection (see k_NN_day)
+        start_time = datetime.datetime.now()
 
-    def update_sameStartEndTime(self):
-        # Does the trip have the same start and end time?
-        # If so it adds a flag.
+        if coords is None:
+            query = {}
+            query[self.fields["nid"] if singleDay else self.fields["key"]] = tripID
+            projection = {}
+            projection[self.fields["pickupCoords"]] = 1.0
 
-        query = {}
-        query["$expr"] = {u"$eq": [u"$properties.tpep_pickup_datetime", u"$properties.tpep_dropoff_datetime"]}
+            document = self.collection.find_one(query, projection=projection)
+            coords = getField(document, self.fields["pickupCoords"])
+
+        geoNear = {
+            u"near": {
+                u"type": u"Point",
+                u"coordinates": [coords[0], coords[1]]
+            },
+            u"key": self.fields["pickup"],
+            u"distanceField": u"dist",
+            u"spherical": True
+        }
+        if maxDistance is not None:
+            geoNear[u"maxDistance"] = maxDistance
+
+        projection = {}
+        projection[self.fields["id"]] = 1.0
+        if self.fields["id"] != "_id":
+            projection["_id"] = 0
+
+        pipeline = [
+            {u"$geoNear": geoNear},
+            {u"$limit": int(k)},
+            {u"$project": projection}
+        ]
+
+        k_NN = set()
+        for doc in self.collection.aggregate(pipeline):
+            k_NN.add(getField(doc, self.fields["id"]))
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, k_NN
+
+    def k_NN_batch(self, tripIDs, k, maxDistance=None, numWorkers=8):
+        # k-NN of many trips: the coordinates of all the trips are retrieved with retrieveDocuments ($in),
+        # then the $geoNear probes run concurrently over the pooled connections of the MongoClient
+        # k: a single k, or one k per trip (e.g. the kValues of an ST_Workload.workload)
+        # Returns timediff, {tripID: k-NN set}
+        if not hasattr(k, "__len__"):
+            k = [k] * len(tripIDs)
 
         start_time = datetime.datetime.now()
 
-        update_query = self.collection.update_many(query, {u"$set": {"Errors.Flag_1": "true"}})
+        t, documents = self.retrieveDocuments(tripIDs)
+
+        def probe(i):
+            tripID = int(tripIDs[i])
+            if tripID not in documents:
+                return tripID, None
+            coords = getField(documents[tripID], self.fields["pickupCoords"])
+            t, k_NN = self.k_NN_geoNear(int(k[i]), coords=coords, maxDistance=maxDistance)
+            return tripID, k_NN
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            result = dict(executor.map(probe, range(len(tripIDs))))
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        # Check:
-        # print("Same start and end time update Worked. \n "
-        #       " Modified:", update_query.modified_count, "\n "
-        #         "It took", timediff, "seconds\n")
+        return timediff, result
 
-        # We can also do the reverse operations. That is remove the flag:
+#---------------------------      Document layout     ------------------------------------------------------
 
-        # start_time = datetime.datetime.now()
-        # antidote_update = self.collection.update_many(
-        #     {"Errors.Flag_1": {u"$exists": 1}},
-        #     {u"$unset": {"Errors.Flag_1": 1}})
-        # finish_time = datetime.datetime.now()
-        # timediff_antidote = (finish_time - start_time).total_seconds()
-        #
-        # print("sameStartEndTime Antidote Worked. \nModified: ", antidote_update.modified_count, "Antidote took: ", timediff_antidote, " seconds\n\n")
+    def buildCompactCollection(self, targetName):
+        # Converts the trips of this (geojson layout) collection into the compact layout (see MONGO_LAYOUTS)
+        # on the server side, copies the zones, and creates the indexes of the compact collection
+        # Use the new collection with: mongoDB(host, port, targetName, layout="compact")
+        def cents(field):
+            return {u"$toInt": {u"$round": [{u"$multiply": [u"$properties." + field, 100]}, 0]}}
 
-        return timediff, update_query.modified_count
+        pipeline = [
+            {u"$match": {u"properties.ID_Postgres": {u"$exists": True}}},
+            {u"$project": {
+                u"_id": u"$properties.ID_Postgres",
+                u"nid": u"$properties.nid",
+                u"v": {u"$toInt": u"$properties.VendorID"},
+                u"tp": u"$properties.tpep_pickup_datetime",
+                u"td": u"$properties.tpep_dropoff_datetime",
+                u"pc": {u"$toInt": u"$properties.passenger_count"},
+                u"dist": {u"$toDouble": u"$properties.trip_distance"},
+                u"pk": u"$geometry_pk.coordinates",
+                u"do": u"$geometry_do.coordinates",
+                u"rc": {u"$toInt": u"$properties.RatecodeID"},
+                u"sf": {u"$eq": [u"$properties.store_and_fwd_flag", u"Y"]},
+                u"pt": {u"$toInt": u"$properties.payment_type"},
+                u"fa": cents(u"fare_amount"),
+                u"ex": cents(u"extra"),
+                u"mta": cents(u"mta_tax"),
+                u"tip": cents(u"tip_amount"),
+                u"tol": cents(u"tolls_amount"),
+                u"sur": cents(u"improvement_surcharge"),
+                u"tot": cents(u"total_amount"),
+                u"dur": {u"$divide": [{u"$subtract": [u"$properties.tpep_dropoff_datetime",
+                                                      u"$properties.tpep_pickup_datetime"]}, 1000]},
+                u"ef": u"$ErrorFlags"
+            }},
+            {u"$out": targetName}
+        ]
 
-    def update_totalPrice_LTE2X(self,x):
-        # Below code adds a new field to those trips that have a "Total Price Less Than or Equal To X"
+        start_time = datetime.datetime.now()
 
-        query = {}
-        query["properties.total_amount"] = {u"$lte": x}
+        self.collection.aggregate(pipeline, allowDiskUse=True)
+
+        # The zone documents of the PIP queries are copied unchanged (the $match above only keeps the trips)
+        self.collection.aggregate([
+            {u"$match": {u"geometry": {u"$exists": True}, u"properties.LocationID": {u"$exists": True}}},
+            {u"$merge": {u"into": targetName, u"whenMatched": u"keepExisting", u"whenNotMatched": u"insert"}}
+        ], allowDiskUse=True)
+
+        target = self.collection.database[targetName]
+        target.create_index([(u"geometry", u"2dsphere")])
+        target.create_index([(u"pk", u"2dsphere")])
+        target.create_index([(u"do", u"2dsphere")])
+        target.create_index([(u"tp", 1)])
+        target.create_index([(u"nid", 1)], sparse=True)
+        target.create_index([(u"dur", 1)], sparse=True)
+        # dur is derived for every trip (see hasDuration)
+        self.durationMeta().replace_one({u"_id": targetName},
+                                        {u"_id": targetName, u"complete": True,
+                                         u"at": datetime.datetime.utcnow()}, upsert=True)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
 
+    def rekeyCollection(self, targetName, clustered=True):
+        # Copies the collection into targetName with _id = Postgres ID (the other documents, e.g. zones, keep their _id)
+        # clustered: the new collection is clustered on _id (MongoDB >= 5.3), i.e. the trips are stored in _id order
+        # and a lookup by _id needs no separate index
+        # Use the new collection with: mongoDB(host, port, targetName, keyedByID=True)
         start_time = datetime.datetime.now()
 
-        update_query = self.collection.update_many(query, {u"$set": {"Errors.Flag_2": "true"}})
+        db = self.collection.database
+        if clustered:
+            db.create_collection(targetName, clusteredIndex={u"key": {u"_id": 1}, u"unique": True})
+
+        pipeline = [
+            {u"$set": {u"_id": {u"$ifNull": [u"$" + self.fields["id"], u"$_id"]}}},
+            {u"$merge": {u"into": targetName, u"on": u"_id", u"whenMatched": u"replace", u"whenNotMatched": u"insert"}}
+        ]
+        self.collection.aggregate(pipeline, allowDiskUse=True)
+
+        target = db[targetName]
+        for index in self.collection.list_indexes():
+            if index["name"] != "_id_":
+                options = dict((k, index[k]) for k in ("sparse", "partialFilterExpression") if k in index)
+                target.create_index(list(index["key"].items()), name=index["name"], **options)
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        # # Check:
-        # print("totalPrice_LTE2X Update Worked. \nModified:", update_query.modified_count, "\nIt took", timediff,
-        #       "seconds\n")
+        return timediff
+
+    def collectionSize(self):
+        # Storage statistics of the collection in BYTES
+        stats = self.collection.database.command("collStats", self.collection.name)
+
+        return {"count": stats["count"],
+                "size": stats["size"],
+                "avgObjSize": stats.get("avgObjSize", 0),
+                "storageSize": stats["storageSize"],
+                "totalIndexSize": stats["totalIndexSize"]}
+
+#---------------------------      Range queries     --------------------------------------------------------
+
+    def rangeQuery(self, bbox, interval, projection=None, batchSize=10000):
+        # Streams the trips picked up within the bounding box and the time interval
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        # interval: e.g. ('2015-01-01 10:00:00', '2015-01-01 12:00:00')
+        # projection: default: ID_Postgres, pickup time and coordinates
+        # The documents are fetched in batches of batchSize, i.e. the whole result is never kept in RAM
+        if projection is None:
+            projection = {self.fields["id"]: 1.0,
+                          self.fields["tPickup"]: 1.0,
+                          self.fields["pickupCoords"]: 1.0}
+
+        cursor = self.collection.find(rangeQuery_Mongo(bbox, interval, self.fields), projection=projection).batch_size(batchSize)
+        try:
+            for doc in cursor:
+                yield doc
+        finally:
+            cursor.close()
+
+    def rangeCount(self, bbox, interval, approximate=False, exactBelow=1000000, sampleSize=1000):
+        # How many trips are picked up within the bounding box and the time interval?
+        # approximate: False -> exact count
+        #              True -> grid aggregate (if built, see buildGridAggregate), otherwise
+        #                      the collection size times the share of a random sample ($sample of sampleSize) in the range
+        #              "auto" -> exact count if the approximation is below exactBelow
+        start_time = datetime.datetime.now()
+
+        query = rangeQuery_Mongo(bbox, interval, self.fields)
+        if approximate:
+            grid = self.gridCollection()
+            if grid.find_one({u"_id": u"meta"}) is not None:
+                t, (res, rows) = self.gridHeatmap(bbox, interval, maxCells=float("inf"))
+                result = sum(row[2] for row in rows)
+            else:
+                pipeline = [{u"$sample": {u"size": sampleSize}},
+                            {u"$match": query},
+                            {u"$count": u"n"}]
+                matched = [doc[u"n"] for doc in self.collection.aggregate(pipeline)]
+                share = matched[0] / sampleSize if matched else 0.0
+                result = int(round(share * self.collection.estimated_document_count()))
+
+        if not approximate or (approximate == "auto" and result < exactBelow):
+            result = self.collection.count_documents(query)
 
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
 
-        # Below code is questioning if "Errors.Flag_2" attribute is exist.
-        # If it is exist, it is deleting this attribute.
+        return timediff, result
 
-        # start_time_antidote = datetime.datetime.now()
-        # antidote_update = self.collection.update_many(
-        #     {"Errors.Flag_2": {u"$exists": 1}},
-        #     {u"$unset": {"Errors.Flag_2": 1}}
-        # )
-        # finish_time_antidote = datetime.datetime.now()
-        # timediff_antidote = (finish_time - start_time).total_seconds()
-        #
-        # print("totalPrice_LTE2X_update Antidote Worked. \nModified: ", antidote_update.modified_count, "Antidote Took: ",timediff_antidote," seconds\n\n")
+#---------------------------      OD matrix     ------------------------------------------------------------
 
-        return timediff, update_query.modified_count
+    def odMatrix(self, interval, durationStats=False, batchSize=50000):
+        # Origin x destination trip counts of all the trips picked up within the interval (e.g. see dayInterval)
+        # The trips are streamed and assigned to the zones on the client side, batch by batch
+        # (instead of two $geoIntersects queries per trip as in pip_TimeInterval)
+        # Returns timediff, counts: NUM_ZONES x NUM_ZONES array; counts[o - 1, d - 1] = number of trips from o to d
+        # If durationStats: timediff, (counts, {"mean", "min", "max"} arrays of the journey times in SECONDS)
+        start_time = datetime.datetime.now()
 
-    def update_numPassengers_Equal2X(self,x):
-        # Below code is searching for passenger_count value equal to x
-        # As a result of search it is adding a new attribute named "Flag_3" under the Errors attribute.
+        zones = self.loadZones()
+
+        projection = {}
+        projection[self.fields["pickupCoords"]] = 1.0
+        projection[self.fields["dropoffCoords"]] = 1.0
+        projection[self.fields["tPickup"]] = 1.0
+        projection[self.fields["tDropoff"]] = 1.0
 
         query = {}
-        query["properties.passenger_count"] = x
+        query[self.fields["tPickup"]] = {
+            u"$gte": datetime.datetime.strptime(str(interval[0]), "%Y-%m-%d %H:%M:%S"),
+            u"$lt": datetime.datetime.strptime(str(interval[1]), "%Y-%m-%d %H:%M:%S")
+        }
+
+        counts = np.zeros((NUM_ZONES, NUM_ZONES), dtype=np.int64)
+        if durationStats:
+            totalDuration = np.zeros((NUM_ZONES, NUM_ZONES))
+            minDuration = np.full((NUM_ZONES, NUM_ZONES), np.inf)
+            maxDuration = np.full((NUM_ZONES, NUM_ZONES), -np.inf)
+
+        cursor = self.collection.find(query, projection=projection).batch_size(batchSize)
+
+        batch = []
+        for doc in itertools.chain(cursor, [None]):
+            if doc is not None:
+                batch.append((getField(doc, self.fields["pickupCoords"])[0], getField(doc, self.fields["pickupCoords"])[1],
+                              getField(doc, self.fields["dropoffCoords"])[0], getField(doc, self.fields["dropoffCoords"])[1],
+                              (getField(doc, self.fields["tDropoff"]) - getField(doc, self.fields["tPickup"])).total_seconds()))
+                if len(batch) < batchSize:
+                    continue
+            if not batch:
+                break
+
+            coords = np.array(batch)
+            batch = []
+
+            o = assignZones(zones, coords[:, 0], coords[:, 1])
+            d = assignZones(zones, coords[:, 2], coords[:, 3])
+            valid = (o > 0) & (d > 0)
+            cell = (o[valid] - 1, d[valid] - 1)
+
+            np.add.at(counts, cell, 1)
+            if durationStats:
+                np.add.at(totalDuration, cell, coords[valid, 4])
+                np.minimum.at(minDuration, cell, coords[valid, 4])
+                np.maximum.at(maxDuration, cell, coords[valid, 4])
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        if durationStats:
+            empty = counts == 0
+            durations = {"mean": np.where(empty, np.nan, totalDuration / np.maximum(counts, 1)),
+                         "min": np.where(empty, np.nan, minDuration),
+                         "max": np.where(empty, np.nan, maxDuration)}
+            return timediff, (counts, durations)
 
+        return timediff, counts
+
+    def useZones(self, collectionName=None):
+        # The zones of the PIP queries (pip_TripID, pip_TimeInterval, odMatrix):
+        # None -> the zones stored in the trip collection, otherwise e.g. "zones_subdivided" (see buildSubdividedZones)
+        if collectionName is None:
+            self.zoneCollection = self.collection
+        else:
+            self.zoneCollection = self.collection.database[collectionName]
+        self.zones = None
+
+    def zoneCursor(self, query):
+        # The zone of a point (query: $geoIntersects of the point), in pip_TripID and pip_TimeInterval
+        # A point on a shared border of two zones (or on a cut of the subdivided zones) intersects several polygons:
+        # a single zone is kept, the one of the lowest LocationID, i.e. the same on every run and on both zone sets
+        return self.zoneCollection.find(query).sort(u"properties.LocationID", 1).limit(1)
+
+    def buildSubdividedZones(self, features, targetName="zones_subdivided"):
+        # Pre-split zones: the pieces of the zone polygons, e.g. features = postgres.subdividedZones()
+        # (GeoJSON features with properties.LocationID), stored in targetName with a 2dsphere index.
+        # Small polygons make $geoIntersects cheaper; switch to them with useZones(targetName)
         start_time = datetime.datetime.now()
 
-        update_query = self.collection.update_many(query, {u"$set": {"Errors.Flag_3": "true"}})
+        target = self.collection.database[targetName]
+        target.drop()
+        target.insert_many([{u"type": u"Feature",
+                             u"properties": {u"LocationID": feature["properties"]["LocationID"]},
+                             u"geometry": feature["geometry"]} for feature in features])
+        target.create_index([(u"geometry", u"2dsphere")])
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        # Check:
-        # print("\nnumPassengers_Equal2X Update Worked. \nModified:", update_query.modified_count, "\nIt took", timediff,
-        #       "seconds\n")
+        return timediff
 
+    def loadZones(self):
+        # The zone polygons (see pip_TripID: the zones are stored in the collection with the 'geometry' field)
+        # as (LocationID, bounding box, rings) for the client side zone assignment - see assignZones
+        # Loaded once per instance
+        if getattr(self, "zones", None) is None:
+            query = {}
+            query["geometry"] = {u"$exists": True}
+            query["properties.LocationID"] = {u"$exists": True}
 
-        # Below code is questioning if "Errors.Flag_3" attribute is exist.
-        # If it is exist, it is deleting this attribute.
+            projection = {}
+            projection["geometry"] = 1.0
+            projection["properties.LocationID"] = 1.0
 
-        # start_time = datetime.datetime.now()
-        # antidote_update = self.collection.update_many(
-        #     {"Errors.Flag_3": {u"$exists": 1}},
-        #     {u"$unset": {"Errors.Flag_3": 1}}
-        # )
-        # finish_time = datetime.datetime.now()
-        # timediff_antidote = (finish_time - start_time).total_seconds()
-        #
-        # print("totalPrice_LTE2X_update Antidote Worked.\nModified:", antidote_update.modified_count, "Antidote Took: ",timediff_antidote," seconds\n\n")
+            self.zones = [zonePolygon(doc['properties']['LocationID'], doc['geometry'])
+                          for doc in self.zoneCollection.find(query, projection=projection)]
 
-        return timediff, update_query.modified_count
+        return self.zones
 
-    def update_longTrips(self, x):
-        # Those trips that are longer than x MILISECONDS are flagged.
+#---------------------------      Grid aggregate (heatmaps)     ---------------------------------------------
 
-        pipeline = [
-            {
-                u"$project": {
-                    u"properties": 1.0,
-                    u"dateDifference": {
-                        u"$subtract": [
-                            u"$properties.tpep_dropoff_datetime",
-                            u"$properties.tpep_pickup_datetime"
-                        ]
-                    }
-                }
-            },
-            {
-                u"$match": {
-                    u"dateDifference": {
-                        u"$gte": x
-                    }
-                }
+    def buildGridAggregate(self, resolutions=None, bucketMinutes=60, gridCollection=None):
+        # Precomputes the pickup/dropoff counts and the fare sums of each (grid cell, time bucket)
+        # The finest resolution is aggregated from the trips, the coarser ones are rolled up from it.
+        # resolutions: see GRID_RESOLUTIONS
+        # bucketMinutes: length of the time buckets
+        # gridCollection: where the aggregate is stored; default: <collection>_grid (same database)
+        # Requires MongoDB >= 4.4 ($merge into the collection being aggregated)
+        if resolutions is None:
+            resolutions = GRID_RESOLUTIONS
+        resolutions = sorted(resolutions, reverse=True)
+        finest = resolutions[0]
+        scale = 2 ** finest
+        bucketMs = bucketMinutes * 60 * 1000
+
+        grid = self.gridCollection(gridCollection)
+
+        start_time = datetime.datetime.now()
+
+        grid.drop()
+
+        def cellAndBucket(coordinatesField, timeField):
+            return {
+                u"cx": {u"$toInt": {u"$floor": {u"$multiply": [{u"$arrayElemAt": [u"$" + coordinatesField, 0]}, scale]}}},
+                u"cy": {u"$toInt": {u"$floor": {u"$multiply": [{u"$arrayElemAt": [u"$" + coordinatesField, 1]}, scale]}}},
+                u"t": {u"$toDate": {u"$subtract": [{u"$toLong": u"$" + timeField},
+                                                   {u"$mod": [{u"$toLong": u"$" + timeField}, bucketMs]}]}}
             }
+
+        # Pickups
+        project = cellAndBucket(self.fields["pickupCoords"], self.fields["tPickup"])
+        project[u"fare"] = {u"$divide": [u"$" + self.fields["fare"], self.fields["amountScale"]]}
+        pipeline = [
+            {u"$match": {self.fields["pickupCoords"]: {u"$exists": True}}},
+            {u"$project": project},
+            {u"$group": {u"_id": {u"res": finest, u"cx": u"$cx", u"cy": u"$cy", u"t": u"$t"},
+                         u"n_pickup": {u"$sum": 1},
+                         u"fare_sum": {u"$sum": u"$fare"}}},
+            {u"$set": {u"n_dropoff": 0}},
+            {u"$merge": {u"into": grid.name, u"on": u"_id", u"whenMatched": u"replace", u"whenNotMatched": u"insert"}}
         ]
+        self.collection.aggregate(pipeline, allowDiskUse=True)
+
+        # Dropoffs: added to the cells created by the pickups
+        pipeline = [
+            {u"$match": {self.fields["dropoffCoords"]: {u"$exists": True}}},
+            {u"$project": cellAndBucket(self.fields["dropoffCoords"], self.fields["tDropoff"])},
+            {u"$group": {u"_id": {u"res": finest, u"cx": u"$cx", u"cy": u"$cy", u"t": u"$t"},
+                         u"n_dropoff": {u"$sum": 1}}},
+            {u"$set": {u"n_pickup": 0, u"fare_sum": 0}},
+            {u"$merge": {u"into": grid.name, u"on": u"_id",
+                         u"whenMatched": [{u"$set": {u"n_dropoff": {u"$add": [u"$n_dropoff", u"$$new.n_dropoff"]}}}],
+                         u"whenNotMatched": u"insert"}}
+        ]
+        self.collection.aggregate(pipeline, allowDiskUse=True)
+
+        # Coarser resolutions
+        for res in resolutions[1:]:
+            divisor = 2 ** (finest - res)
+            pipeline = [
+                {u"$match": {u"_id.res": finest}},
+                {u"$group": {u"_id": {u"res": res,
+                                      u"cx": {u"$toInt": {u"$floor": {u"$divide": [u"$_id.cx", divisor]}}},
+                                      u"cy": {u"$toInt": {u"$floor": {u"$divide": [u"$_id.cy", divisor]}}},
+                                      u"t": u"$_id.t"},
+                             u"n_pickup": {u"$sum": u"$n_pickup"},
+                             u"n_dropoff": {u"$sum": u"$n_dropoff"},
+                             u"fare_sum": {u"$sum": u"$fare_sum"}}},
+                {u"$merge": {u"into": grid.name, u"on": u"_id", u"whenMatched": u"replace", u"whenNotMatched": u"insert"}}
+            ]
+            grid.aggregate(pipeline, allowDiskUse=True)
+
+        grid.create_index([(u"_id.res", 1), (u"_id.t", 1), (u"_id.cx", 1), (u"_id.cy", 1)])
+        grid.replace_one({u"_id": u"meta"},
+                         {u"_id": u"meta", u"resolutions": resolutions, u"bucketMinutes": bucketMinutes},
+                         upsert=True)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
+
+    def gridHeatmap(self, bbox, interval, maxCells=10000, res=None, gridCollection=None):
+        # Pickup/dropoff counts and fare sums of the cells within the bounding box and the time interval
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        # interval: e.g. ('2015-01-01 10:00:00', '2015-01-01 12:00:00')
+        # maxCells: the finest resolution having at most maxCells cells within bbox is selected (unless res is given)
+        # Returns: timediff, (res, [(cx, cy, n_pickup, n_dropoff, fare_sum), ...]) - see gridHeatmapArray
+        grid = self.gridCollection(gridCollection)
 
         start_time = datetime.datetime.now()
 
-        cursor = self.collection.aggregate(pipeline, allowDiskUse=True)
+        meta = grid.find_one({u"_id": u"meta"})
+        if res is None:
+            res = chooseGridResolution(bbox, meta[u"resolutions"], maxCells)
+        cx0, cy0 = gridCell(bbox[0], bbox[1], res)
+        cx1, cy1 = gridCell(bbox[2], bbox[3], res)
 
-        query = {}
-        numLongTrips = 0
-        for doc in cursor:
-            query["properties.ID_Postgres"] = doc["properties"]["ID_Postgres"]
-            self.collection.update(query, {u"$set": {"Errors.Flag_4": "true"}})
-            numLongTrips = numLongTrips + 1
+        # Buckets overlapping with the interval
+        t0 = datetime.datetime.strptime(str(interval[0]), "%Y-%m-%d %H:%M:%S") - datetime.timedelta(minutes=meta[u"bucketMinutes"])
+        t1 = datetime.datetime.strptime(str(interval[1]), "%Y-%m-%d %H:%M:%S")
+
+        pipeline = [
+            {u"$match": {u"_id.res": res,
+                         u"_id.t": {u"$gt": t0, u"$lt": t1},
+                         u"_id.cx": {u"$gte": cx0, u"$lte": cx1},
+                         u"_id.cy": {u"$gte": cy0, u"$lte": cy1}}},
+            {u"$group": {u"_id": {u"cx": u"$_id.cx", u"cy": u"$_id.cy"},
+                         u"n_pickup": {u"$sum": u"$n_pickup"},
+                         u"n_dropoff": {u"$sum": u"$n_dropoff"},
+                         u"fare_sum": {u"$sum": u"$fare_sum"}}}
+        ]
+
+        rows = [(doc[u"_id"][u"cx"], doc[u"_id"][u"cy"], doc[u"n_pickup"], doc[u"n_dropoff"], doc[u"fare_sum"])
+                for doc in grid.aggregate(pipeline)]
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        # Check:
-        #print("\nnumLongTrips Update Worked. \nModified:", a, "\nIt took", timediff, "seconds\n")
+        return timediff, (res, rows)
+
+    def gridCollection(self, gridCollection=None):
+        if gridCollection is None:
+            gridCollection = self.collection.name + "_grid"
+        return self.collection.database[gridCollection]
 
-        # Reverse operation:
+#---------------------------      Update Functions     -----------------------------------------------------
+# The data quality flags are stored as bits of a single integer field: ErrorFlags (see ERROR_FLAGS)
+# e.g. a trip with the same start and end time and location has ErrorFlags = 1 | 16 = 17
 
-        # antidote_update = self.collection.update_many(
-        #     {"Errors.Flag_4": {u"$exists": 1}},
-        #     {u"$unset": {"Errors.Flag_4": 1}})
-        #
+    @invalidatesCache
+    def update_sameStartEndTime(self):
+        # Does the trip have the same start and end time?
+        # If so it adds a flag.
+        # Reverse operation: self.clearErrorFlag("sameStartEndTime")
+        return self.setErrorFlag("sameStartEndTime")
 
-        return timediff, numLongTrips
+    @invalidatesCache
+    def update_totalPrice_LTE2X(self,x):
+        # Flags the trips that have a "Total Price Less Than or Equal To X"
+        # Reverse operation: self.clearErrorFlag("totalPrice_LTE2X")
+        return self.setErrorFlag("totalPrice_LTE2X", x)
 
+    @invalidatesCache
+    def update_numPassengers_Equal2X(self,x):
+        # Flags the trips whose passenger_count value is equal to x
+        # Reverse operation: self.clearErrorFlag("numPassengers_Equal2X")
+        return self.setErrorFlag("numPassengers_Equal2X", x)
 
+    @invalidatesCache
+    def update_longTrips(self, x):
+        # Those trips that are longer than x MILISECONDS are flagged.
+        # A single update_many with $expr (instead of one update per long trip)
+        # Reverse operation: self.clearErrorFlag("longTrips")
+        return self.setErrorFlag("longTrips", x)
 
+    @invalidatesCache
     def update_sameStartEndLocation(self):
         # This function flags those trips whose pickup and dropoff coordinates are the same
+        # Reverse operation: self.clearErrorFlag("sameStartEndLocation")
+        return self.setErrorFlag("sameStartEndLocation")
 
-        pipeline = [
-            {
-                u"$match": {
-                    u"geometry_pk": {
-                        u"$exists": True
-                    },
-                    u"geometry_do": {
-                        u"$exists": True
-                    },
-                    u"properties.ID_Postgres": {
-                        u"$exists": True
-                    }
-                }
-            },
-            {
-                u"$project": {
-                    u"geometry_pk": 1.0,
-                    u"geometry_do": 1.0,
-                    u"properties.ID_Postgres": 1.0,
-                    u"AyniMi?": {
-                        u"$eq": [
-                            u"$geometry_pk.coordinates",
-                            u"$geometry_do.coordinates"
-                        ]
-                    }
-                }
-            },
-                   {
-                       u"$match": {
-                           u"AyniMi?": True
-                       }
-                   }
-        ]
+    @invalidatesCache
+    def setErrorFlag(self, ruleName, x=None, query=None):
+        # Sets the bit of the rule (see ERROR_FLAGS) of the trips matching the query
+        # query: default: the rule's query (see qualityQuery_Mongo) with the parameter x
+        bit = errorFlagBit(ruleName)
+        if query is None:
+            query = qualityQuery_Mongo(ruleName, x, self.fields, self.hasDuration())
 
         start_time = datetime.datetime.now()
+        update_query = self.collection.update_many(query, {u"$bit": {self.fields["errorFlags"]: {u"or": bit}}})
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
 
-        cursor = self.collection.aggregate(pipeline, allowDiskUse=True)
+        # The number of trips matching the rule (also the ones flagged by a previous run)
+        return timediff, update_query.matched_count
 
-        query = {}
-        numSameLocation = 0
-        for doc in cursor:
-            query["properties.ID_Postgres"] = doc['properties']['ID_Postgres']
+    @invalidatesCache
+    def clearErrorFlag(self, ruleName):
+        bit = errorFlagBit(ruleName)
 
-            self.collection.update_many(query, {u"$set": {"Errors.Flag_5": "true"}})
-            numSameLocation = numSameLocation + 1
+        query = {}
+        query[self.fields["errorFlags"]] = {u"$bitsAllSet": bit}
 
+        start_time = datetime.datetime.now()
+        update_query = self.collection.update_many(query, {u"$bit": {self.fields["errorFlags"]: {u"and": ~bit}}})
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        #print("\ndo_eq_pk_points Update Worked. \nModified:", numSameLocation, "\nIt took", timediff, "seconds\n")
+        return timediff, update_query.modified_count
 
-        # Reverse operation:
-        # antidote_update = self.collection.update_many(
-        #     {"Errors.Flag_5": {u"$exists": 1}},
-        #     {u"$unset": {"Errors.Flag_5": 1}})
+    def createErrorFlagIndex(self):
+        # Only the flagged trips are indexed
+        start_time = datetime.datetime.now()
+        self.collection.create_index([(self.fields["errorFlags"], 1)], partialFilterExpression={self.fields["errorFlags"]: {u"$gt": 0}})
+        finish_time = datetime.datetime.now()
 
-        return timediff, numSameLocation
+        return (finish_time - start_time).total_seconds()
 
+    def countErrorFlag(self, ruleName):
+        # How many trips are flagged by the rule?
+        query = {}
+        query[self.fields["errorFlags"]] = {u"$gt": 0, u"$bitsAllSet": errorFlagBit(ruleName)}
 
-# -----------------------------------------------------------------------
-#   -------------   Postgres
+        start_time = datetime.datetime.now()
+        result = self.collection.count_documents(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
 
-class postgres():
-    # To improve the legibility of the queries, table names are not considered as an additional parameter.
-    # Following table names are used: 
-        # trips: table store all the trips
-        # zones: table storing the TLC zones
-    def __init__(self, dbName, userName, pswd, host, port):
-        try:
-            self.conn = psycopg2.connect(database=dbName,
-                            user=userName,
-                            password=pswd,
-                            host=host,
-                            port=port)
-            print("Connected to PostgreSQL Server")
-        except:
-            print("Postgres connection failed!")
+        return timediff, result
 
-    def findMinMax_Interval(self, tableName, columnName):
-        # At the moment this function returns the min-max of the column (could be id or nid - when a single day table is analysed) input
-        cur = self.conn.cursor()
+    def countPerFlag(self):
+        # Number of flagged trips of each rule, in a single pass over the flagged trips
+        # Returns timediff, {ruleName: count}
+        facets = {}
+        for ruleName, bit in ERROR_FLAGS.items():
+            facets[ruleName] = [{u"$match": {self.fields["errorFlags"]: {u"$bitsAllSet": bit}}},
+                                {u"$count": u"n"}]
 
-        query = "select min({}), max({}) " \
-                "from {}".format(columnName, columnName, tableName)
+        pipeline = [{u"$match": {self.fields["errorFlags"]: {u"$gt": 0}}},
+                    {u"$project": {self.fields["errorFlags"]: 1}},
+                    {u"$facet": facets}]
 
-        # Record the execution time of the query
         start_time = datetime.datetime.now()
-        cur.execute(query)
+        doc = next(self.collection.aggregate(pipeline, allowDiskUse=True))
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
-        result = cur.fetchall()
+        result = {}
+        for ruleName in ERROR_FLAGS:
+            result[ruleName] = doc[ruleName][0][u"n"] if doc[ruleName] else 0
 
-        cur.close()
         return timediff, result
 
-    # --------------------------      Methods related with data import/export
-    def postgres2GeoJSON(self, chunkSize, chunkID):
-        # chunkSize: number of records to be converted to GeoJSON to ease the RAM operations
-        # chunkID: the GeoJSON file is going to be saved by using this ID. starts from ZERO
-        template = \
-            '''
-            {
-            "type" : "Feature",
-                "geometry_pk" : {
-                    "type" : "Point",
-                    "coordinates" : [%s,%s]},
-                "properties": {
-                    "ID_Postgres": %s,
-                    "VendorID" : %s,
-                    "passenger_count" : %s,
-                    "store_and_fwd_flag" : "%s",
-                    "RatecodeID" : %s,
-                    "trip_distance" : %s,
-                    "payment_type" : %s,
-                    "fare_amount" : %s,
-                    "extra" : %s,
-                    "mta_tax" : %s,
-                    "tip_amount" : %s,
-                    "tolls_amount" : %s,
-                    "improvement_surcharge" : %s,
-                    "total_amount" : %s,
-                    "tpep_pickup_datetime" : ISODate("%s"),
-                    "tpep_dropoff_datetime" : ISODate("%s")},
-                "geometry_do" : {
-                    "type" : "Point",
-                    "coordinates" : [%s,%s]},
-            },
+#---------------------------      Zone x hour rollups     ---------------------------------------------------
 
-            '''
+    def rollupTrips(self, query, batchSize=50000):
+        # Pickups and dropoffs per (zone, hour) of the trips matching the query; the trips are streamed and
+        # assigned to the zones on the client side (see odMatrix). The dropoffs are counted in their dropoff hour
+        # Returns ({(zone, hour as datetime64[h]): [pickups, dropoffs]}, max key of the trips)
+        zones = self.loadZones()
 
-        # the head of the geojson file
-        output = \
-            '''
-            '''
+        projection = {}
+        projection[self.fields["key"]] = 1.0
+        projection[self.fields["pickupCoords"]] = 1.0
+        projection[self.fields["dropoffCoords"]] = 1.0
+        projection[self.fields["tPickup"]] = 1.0
+        projection[self.fields["tDropoff"]] = 1.0
+
+        counts = {}
+        maxKey = None
+        cursor = self.collection.find(query, projection=projection).batch_size(batchSize)
+
+        batch = []
+        for doc in itertools.chain(cursor, [None]):
+            if doc is not None:
+                batch.append(doc)
+                if len(batch) < batchSize:
+                    continue
+            if not batch:
+                break
+
+            keys = [getField(doc, self.fields["key"]) for doc in batch]
+            maxKey = max(keys) if maxKey is None else max(maxKey, max(keys))
+
+            for coordsField, timeField, column in ((self.fields["pickupCoords"], self.fields["tPickup"], 0),
+                                                   (self.fields["dropoffCoords"], self.fields["tDropoff"], 1)):
+                coords = np.array([getField(doc, coordsField) for doc in batch], dtype=np.float64)
+                hours = np.array([getField(doc, timeField) for doc in batch], dtype="datetime64[s]").astype("datetime64[h]")
+                zoneIDs = assignZones(zones, coords[:, 0], coords[:, 1])
+
+                valid = zoneIDs > 0
+                cells, n = np.unique(hours[valid].astype(np.int64) * 1000 + zoneIDs[valid], return_counts=True)
+                for cell, c in zip(cells.tolist(), n.tolist()):
+                    key = (cell % 1000, np.datetime64(cell // 1000, "h"))
+                    counts.setdefault(key, [0, 0])[column] += c
+
+            batch = []
+
+        return counts, maxKey
+
+    def mergeZoneHourCounts(self, counts, name="zone_hour_counts"):
+        # Adds the counts (see rollupTrips) to the rollup collection with $merge: the existing (zone, hour) documents
+        # are incremented, the new ones inserted
+        if not counts:
+            return
+
+        staging = self.collection.database["{}_staging_{}".format(name, uuid.uuid4().hex)]
+        staging.insert_many([{u"zone": zone,
+                              u"hour": hour.astype("datetime64[s]").astype(datetime.datetime),
+                              u"pickups": c[0],
+                              u"dropoffs": c[1]} for (zone, hour), c in counts.items()])
+        staging.aggregate([
+            {u"$project": {u"_id": 0, u"zone": 1, u"hour": 1, u"pickups": 1, u"dropoffs": 1}},
+            {u"$merge": {
+                u"into": name,
+                u"on": [u"zone", u"hour"],
+                u"whenMatched": [{u"$set": {u"pickups": {u"$add": [u"$pickups", u"$$new.pickups"]},
+                                            u"dropoffs": {u"$add": [u"$dropoffs", u"$$new.dropoffs"]}}}],
+                u"whenNotMatched": u"insert"
+            }}
+        ])
+        staging.drop()
+
+    @invalidatesCache
+    def buildZoneHourCounts(self, numWorkers=4, name="zone_hour_counts"):
+        # Builds the rollup collection 'name' {zone, hour, pickups, dropoffs} from scratch, day by day in parallel
+        # The max key of the trips is kept as the watermark of updateZoneHourCounts (in <name>_meta)
+        # Returns timediff
+        start_time = datetime.datetime.now()
 
-        outFileHandle = open("nyc2015_json_%s.geojson" % str(chunkID), "a")
+        database = self.collection.database
+        database[name].drop()
+        database[name + "_meta"].drop()
+        database[name].create_index([(u"zone", 1), (u"hour", 1)], unique=True)
+        database[name].create_index([(u"hour", 1)])
 
-        cur = self.conn.cursor()
+        query = {}
+        query[self.fields["key"]] = {u"$type": u"number"}
+        last = self.collection.find_one(query, projection={self.fields["key"]: 1.0}, sort=[(self.fields["key"], -1)])
+        if last is None:
+            return 0.0
+        watermark = getField(last, self.fields["key"])
 
-        cur.execute(""" SELECT *
-                            FROM staging
-                            where id > {} and id <= {}
-                            order by id """.format(chunkID * chunkSize, (chunkID + 1) * chunkSize))
+        query = {}
+        query[self.fields["tPickup"]] = {u"$exists": True}
+        projection = {self.fields["tPickup"]: 1.0}
+        first = getField(self.collection.find_one(query, projection=projection, sort=[(self.fields["tPickup"], 1)]), self.fields["tPickup"])
+        last = getField(self.collection.find_one(query, projection=projection, sort=[(self.fields["tPickup"], -1)]), self.fields["tPickup"])
+        days = [first.date() + datetime.timedelta(days=i) for i in range((last.date() - first.date()).days + 1)]
 
-        rows = cur.fetchall()
-        c = 0
-        for row in rows:
-            record = ''
-            id = row[0]
-            vendorID = row[1]
-            t_pickup = rearrangeTimeFormat(str(row[2]))
-            t_dropoff = rearrangeTimeFormat(str(row[3]))
-            passenger_count = row[4]
+        # $merge of concurrent days could race on the same (zone, hour): the merges are serialised
+        lock = threading.Lock()
+
+        def rollupDay(day):
+            interval = dayInterval(day)
+            query = {}
+            query[self.fields["tPickup"]] = {
+                u"$gte": datetime.datetime.strptime(interval[0], "%Y-%m-%d %H:%M:%S"),
+                u"$lt": datetime.datetime.strptime(interval[1], "%Y-%m-%d %H:%M:%S")
+            }
+            query[self.fields["key"]] = {u"$lte": watermark}
+            counts, maxKey = self.rollupTrips(query)
+            with lock:
+                self.mergeZoneHourCounts(counts, name)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            list(executor.map(rollupDay, days))
+
+        database[name + "_meta"].replace_one({u"_id": u"watermark"}, {u"_id": u"watermark", u"key": watermark}, upsert=True)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
+
+    @invalidatesCache
+    def updateZoneHourCounts(self, name="zone_hour_counts"):
+        # Adds the trips inserted since the last build/update (key above the watermark) to the rollup collection
+        # Returns timediff, new watermark
+        start_time = datetime.datetime.now()
+
+        meta = self.collection.database[name + "_meta"]
+        watermark = meta.find_one({u"_id": u"watermark"})[u"key"]
+
+        query = {}
+        query[self.fields["key"]] = {u"$gt": watermark}
+        query[self.fields["tPickup"]] = {u"$exists": True}
+        counts, maxKey = self.rollupTrips(query)
+        self.mergeZoneHourCounts(counts, name)
+        if maxKey is not None:
+            watermark = maxKey
+            meta.replace_one({u"_id": u"watermark"}, {u"_id": u"watermark", u"key": watermark}, upsert=True)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, watermark
+
+    def zoneHourMatrix(self, start, end, kind="pickups", name="zone_hour_counts"):
+        # Dense zones x hours matrix of the rollup for the days start..end (datetime.date, both inclusive)
+        # kind: "pickups" or "dropoffs"
+        # Returns timediff, (hours: datetime64[h] array, counts: NUM_ZONES x len(hours) array; counts[zone - 1, i])
+        if kind not in ("pickups", "dropoffs"):
+            raise ValueError("Unknown kind: {} (pickups or dropoffs)".format(kind))
+
+        start_time = datetime.datetime.now()
+
+        query = {u"hour": {u"$gte": datetime.datetime(start.year, start.month, start.day),
+                           u"$lt": datetime.datetime(end.year, end.month, end.day) + datetime.timedelta(days=1)}}
+        projection = {u"_id": 0, u"zone": 1, u"hour": 1, kind: 1}
+        rows = [(doc[u"zone"], doc[u"hour"], doc[kind]) for doc in self.collection.database[name].find(query, projection=projection)]
+
+        hours, counts = zoneHourArray(rows, start, end)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, (hours, counts)
+
+#---------------------------      Parallel scans and sharding     -------------------------------------------
+
+    def createKeyIndex(self):
+        # Index of the trip key (ID_Postgres in the geojson layout; _id is always indexed)
+        # The range scans of parallelCount need it, otherwise each range is a full collection scan
+        if self.fields["key"] != "_id":
+            self.collection.create_index([(self.fields["key"], 1)], sparse=True)
+
+    def keyRanges(self, numRanges, samplesPerRange=100):
+        # Splits the trip keys (ID_Postgres or _id, see MONGO_LAYOUTS) into numRanges ranges of about the same
+        # number of trips: the boundaries are quantiles of a $sample of the keys, hence gaps of the IDs
+        # (e.g. 8M1 - 10M) do not result in empty ranges. [(lo, hi), ...], lo inclusive, hi exclusive
+        self.createKeyIndex()
+        query = {}
+        query[self.fields["key"]] = {u"$type": u"number"}
+        projection = {}
+        projection[self.fields["key"]] = 1.0
+
+        first = self.collection.find_one(query, projection=projection, sort=[(self.fields["key"], 1)])
+        last = self.collection.find_one(query, projection=projection, sort=[(self.fields["key"], -1)])
+        if first is None:
+            return []
+
+        lo = int(getField(first, self.fields["key"]))
+        hi = int(getField(last, self.fields["key"])) + 1
+
+        pipeline = [{u"$sample": {u"size": numRanges * samplesPerRange}},
+                    {u"$match": query},
+                    {u"$project": projection}]
+        keys = np.sort(np.array([int(getField(doc, self.fields["key"])) for doc in
+                                 self.collection.aggregate(pipeline, allowDiskUse=True)], dtype=np.int64))
+        if len(keys) == 0:
+            return [(lo, hi)]
+
+        cuts = np.quantile(keys, np.arange(1, numRanges) / float(numRanges)).astype(np.int64)
+        boundaries = [lo] + sorted(set(int(c) for c in cuts if lo < c < hi)) + [hi]
+
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def keyRangeQuery(self, keyRange, query):
+        rangeQuery = {}
+        rangeQuery[self.fields["key"]] = {u"$gte": keyRange[0], u"$lt": keyRange[1]}
+        return {u"$and": [rangeQuery, query]}
+
+    def parallelCount(self, ruleName=None, x=None, query=None, numRanges=32, numWorkers=8):
+        # Number of trips satisfying the rule (see qualityQuery_Mongo) or the query, counted by numWorkers
+        # concurrent scans of key ranges over the pooled connections of the client, i.e. a full collection scan
+        # (e.g. sameStartEndTime with $expr) is not limited to a single thread of the server
+        # Each range is an index range scan of the key (see createKeyIndex, parallelCountPlan)
+        # numRanges > numWorkers balances the ranges of different densities
+        # Returns timediff, count
+        if query is None:
+            query = qualityQuery_Mongo(ruleName, x, self.fields, self.hasDuration())
+
+        start_time = datetime.datetime.now()
+
+        hint = [(self.fields["key"], 1)]
+
+        def countRange(keyRange):
+            return self.collection.count_documents(self.keyRangeQuery(keyRange, query), hint=hint)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            result = sum(executor.map(countRange, self.keyRanges(numRanges)))
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, result
+
+    def parallelCountPlan(self, ruleName=None, x=None, query=None, numRanges=32):
+        # The winning plan of the count of the first key range of parallelCount (explain, queryPlanner)
+        if query is None:
+            query = qualityQuery_Mongo(ruleName, x, self.fields, self.hasDuration())
+        keyRanges = self.keyRanges(numRanges)
+        if not keyRanges:
+            return None
+
+        explain = self.collection.database.command(
+            "explain", {u"count": self.collection.name, u"query": self.keyRangeQuery(keyRanges[0], query),
+                        u"hint": {self.fields["key"]: 1}}, verbosity="queryPlanner")
+
+        return explain[u"queryPlanner"][u"winningPlan"]
+
+    def shardCollection(self, numInitialChunks=None):
+        # Shards the collection on the hashed pickup time (the client must be connected to a mongos):
+        # consecutive trips are spread over all the shards, hence the scans of a time interval run on every shard.
+        # A local test cluster could be started with mtools, e.g.: mlaunch init --sharded 3 --replicaset --nodes 1
+        # numInitialChunks: optional number of initial chunks of the empty collection
+        database = self.collection.database
+        self.client.admin.command("enableSharding", database.name)
+        self.collection.create_index([(self.fields["tPickup"], u"hashed")])
+
+        command = {u"key": {self.fields["tPickup"]: u"hashed"}}
+        if numInitialChunks is not None:
+            command[u"numInitialChunks"] = numInitialChunks
+
+        return self.client.admin.command("shardCollection", self.collection.full_name, **command)
+
+    def shardDistribution(self):
+        # Number of documents and size on each shard: {shard: {"count", "size"}} (empty if not sharded)
+        stats = self.collection.database.command("collStats", self.collection.name)
+
+        return dict((shard, {"count": s[u"count"], "size": s[u"size"]}) for shard, s in stats.get(u"shards", {}).items())
+
+#---------------------------      Cache state (see ST_Benchmark.cacheState)     ------------------------------
+
+    def prewarm(self):
+        # Loads the collection and all its indexes into the WiredTiger cache (the touch command is gone since 4.4):
+        # a full collection scan, then a full scan of every index (count with the index as hint)
+        # Returns timediff
+        start_time = datetime.datetime.now()
+
+        self.collection.count_documents({}, hint=[(u"$natural", 1)])
+        for indexName in self.collection.index_information():
+            try:
+                self.collection.count_documents({}, hint=indexName)
+            except Exception:
+                # e.g. sparse / partial indexes can not serve an unfiltered count
+                pass
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
+
+    def cacheStats(self):
+        # WiredTiger cache counters of the server: the difference of two calls shows the reads from disk
+        cache = self.client.admin.command("serverStatus")[u"wiredTiger"][u"cache"]
+
+        return {"bytesInCache": cache[u"bytes currently in the cache"],
+                "pagesReadIntoCache": cache[u"pages read into cache"]}
+
+    def resetStats(self):
+        # Best effort for cold runs without a restart: the cached query plans are dropped
+        self.collection.database.command("planCacheClear", self.collection.name)
+
+
+instrumentClass(mongoDB)
+
+
+# -----------------------------------------------------------------------
+#   -------------   Postgres
+
+class postgres():
+    # To improve the legibility of the queries, table names are not considered as an additional parameter.
+    # Following table names are used: 
+        # trips: table store all the trips
+        # zones: table storing the TLC zones (or zones_subdivided, see useZones)
+    # cache: optional ST_Cache.queryCache - repeated k-NN/PIP/time series queries are then served from the cache
+    # connect: "lazy", "async" or "eager" (see CONNECT_MODES); self.conn is opened on first use unless "eager"
+    # timeout: connection timeout in seconds (connect_timeout of libpq)
+    def __init__(self, dbName, userName, pswd, host, port, cache=None, connect="lazy", timeout=5):
+        if connect not in CONNECT_MODES:
+            raise ValueError("Unknown connect mode: {} (one of {})".format(connect, ", ".join(CONNECT_MODES)))
+        loadPsycopg2()
+
+        self.cache = cache
+        # Kept for the connection pool of the parallel methods (see connectionPool)
+        self.connParams = {"database": dbName,
+                           "user": userName,
+                           "password": pswd,
+                           "host": host,
+                           "port": port,
+                           "connect_timeout": int(math.ceil(timeout))}
+        # The zones of the PIP queries (see useZones / zoneJoin)
+        self.zoneTable = "zones"
+        self._conn = None
+        self._connecting = None
+
+        if connect == "async":
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._connecting = executor.submit(psycopg2.connect, **self.connParams)
+            executor.shutdown(wait=False)
+        elif connect == "eager":
+            try:
+                self.conn = psycopg2.connect(**self.connParams)
+                print("Connected to PostgreSQL Server")
+            except:
+                print("Postgres connection failed!")
+
+    @property
+    def conn(self):
+        # The connection of the queries, opened by the first query (lazy) or waited for (async)
+        if self._conn is None:
+            if self._connecting is not None:
+                future, self._connecting = self._connecting, None
+                self._conn = future.result()
+            else:
+                self._conn = psycopg2.connect(**self.connParams)
+        return self._conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._conn = conn
+
+    def cacheNamespace(self):
+        # Cached results are invalidated per database; built from the parameters, hence a cache hit needs no connection
+        return "postgres:host={host} port={port} dbname={database}".format(**self.connParams)
+
+    def findMinMax_Interval(self, tableName, columnName):
+        # At the moment this function returns the min-max of the column (could be id or nid - when a single day table is analysed) input
+        cur = self.conn.cursor()
+
+        query = "select min({}), max({}) " \
+                "from {}".format(columnName, columnName, tableName)
+
+        # Record the execution time of the query
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        result = cur.fetchall()
+
+        cur.close()
+        return timediff, result
+
+    # --------------------------      Statistics used to generate realistic workloads (see ST_Workload)
+
+    def idRanges(self, tableName, columnName):
+        # Returns the list of the (min, max) ranges of the consecutive IDs of the table
+        # e.g. the trips table: [(1, 8000000), (10000001, ...)]
+        # Runs a full scan of the ID index: call it once and keep the result with the workload
+        cur = self.conn.cursor()
+
+        query = "select min({}), max({}) " \
+                "from (select {}, {} - row_number() over (order by {}) as grp from {}) t " \
+                "group by grp " \
+                "order by 1".format(columnName, columnName, columnName, columnName, columnName, tableName)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        result = [(row[0], row[1]) for row in cur.fetchall()]
+
+        cur.close()
+        return timediff, result
+
+    def hourlyVolume(self, tableName):
+        # Number of trips starting at each hour of the day (24 counts)
+        cur = self.conn.cursor()
+
+        query = "select extract(hour from t_pickup)::int, count(*) " \
+                "from {} " \
+                "group by 1".format(tableName)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        result = [0] * 24
+        for row in cur.fetchall():
+            result[row[0]] = row[1]
+
+        cur.close()
+        return timediff, result
+
+    def dailyVolume(self, tableName, start, end):
+        # Number of trips of each day between start and end (datetime.date, both inclusive)
+        cur = self.conn.cursor()
+
+        query = "select t_pickup::date, count(*) " \
+                "from {} " \
+                "where t_pickup >= '{}' and t_pickup < '{}' " \
+                "group by 1".format(tableName, start, end + datetime.timedelta(days=1))
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        result = [0] * ((end - start).days + 1)
+        for row in cur.fetchall():
+            result[(row[0] - start).days] = row[1]
+
+        cur.close()
+        return timediff, result
+
+    # --------------------------      Methods related with data import/export
+    def postgres2GeoJSON(self, chunkSize, chunkID):
+        # chunkSize: number of records to be converted to GeoJSON to ease the RAM operations
+        # chunkID: the GeoJSON file is going to be saved by using this ID. starts from ZERO
+        template = \
+            '''
+            {
+            "_id" : %s,
+            "type" : "Feature",
+                "geometry_pk" : {
+                    "type" : "Point",
+                    "coordinates" : [%s,%s]},
+                "properties": {
+                    "ID_Postgres": %s,
+                    "VendorID" : %s,
+                    "passenger_count" : %s,
+                    "store_and_fwd_flag" : "%s",
+                    "RatecodeID" : %s,
+                    "trip_distance" : %s,
+                    "payment_type" : %s,
+                    "fare_amount" : %s,
+                    "extra" : %s,
+                    "mta_tax" : %s,
+                    "tip_amount" : %s,
+                    "tolls_amount" : %s,
+                    "improvement_surcharge" : %s,
+                    "total_amount" : %s,
+                    "duration_s" : %s,
+                    "tpep_pickup_datetime" : ISODate("%s"),
+                    "tpep_dropoff_datetime" : ISODate("%s")},
+                "geometry_do" : {
+                    "type" : "Point",
+                    "coordinates" : [%s,%s]},
+            },
+
+            '''
+
+        # the head of the geojson file
+        output = \
+            '''
+            '''
+
+        outFileHandle = open("nyc2015_json_%s.geojson" % str(chunkID), "a")
+
+        cur = self.conn.cursor()
+
+        cur.execute(""" SELECT *
+                            FROM staging
+                            where id > {} and id <= {}
+                            order by id """.format(chunkID * chunkSize, (chunkID + 1) * chunkSize))
+
+        rows = cur.fetchall()
+        c = 0
+        numBytes = 0
+        for row in rows:
+            record = ''
+            id = row[0]
+            vendorID = row[1]
+            t_pickup = formatISOTime(row[2])
+            t_dropoff = formatISOTime(row[3])
+            passenger_count = row[4]
             trip_distance = row[5]
             pickup_longitude = row[6]
             pickup_latitude = row[7]
@@ -844,8 +1804,10 @@ class postgres():
             tolls_amount = row[17]
             improvement_surcharge = row[18]
             total_amount = row[19]
+            duration_s = durationSeconds(row[2], row[3])
 
-            record += template % (pickup_longitude,
+            record += template % (id,
+                                  pickup_longitude,
                                   pickup_latitude,
                                   id,
                                   vendorID,
@@ -861,6 +1823,7 @@ class postgres():
                                   tolls_amount,
                                   improvement_surcharge,
                                   total_amount,
+                                  duration_s,
                                   t_pickup,
                                   t_dropoff,
                                   dropoff_longitude,
@@ -868,6 +1831,7 @@ class postgres():
 
             # Add the record to the GeoJSON file
             outFileHandle.write(record)
+            numBytes += len(record)
 
             c += 1
 
@@ -878,6 +1842,8 @@ class postgres():
 
         outFileHandle.write(output)
         outFileHandle.close()
+        addRows(c)
+        addBytes(numBytes + len(output))
 
         del rows
         cur.close()
@@ -893,6 +1859,7 @@ class postgres():
         template = \
             '''
             {
+            "_id" : %s,
             "type" : "Feature",
                 "geometry_pk" : {
                     "type" : "Point",
@@ -913,6 +1880,7 @@ class postgres():
                     "tolls_amount" : %s,
                     "improvement_surcharge" : %s,
                     "total_amount" : %s,
+                    "duration_s" : %s,
                     "tpep_pickup_datetime" : ISODate("%s"),
                     "tpep_dropoff_datetime" : ISODate("%s")},
                 "geometry_do" : {
@@ -938,13 +1906,14 @@ class postgres():
 
         rows = cur.fetchall()
         c = 0
+        numBytes = 0
         for row in rows:
             record = ''
             nid = row[0]
             id = row[1]
             vendorID = row[2]
-            t_pickup = rearrangeTimeFormat(str(row[3]))
-            t_dropoff = rearrangeTimeFormat(str(row[4]))
+            t_pickup = formatISOTime(row[3])
+            t_dropoff = formatISOTime(row[4])
             passenger_count = row[5]
             trip_distance = row[6]
             pickup_longitude = row[7]
@@ -961,8 +1930,10 @@ class postgres():
             tolls_amount = row[18]
             improvement_surcharge = row[19]
             total_amount = row[20]
+            duration_s = durationSeconds(row[3], row[4])
 
-            record += template % (pickup_longitude,
+            record += template % (id,
+                                  pickup_longitude,
                                   pickup_latitude,
                                   nid,
                                   id,
@@ -979,6 +1950,7 @@ class postgres():
                                   tolls_amount,
                                   improvement_surcharge,
                                   total_amount,
+                                  duration_s,
                                   t_pickup,
                                   t_dropoff,
                                   dropoff_longitude,
@@ -986,6 +1958,7 @@ class postgres():
 
             # Add the record to the GeoJSON file
             outFileHandle.write(record)
+            numBytes += len(record)
 
             c += 1
 
@@ -996,6 +1969,63 @@ class postgres():
 
         outFileHandle.write(output)
         outFileHandle.close()
+        addRows(c)
+        addBytes(numBytes + len(output))
+
+        del rows
+        cur.close()
+
+    def postgres2CompactJSON(self, chunkSize, chunkID, tableName="staging", withNID=False):
+        # Exports the trips in the compact layout (see MONGO_LAYOUTS) as JSON lines (MongoDB extended JSON),
+        # to be imported with: mongoimport --collection <name> --file nyc2015_compact_<chunkID>.json
+        # chunkSize, chunkID: see postgres2GeoJSON
+        # withNID: True if the table is a single day table having the NEW ID (nid) - see postgres2GeoJSON_SubTable
+        idColumn = "nid" if withNID else "id"
+        offset = 1 if withNID else 0
+
+        outFileHandle = open("nyc2015_compact_%s.json" % str(chunkID), "a")
+
+        cur = self.conn.cursor()
+
+        cur.execute(""" SELECT *
+                            FROM {}
+                            where {} > {} and {} <= {}
+                            order by {} """.format(tableName, idColumn, chunkID * chunkSize, idColumn, (chunkID + 1) * chunkSize, idColumn))
+
+        rows = cur.fetchall()
+        numBytes = 0
+        for row in rows:
+            # The same column positions as postgres2GeoJSON / postgres2GeoJSON_SubTable
+            r = row[offset:]
+            document = {"_id": r[0],
+                        "v": toInt(r[1]),
+                        "tp": {"$date": formatISOTime(r[2])},
+                        "td": {"$date": formatISOTime(r[3])},
+                        "pc": r[4],
+                        "dist": r[5],
+                        "pk": [r[6], r[7]],
+                        "rc": toInt(r[8]),
+                        "sf": r[9] == "Y",
+                        "do": [r[10], r[11]],
+                        "pt": toInt(r[12]),
+                        "fa": toCents(r[13]),
+                        "ex": toCents(r[14]),
+                        "mta": toCents(r[15]),
+                        "tip": toCents(r[16]),
+                        "tol": toCents(r[17]),
+                        "sur": toCents(r[18]),
+                        "tot": toCents(r[19]),
+                        "dur": durationSeconds(r[2], r[3])}
+            if withNID:
+                document["nid"] = row[0]
+
+            line = json.dumps(document, separators=(",", ":")) + "\n"
+            outFileHandle.write(line)
+            numBytes += len(line)
+
+        outFileHandle.close()
+        addRows(len(rows))
+        addBytes(numBytes)
 
         del rows
         cur.close()
@@ -1025,7 +2055,11 @@ class postgres():
 
 
     #  --How many trips have the same start and end time?
-    def sameStartEndTime(self):
+    def sameStartEndTime(self, approximate=False, sampleFraction=None, targetError=0.01):
+        # approximate: True -> estimated on a TABLESAMPLE, see approximateCount (the same for the other counts)
+        if approximate:
+            return self.approximateCount("sameStartEndTime", None, sampleFraction, targetError)
+
         cur = self.conn.cursor()
 
         query = "select count(*) " \
@@ -1045,9 +2079,12 @@ class postgres():
 
 
     # --How many trips have a total price LESS THAN or EQUAL to X?
-    def totalPrice_LTE2X(self, x):
+    def totalPrice_LTE2X(self, x, approximate=False, sampleFraction=None, targetError=0.01):
         # x: total price
         # Retrives the query result : How many "Total amount" value is less than or equal to input 'x'
+        if approximate:
+            return self.approximateCount("totalPrice_LTE2X", x, sampleFraction, targetError)
+
         cur = self.conn.cursor()
 
         query = "select count(*) " \
@@ -1064,7 +2101,10 @@ class postgres():
         return timediff, result
 
     # --How many trips have X number of customers? Zero or less number of passengers are not meaningful
-    def numPassengers_Equal2X(self, x):
+    def numPassengers_Equal2X(self, x, approximate=False, sampleFraction=None, targetError=0.01):
+        if approximate:
+            return self.approximateCount("numPassengers_Equal2X", x, sampleFraction, targetError)
+
         cur = self.conn.cursor()
 
         query = "select count(*) " \
@@ -1081,15 +2121,16 @@ class postgres():
         return timediff, result
 
     # -- Some trips could be unrealistically long. Given a long definition in SECONDS
-    def numLongTrips(self, threshold):
+    def numLongTrips(self, threshold, approximate=False, sampleFraction=None, targetError=0.01):
+        if approximate:
+            return self.approximateCount("longTrips", threshold, sampleFraction, targetError)
+
         cur = self.conn.cursor()
 
+        # With duration_s (see addDuration): index range scan; otherwise a single interval comparison per row
         query = "select count(*) "\
                 "from trips " \
-                "where DATE_PART('day', t_dropoff - t_pickup) * 60 * 60 * 24 + " \
-                      "DATE_PART('hour', t_dropoff - t_pickup) * 60 * 60 + " \
-                      "DATE_PART('minute', t_dropoff - t_pickup) * 60 + " \
-                      "DATE_PART('second', t_dropoff - t_pickup) >= {}".format(threshold)
+                "where {}".format(qualityCondition_Postgres("longTrips", threshold, "trips", self.hasDuration()))
 
         start_time = datetime.datetime.now()
         cur.execute(query)
@@ -1102,6 +2143,54 @@ class postgres():
 
 
 
+    def approximateCount(self, ruleName, x=None, sampleFraction=None, targetError=0.01, confidence=0.95,
+                         method="BERNOULLI", exactBelow=1000000):
+        # Estimates the number of trips satisfying the rule (see qualityCondition_Postgres) on a TABLESAMPLE of trips
+        # sampleFraction: share of the rows in the sample; default: the sample size of the targetError
+        # targetError: half width of the confidence interval as a share of the table (0.01: +-1% of the trips)
+        # method: "BERNOULLI" (random rows, reads every page) or "SYSTEM" (random pages, fast). The trips are stored in
+        # time order, hence the rows of a page are alike: the SYSTEM interval is widened by the design effect of
+        # the page clusters (see pageDesignEffect)
+        # exactBelow: tables smaller than this (pg_class.reltuples) are counted exactly
+        # Returns timediff, {"count", "low", "high", "exact", "sampleSize"} (see countInterval)
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        condition = qualityCondition_Postgres(ruleName, x, "trips", self.hasDuration())
+        cur.execute("select reltuples::bigint from pg_class where oid = 'trips'::regclass")
+        total = cur.fetchone()[0]
+        if sampleFraction is None:
+            sampleFraction = sampleSizeFor(targetError, confidence) / float(max(total, 1))
+
+        # reltuples < 0: the table has never been analysed
+        if total < exactBelow or sampleFraction >= 1:
+            cur.execute("select count(*) from trips where {}".format(condition))
+            count = cur.fetchone()[0]
+            result = {"count": count, "low": count, "high": count, "exact": True, "sampleSize": max(total, count)}
+        elif method.upper() == "SYSTEM":
+            # Sampled rows / matching rows per page (the block number of ctid)
+            query = "select count(*), count(*) filter (where {}) " \
+                    "from trips tablesample system ({}) " \
+                    "group by (ctid::text::point)[0]".format(condition, sampleFraction * 100)
+            cur.execute(query)
+            pages = cur.fetchall()
+            sampleSize = sum(page[0] for page in pages)
+            matched = sum(page[1] for page in pages)
+            result = countInterval(matched, sampleSize, total, confidence, pageDesignEffect(pages))
+        else:
+            query = "select count(*), count(*) filter (where {}) " \
+                    "from trips tablesample {} ({})".format(condition, method, sampleFraction * 100)
+            cur.execute(query)
+            sampleSize, matched = cur.fetchone()
+            result = countInterval(matched, sampleSize, total, confidence)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, result
+
+    @cachedQuery
     def k_NN_v1(self, tripID, k, nameIDColumn, tableName):
         # This query determines the k_NN of a a pickup location of a trip by joining the trip table twice
         # nameIDColumn: usually id, but could also be "nid" if a single day is analysed
@@ -1132,6 +2221,7 @@ class postgres():
 
 
 
+    @cachedQuery
     def k_NN_v2(self, tripID,k, nameIDColumn, tableName):
         # This query determines the k_NN of a pickup location of a trip using id insertion
         # It has a similar idea to MongoDB query
@@ -1159,6 +2249,7 @@ class postgres():
         cur.close()
         return timediff, k_NN
 
+    @cachedQuery
     def pip_tripID(self, tripID):
         # pip: point_in_polygon
         # This method returns the Origin - Destination polygon of the pickup location of the trip ID
@@ -1166,9 +2257,10 @@ class postgres():
 
         q_pip = "SELECT z1.gid as O, z2.gid as D \n" \
                 "FROM trips t \n" \
-                "FULL JOIN zones z1 ON ST_Contains(z1.geom, t.l_pickup) \n" \
-                "FULL JOIN zones z2 ON ST_Contains(z2.geom, t.l_dropoff) \n" \
-                "WHERE t.id = {}".format(tripID)
+                "{} \n" \
+                "{} \n" \
+                "WHERE t.id = {}".format(self.zoneJoin("z1", "t.l_pickup", "FULL"),
+                                         self.zoneJoin("z2", "t.l_dropoff", "FULL"), tripID)
 
         start_time = datetime.datetime.now()
         cur.execute(q_pip)
@@ -1184,19 +2276,17 @@ class postgres():
     def pip_TimeInterval(self, interval, useCursor):
         # Interval is the random time interval the OD data is to be generated
         # useCursor is an optional parameter: it indeed speeds up the execution time considerably
+        # For long intervals (e.g. a month) see pip_TimeInterval_stream: the rows are not kept in RAM
         if(useCursor == True):
-            cur = self.conn.cursor("with_cursor")
+            # A unique name: concurrent calls must not share the named cursor
+            cur = self.conn.cursor("pip_cursor_" + uuid.uuid4().hex)
         else:
             cur = self.conn.cursor() # the traditional approach
 
         #print(interval[0], interval[1])
 
         # pip for the given time interval
-        q_pip = "SELECT z1.gid as origin_zone, z2.gid as destination_zone \n" \
-                "FROM trips t \n" \
-                "FULL JOIN zones z1 ON ST_Contains(z1.geom, t.l_pickup) \n" \
-                "FULL JOIN zones z2 ON ST_Contains(z2.geom, t.l_dropoff) \n" \
-                "WHERE t.t_pickup >= '{}' and t.t_pickup < '{}'".format(interval[0], interval[1])    
+        q_pip = self.pipTimeIntervalQuery(interval)
 
         start_time = datetime.datetime.now()
         cur.execute(q_pip)
@@ -1204,7 +2294,7 @@ class postgres():
         timediff = (finish_time - start_time).total_seconds()
 
         od = cur.fetchall()
-        cur.close
+        cur.close()
 
     
         # Note: If all the trip information is to be retrieved (i.e. taxiTrip.*) RAM error is observed:
@@ -1216,6 +2306,113 @@ class postgres():
 
         return timediff, od
 
+    def pip_TimeIntervals(self, intervals, useCursor=True):
+        # Batch version of pip_TimeInterval: all the intervals are sent in a single query (unnest of the interval list,
+        # joined to trips on t_pickup), i.e. one round trip and one plan instead of one per interval
+        # intervals: list of (start, end), e.g. ST_Workload.workload.intervalStrings()
+        # Returns timediff, (ods, numRows): ods[i] = list of (origin_zone, destination_zone) of intervals[i],
+        # numRows[i] = len(ods[i]); timediff is the total time of the batch
+        if(useCursor == True):
+            cur = self.conn.cursor("pip_cursor_" + uuid.uuid4().hex)
+        else:
+            cur = self.conn.cursor()
+
+        q_pip = "SELECT iv.n, z1.gid as origin_zone, z2.gid as destination_zone \n" \
+                "FROM unnest(%s::timestamp[], %s::timestamp[]) WITH ORDINALITY AS iv(t_start, t_end, n) \n" \
+                "JOIN trips t ON t.t_pickup >= iv.t_start and t.t_pickup < iv.t_end \n" \
+                "{} \n" \
+                "{}".format(self.zoneJoin("z1", "t.l_pickup"), self.zoneJoin("z2", "t.l_dropoff"))
+
+        start_time = datetime.datetime.now()
+        cur.execute(q_pip, ([str(interval[0]) for interval in intervals], [str(interval[1]) for interval in intervals]))
+
+        ods = [[] for interval in intervals]
+        for row in cur:
+            ods[row[0] - 1].append((row[1], row[2]))
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        cur.close()
+
+        return timediff, (ods, [len(od) for od in ods])
+
+    def pip_TimeInterval_stream(self, interval, batchSize=10000):
+        # Same as pip_TimeInterval, but the (origin, destination) rows are streamed in batches of batchSize
+        # Returns a queryStream: iterate over it, then see its firstRowLatency / timediff / numRows
+        return self.streamQuery(self.pipTimeIntervalQuery(interval), batchSize)
+
+    def pipTimeIntervalQuery(self, interval):
+        q_pip = "SELECT z1.gid as origin_zone, z2.gid as destination_zone \n" \
+                "FROM trips t \n" \
+                "{} \n" \
+                "{} \n" \
+                "WHERE t.t_pickup >= '{}' and t.t_pickup < '{}'".format(self.zoneJoin("z1", "t.l_pickup", "FULL"),
+                                                                        self.zoneJoin("z2", "t.l_dropoff", "FULL"),
+                                                                        interval[0], interval[1])
+
+        return q_pip
+
+    # --------------------------------------    Zones of the PIP queries
+
+    def buildSubdividedZones(self, maxVertices=64, tableName="zones_subdivided"):
+        # Splits the zone polygons (some have thousands of vertices) into pieces of at most maxVertices vertices
+        # with ST_Subdivide: the bounding boxes of the pieces are tight, hence the GiST index filters better and
+        # ST_Intersects tests a few vertices only. Switch the PIP queries to the pieces with useZones(tableName)
+        # Returns timediff, number of pieces
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        cur.execute("drop table if exists {}".format(tableName))
+        cur.execute("create table {} as "
+                    "select gid, ST_Subdivide(geom, {}) as geom "
+                    "from zones".format(tableName, int(maxVertices)))
+        numPieces = cur.rowcount
+        cur.execute("create index {0}_geom on {0} using gist (geom)".format(tableName))
+        cur.execute("create index {0}_gid on {0} (gid)".format(tableName))
+        self.conn.commit()
+        cur.execute("analyze {}".format(tableName))
+        self.conn.commit()
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, numPieces
+
+    def subdividedZones(self, tableName="zones_subdivided"):
+        # The pieces as GeoJSON features (properties.LocationID), e.g. for mongoDB.buildSubdividedZones
+        cur = self.conn.cursor()
+        cur.execute("select gid, ST_AsGeoJSON(geom) from {}".format(tableName))
+        features = [{"type": "Feature",
+                     "properties": {"LocationID": row[0]},
+                     "geometry": json.loads(row[1])} for row in cur.fetchall()]
+        cur.close()
+
+        return features
+
+    def useZones(self, tableName="zones"):
+        # The zones of the PIP queries (pip_tripID, pip_TimeInterval(s), journeyTimeSeries, odMatrix, addOD):
+        # "zones" (the TLC polygons) or the pieces of buildSubdividedZones
+        self.zoneTable = tableName
+
+    def zoneJoin(self, alias, point, joinType="LEFT"):
+        # Join of the zone (gid) of the point, e.g. zoneJoin("z1", "t.l_pickup"): a single zone per point.
+        # Some TLC zones share their geometry (e.g. LocationIDs 56/57, 103/104/105), and a point on a border of
+        # two zones - or on a cut of the subdivided zones - intersects several polygons: a plain join would repeat
+        # the trip. LIMIT 1 keeps one, ORDER BY gid the same one (the lowest gid) on every run.
+        # The pieces of a subdivided zone share their cuts: a point on a cut is in the interior of the zone
+        # but not contained by any piece, hence ST_Intersects (see zoneCondition)
+        # FULL JOIN LATERAL is not allowed; the PIP queries filter the trips, i.e. FULL is LEFT anyway
+        joinType = "LEFT" if joinType == "FULL" else joinType
+        return "{} JOIN LATERAL (SELECT zs.gid FROM {} zs WHERE {} ORDER BY zs.gid LIMIT 1) {} ON true" \
+               .format(joinType, self.zoneTable, self.zoneCondition("zs", point), alias).strip()
+
+    def zoneCondition(self, alias, point):
+        # Condition of a zone table aliased as 'alias' containing the point (see zoneJoin)
+        if self.zoneTable == "zones":
+            return "ST_Contains({}.geom, {})".format(alias, point)
+        return "ST_Intersects({}.geom, {})".format(alias, point)
+
     def pickup_pos(self,id):
         cur = self.conn.cursor()
         query = "SELECT l_pickup_lat,l_pickup_lon " \
@@ -1258,6 +2455,7 @@ class postgres():
 
 
     # --------------------------------------    UPDATE Queries
+    @invalidatesCache
     def addAttribute(self, attrName, type):
         # We can add a new attribute denoting the errors
 
@@ -1280,6 +2478,7 @@ class postgres():
 
         return timediff
 
+    @invalidatesCache
     def removeAttribute(self, attrName):
         cur = self.conn.cursor()
 
@@ -1301,55 +2500,359 @@ class postgres():
 
         return timediff
 
-    def addOD(self):
+    @invalidatesCache
+    def addOD(self, mode="chunked", chunkSize=1000000, numWorkers=4, throttle=0):
+        # Adds the origin/dropoff zone of each trip (origin_zone, dropoff_zone)
+        # mode: "chunked" -> parallel updates of id ranges (see chunkedUpdate)
+        #       "rewrite" -> the table is rewritten with the new attributes (see rewriteUpdate)
+        #       "single"  -> a single table wide UPDATE in one transaction
         start_time = datetime.datetime.now()
-        cur = self.conn.cursor()
 
-        t_addAttribute_originZone = self.addAttribute("origin_zone", "smallint")
-        t_addAttribute_dropoffZone = self.addAttribute("dropoff_zone", "smallint")
+        if mode == "rewrite":
+            # Existing origin_zone/dropoff_zone attributes are replaced by the rewrite
+            self.rewriteUpdate({"origin_zone": ("z1.gid", "smallint"),
+                                "dropoff_zone": ("z2.gid", "smallint")},
+                               self.zoneJoin("z1", "t.l_pickup") + " " + self.zoneJoin("z2", "t.l_dropoff"))
+        else:
+            t_addAttribute_originZone = self.addAttribute("origin_zone", "smallint")
+            t_addAttribute_dropoffZone = self.addAttribute("dropoff_zone", "smallint")
 
-        query = "UPDATE trips t "\
-                "SET origin_zone = z1.gid, dropoff_zone = z2.gid "\
-                "FROM zones z1, zones z2  "\
-                "WHERE ST_CONTAINS(z1.geom, t.l_pickup) and ST_Contains(z2.geom, t.l_dropoff) and t.id<5"
+            self.chunkedUpdate("origin_zone = z1.gid, dropoff_zone = z2.gid",
+                               "{} and {}".format(self.zoneCondition("z1", "t.l_pickup"), self.zoneCondition("z2", "t.l_dropoff")),
+                               fromClause="{0} z1, {0} z2".format(self.zoneTable),
+                               chunkSize=chunkSize, numWorkers=numWorkers if mode == "chunked" else None,
+                               throttle=throttle)
 
-        #t.id = 15623881 or t.id = 15623973 or t.id = 15624015
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
 
-        # Somehow the update commit is NOT WORKING!
+        return timediff
 
+    @invalidatesCache
+    def addErrorTypes(self, attrName=None, mode="chunked", chunkSize=1000000, numWorkers=4, throttle=0):
+        # Flags the trips whose pickup and dropoff coordinates are the same: the sameStartEndLocation bit of
+        # error_flags (see setErrorFlag) - as update_sameStartEndLocation of mongoDB. No per-flag attribute is
+        # created anymore: attrName is ignored, kept for the former callers
+        # mode: "chunked" (numWorkers concurrent id ranges) or anything else: a single UPDATE (see chunkedUpdate)
+        # Returns timediff, number of flagged trips
+        start_time = datetime.datetime.now()
 
-        cur.execute(query)
+        self.addErrorFlags()
+        t, n = self.setErrorFlag("sameStartEndLocation", chunkSize=chunkSize,
+                                 numWorkers=numWorkers if mode == "chunked" else None, throttle=throttle)
 
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, n
+
+    # --------------------------------------    Error flags
+    # The data quality flags are stored as bits of a single smallint attribute: error_flags (see ERROR_FLAGS)
+    # A new rule only needs a new bit - no new attribute (i.e. no table wide ALTER)
+
+    @invalidatesCache
+    def addDuration(self):
+        # Journey time in SECONDS as a stored generated column (computed by Postgres on every insert/update)
+        # with a B-tree index: numLongTrips, the longTrips flag and journeyTimeSeries then use it
+        # Note: adding a stored column rewrites the table (once)
+        start_time = datetime.datetime.now()
+
+        cur = self.conn.cursor()
+        cur.execute("alter table trips add column if not exists duration_s integer "
+                    "generated always as ({}) stored".format(DURATION_SQL))
+        cur.execute("create index if not exists trips_duration_s on trips (duration_s)")
         self.conn.commit()
+        cur.execute("analyze trips")
+        self.conn.commit()
+        cur.close()
+        self.durationColumn = True
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
+
+        return timediff
+
+    def hasDuration(self):
+        # Does the trips table have the duration_s column? (checked once)
+        if getattr(self, "durationColumn", None) is None:
+            cur = self.conn.cursor()
+            cur.execute("select 1 from information_schema.columns "
+                        "where table_name = 'trips' and column_name = 'duration_s'")
+            self.durationColumn = cur.fetchone() is not None
+            cur.close()
+        return self.durationColumn
+
+    @invalidatesCache
+    def addErrorFlags(self):
+        # Adds the error_flags attribute and a partial index for each bit
+        start_time = datetime.datetime.now()
+
+        self.addAttribute("error_flags", "smallint NOT NULL DEFAULT 0")
+
+        cur = self.conn.cursor()
+        for ruleName, bit in ERROR_FLAGS.items():
+            cur.execute("create index if not exists trips_flag_{} on trips (id) "
+                        "where error_flags & {} <> 0".format(ruleName.lower(), bit))
+        self.conn.commit()
         cur.close()
 
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
         return timediff
 
-    def addErrorTypes(self, attrName):
+    @invalidatesCache
+    def setErrorFlag(self, ruleName, x=None, condition=None, chunkSize=1000000, numWorkers=4, throttle=0):
+        # Sets the bit of the rule (see ERROR_FLAGS) of the trips satisfying the condition
+        # condition: default: the rule's condition (see qualityCondition_Postgres) with the parameter x
+        # e.g. P.setErrorFlag("totalPrice_LTE2X", 0)
+        # Returns timediff, number of flagged trips (see chunkedUpdate)
+        bit = errorFlagBit(ruleName)
+        if condition is None:
+            condition = qualityCondition_Postgres(ruleName, x, "t", self.hasDuration())
+
+        return self.chunkedUpdate("error_flags = error_flags | {}".format(bit),
+                                  "t.error_flags & {} = 0 AND ({})".format(bit, condition),
+                                  chunkSize=chunkSize, numWorkers=numWorkers, throttle=throttle)
+
+    @invalidatesCache
+    def clearErrorFlag(self, ruleName, chunkSize=1000000, numWorkers=4, throttle=0):
+        bit = errorFlagBit(ruleName)
+
+        return self.chunkedUpdate("error_flags = error_flags & ~{}".format(bit),
+                                  "t.error_flags & {} <> 0".format(bit),
+                                  chunkSize=chunkSize, numWorkers=numWorkers, throttle=throttle)
+
+    def countErrorFlag(self, ruleName):
+        # How many trips are flagged by the rule? (uses the partial index of the bit)
+        cur = self.conn.cursor()
+
+        query = "select count(*) " \
+                "from trips " \
+                "where error_flags & {} <> 0".format(errorFlagBit(ruleName))
+
+        start_time = datetime.datetime.now()
+        cur.execute(query)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        result = cur.fetchone()[0]
+        cur.close()
+        return timediff, result
+
+    def countPerFlag(self):
+        # Number of flagged trips of each rule, in a single pass over the flagged trips
+        # Returns timediff, {ruleName: count}
         cur = self.conn.cursor()
-        self.removeAttribute(attrName)
-        self.addAttribute(attrName, "character")
 
-        # Find all the trips whose pickup and dropoff coordinates are the same:
-        query = "update trips t " \
-                "set {} = 1" \
-                "where l_pickup = l_dropoff".format(attrName)
+        counts = ["count(*) filter (where error_flags & {} <> 0)".format(bit) for bit in ERROR_FLAGS.values()]
+        query = "select {} " \
+                "from trips " \
+                "where error_flags <> 0".format(", ".join(counts))
 
-        # Record the execution time of the query
         start_time = datetime.datetime.now()
         cur.execute(query)
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
 
+        result = dict(zip(ERROR_FLAGS.keys(), cur.fetchone()))
+        cur.close()
+        return timediff, result
+
+    # --------------------------------------    Update engine for the table wide updates
+
+    @invalidatesCache
+    def chunkedUpdate(self, setClause, condition, fromClause="", chunkSize=1000000, numWorkers=4, throttle=0, tableName="trips"):
+        # UPDATE <tableName> t SET <setClause> [FROM <fromClause>] WHERE <condition>
+        # split by id ranges of chunkSize. Each range is committed on its own, hence the locks are kept shortly
+        # and a failure only rolls back the current range.
+        # setClause: e.g. "origin_zone = z1.gid"
+        # condition: e.g. "t.l_pickup = t.l_dropoff" (the updated table is aliased as t)
+        # numWorkers: number of ranges updated concurrently on pooled connections
+        #             (None: a single UPDATE of the whole table in one transaction)
+        # throttle: SECONDS each worker sleeps after a range, to leave I/O to the other sessions
+        # Returns timediff, number of updated rows
+        if fromClause:
+            fromClause = "FROM {} ".format(fromClause)
+
+        start_time = datetime.datetime.now()
+
+        if numWorkers is None:
+            cur = self.conn.cursor()
+            cur.execute("UPDATE {} t SET {} {}WHERE {}".format(tableName, setClause, fromClause, condition))
+            numUpdated = cur.rowcount
+            self.conn.commit()
+            cur.close()
+        else:
+            query = "UPDATE {} t SET {} {}" \
+                    "WHERE t.id >= %s AND t.id < %s AND ({})".format(tableName, setClause, fromClause, condition)
+
+            t, result = self.findMinMax_Interval(tableName, "id")
+            minID, maxID = result[0]
+            if minID is None:
+                # Empty table
+                return (datetime.datetime.now() - start_time).total_seconds(), 0
+            ranges = [(lo, lo + chunkSize) for lo in range(minID, maxID + 1, chunkSize)]
+
+            pool = self.connectionPool(numWorkers)
+
+            def updateRange(idRange):
+                conn = pool.getconn()
+                try:
+                    cur = conn.cursor()
+                    cur.execute(query, idRange)
+                    n = cur.rowcount
+                    conn.commit()
+                    cur.close()
+                except:
+                    conn.rollback()
+                    raise
+                finally:
+                    pool.putconn(conn)
+                if throttle:
+                    time.sleep(throttle)
+                return n
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                numUpdated = sum(executor.map(updateRange, ranges))
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        return timediff, numUpdated
+
+    @invalidatesCache
+    def rewriteUpdate(self, columns, joinClause="", tableName="trips"):
+        # Instead of updating (most of) the rows, the table is rewritten with CREATE TABLE AS and swapped
+        # Cheaper when most of the rows change: no dead tuples and no WAL for each updated row
+        # columns: {attrName: (SQL expression, type)} e.g. {"origin_zone": ("z1.gid", "smallint")}
+        # joinClause: e.g. "LEFT JOIN zones z1 ON ST_Contains(z1.geom, t.l_pickup)" (the table is aliased as t)
+        # The indexes (and the primary key) are re-created; other constraints, defaults and grants are NOT.
+        # Readers of the table are not blocked while the new table and its indexes are built (writers are:
+        # their rows would be lost), only by the final drop / rename.
+        # Returns the number of rows of the new table
+        cur = self.conn.cursor()
+        newTable = tableName + "_rewrite"
+
+        cur.execute("lock table {} in share mode".format(tableName))
+        cur.execute("select column_name, is_generated, generation_expression, data_type from information_schema.columns "
+                    "where table_schema = current_schema() and table_name = %s order by ordinal_position", (tableName,))
+        tableColumns = cur.fetchall()
+        # Generated columns (e.g. duration_s) are not copied but added again to the new table
+        keep = ["t.\"{}\"".format(row[0]) for row in tableColumns if row[0] not in columns and row[1] != "ALWAYS"]
+        generated = [row for row in tableColumns if row[1] == "ALWAYS"]
+        new = ["({})::{} as \"{}\"".format(expr, type, name) for name, (expr, type) in columns.items()]
+
+        cur.execute("drop table if exists {}".format(newTable))
+        cur.execute("create table {} as select {} from {} t {}".format(newTable, ", ".join(keep + new), tableName, joinClause))
+        numRows = cur.rowcount
+        for name, isGenerated, expression, dataType in generated:
+            cur.execute("alter table {} add column \"{}\" {} generated always as ({}) stored".format(newTable, name, dataType, expression))
+
+        # Indexes of the old table, built on the new table under a temporary name (renamed after the swap)
+        cur.execute("select i.indexdef, x.indisprimary, i.indexname "
+                    "from pg_indexes i "
+                    "join pg_class c on c.relname = i.indexname and c.relnamespace = i.schemaname::regnamespace "
+                    "join pg_index x on x.indexrelid = c.oid "
+                    "where i.schemaname = current_schema() and i.tablename = %s", (tableName,))
+        indexes = cur.fetchall()
+        for indexdef, isPrimary, indexName in indexes:
+            cur.execute(rewriteIndexDef(indexdef, indexName + "_rewrite", newTable))
+            if isPrimary:
+                cur.execute("alter table {} add constraint \"{}_rewrite\" primary key using index \"{}_rewrite\"".format(newTable, indexName, indexName))
+
+        # Swap: readers are blocked (ACCESS EXCLUSIVE) only from here to the commit
+        cur.execute("drop table {}".format(tableName))
+        cur.execute("alter table {} rename to {}".format(newTable, tableName))
+        for indexdef, isPrimary, indexName in indexes:
+            # Renames the primary key constraint as well
+            cur.execute("alter index \"{}_rewrite\" rename to \"{}\"".format(indexName, indexName))
+        self.conn.commit()
+
+        cur.execute("analyze {}".format(tableName))
+        self.conn.commit()
+        cur.close()
+
+        return numRows
+
+    def reconnect(self):
+        # New connection with the same parameters, e.g. after a restart of the server (see ST_Benchmark.cacheState)
+        try:
+            self._conn.close()
+        except:
+            pass
+        self._connecting = None
+        self.conn = psycopg2.connect(**self.connParams)
+        pool = getattr(self, "pool", None)
+        if pool is not None:
+            pool.closeall()
+            self.pool = None
+
+    # --------------------------------------    Cache state (see ST_Benchmark.cacheState)
+
+    def prewarm(self, tableName="trips", indexes=True):
+        # Loads the table (and its indexes) into shared buffers with pg_prewarm
+        # Returns timediff, number of blocks loaded
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        cur.execute("create extension if not exists pg_prewarm")
+        cur.execute("select pg_prewarm('{}')".format(tableName))
+        numBlocks = cur.fetchone()[0]
+        if indexes:
+            cur.execute("select coalesce(sum(pg_prewarm(indexrelid::regclass)), 0) "
+                        "from pg_index where indrelid = '{}'::regclass".format(tableName))
+            numBlocks += cur.fetchone()[0]
+        self.conn.commit()
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, numBlocks
 
+    def cacheStats(self, flushDelay=1.0):
+        # Buffer hits / reads of the database: the difference of two calls shows the reads outside of shared buffers
+        # The backends report their counters to pg_stat_database with a delay (at most about 1 second, or when
+        # idle): the pending counters of this connection are flushed (pg_stat_force_next_flush, Postgres >= 15),
+        # and the other backends (e.g. the pooled connections) are given flushDelay SECONDS before the counters
+        # are read; otherwise the reads of the benchmark run itself could be missed (see ST_Benchmark.cacheState)
+        cur = self.conn.cursor()
+        if self.conn.server_version >= 150000:
+            cur.execute("select pg_stat_force_next_flush()")
+            # The flush happens at the end of the transaction
+            self.conn.commit()
+        if flushDelay:
+            cur.execute("select pg_sleep(%s)", (flushDelay,))
+            self.conn.commit()
+        # The statistics of a transaction are a snapshot: read fresh ones
+        cur.execute("select pg_stat_clear_snapshot()")
+        cur.execute("select blks_hit, blks_read from pg_stat_database where datname = current_database()")
+        row = cur.fetchone()
         self.conn.commit()
+        cur.close()
 
+        return {"blocksHit": row[0], "blocksRead": row[1]}
+
+    def resetStats(self):
+        # Resets the statistics counters of the database (the buffers are NOT dropped, see ST_Benchmark.cacheState)
+        cur = self.conn.cursor()
+        cur.execute("select pg_stat_reset()")
+        self.conn.commit()
         cur.close()
 
+    def connectionPool(self, numConnections):
+        # Pool of connections (same parameters as self.conn) used by the parallel methods
+        pool = getattr(self, "pool", None)
+        if pool is None or pool.maxconn < numConnections:
+            if pool is not None:
+                pool.closeall()
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, numConnections, **self.connParams)
+
+        return self.pool
 
+
+    @invalidatesCache
     def extractDay(self, day):
         # E.g.: P.extractDay('2015_08_22')
         # Do not forget the underscore
@@ -1404,8 +2907,9 @@ class postgres():
                 "total real," \
                 "l_pickup geometry(Point,4326)," \
                 "l_dropoff geometry(Point,4326), " \
+                "duration_s integer GENERATED ALWAYS AS ({}) STORED, " \
                 "CONSTRAINT {} PRIMARY KEY (id)" \
-                ")".format(tableName, pkString)
+                ")".format(tableName, DURATION_SQL, pkString)
 
         cur.execute(query)
 
@@ -1416,10 +2920,12 @@ class postgres():
         day2 = datetime.datetime.strptime(day, '%Y_%m_%d') + datetime.timedelta(days=1)
         #print("Next day: ", str(day2))
 
-        query = "insert into {}(id, vendorid, t_pickup, t_dropoff, num_passengers, trip_distance, l_pickup_lon, l_pickup_lat, ratecodeid, flag_store, l_dropoff_lon, l_dropoff_lat, payment_type, fare_amount, extra, mta_tax, surcharge, tip, tolls, total, l_pickup, l_dropoff) " \
-                "select * " \
+        # The columns are listed: trips could have further columns (error_flags, duration_s, OD zones, ...)
+        columns = "id, vendorid, t_pickup, t_dropoff, num_passengers, trip_distance, l_pickup_lon, l_pickup_lat, ratecodeid, flag_store, l_dropoff_lon, l_dropoff_lat, payment_type, fare_amount, extra, mta_tax, surcharge, tip, tolls, total, l_pickup, l_dropoff"
+        query = "insert into {}({}) " \
+                "select {} " \
                 "from trips " \
-                "where t_pickup >= '{}' and t_pickup < '{}'".format(tableName, day, day2)
+                "where t_pickup >= '{}' and t_pickup < '{}'".format(tableName, columns, columns, day, day2)
 
         print(query)
 
@@ -1457,54 +2963,556 @@ class postgres():
         cur.close()
 
 
+    @cachedQuery
     def journeyTimeSeries(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend):
         # This function would generate the time series of journey times for the given OD
         # at a given time interval e.g. timeInterval[0] = 9, timeInterval[1] = 10
         # for the analysis interval: datetime object (e.g. [datetime.date(2015,1,1), datetime.date(2015,1,31)])
         # If we are only interested in weekends, than weekend= True, otherwise False
+        # Returns timediff, [(id, journey time as datetime.timedelta)]
         start_time = datetime.datetime.now()
         cur = self.conn.cursor()
 
+        query = self.journeyTimeSeriesQuery(od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend)
+
+        print(query)
+
+        cur.execute(query)
+
+        results = cur.fetchall()
+
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, results
+
+    def journeyTimeSeries_stream(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend, batchSize=10000):
+        # Same as journeyTimeSeries, but the (id, journey time) rows are streamed in batches of batchSize
+        # Returns a queryStream: iterate over it, then see its firstRowLatency / timediff / numRows
+        query = self.journeyTimeSeriesQuery(od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend)
 
+        return self.streamQuery(query, batchSize)
+
+    def journeyTimeSeriesQuery(self, od, analysisInterval, timeInterval_Hour, timeInterval_Min, weekend):
+        # The journey time is an interval (timedelta) as before addDuration (see ST_Backend for the seconds);
+        # read from duration_s if available (see addDuration)
+        if self.hasDuration():
+            journeyTime = "make_interval(secs => duration_s)"
+        else:
+            journeyTime = "make_interval(secs => {})".format(DURATION_SQL)
+        zoneJoin1 = self.zoneJoin("z1", "l_pickup", "FULL")
+        zoneJoin2 = self.zoneJoin("z2", "l_dropoff", "FULL")
         if(weekend):
-            query = "SELECT id, (t_dropoff-t_pickup) \n" \
+            query = "SELECT id, {} \n" \
                     "FROM trips \n"\
-                    "FULL JOIN zones z1 on st_contains(z1.geom, l_pickup) \n" \
-                    "FULL JOIN zones z2 on st_contains(z2.geom, l_dropoff) \n" \
+                    "{} \n" \
+                    "{} \n" \
                     "WHERE t_pickup >= '{}' and t_pickup < '{}' \n" \
                     "AND (extract(hour from t_pickup) between {} and {}) \n" \
                     "AND (extract (minute from t_pickup) between {} and {}) \n" \
                     "AND z1.gid = {} and z2.gid = {} \n" \
-                    "AND EXTRACT(DOW FROM t_pickup) in (0,6)".format(analysisInterval[0], analysisInterval[1], timeInterval_Hour[0], timeInterval_Hour[1], timeInterval_Min[0], timeInterval_Min[1], od[0], od[1])
+                    "AND EXTRACT(DOW FROM t_pickup) in (0,6)".format(journeyTime, zoneJoin1, zoneJoin2, analysisInterval[0], analysisInterval[1], timeInterval_Hour[0], timeInterval_Hour[1], timeInterval_Min[0], timeInterval_Min[1], od[0], od[1])
         else:
-            query = "SELECT id, (t_dropoff-t_pickup) \n" \
+            query = "SELECT id, {} \n" \
                     "FROM trips \n" \
-                    "FULL JOIN zones z1 on st_contains(z1.geom, l_pickup) \n" \
-                    "FULL JOIN zones z2 on st_contains(z2.geom, l_dropoff) \n" \
+                    "{} \n" \
+                    "{} \n" \
                     "WHERE t_pickup >= '{}' and t_pickup < '{}' \n" \
                     "AND (extract(hour from t_pickup) between {} and {}) \n" \
                     "AND (extract (minute from t_pickup) between {} and {}) \n" \
                     "AND z1.gid = {} and z2.gid = {} \n" \
-                    "AND EXTRACT(DOW FROM t_pickup) in (1, 2, 3, 4, 5)".format(analysisInterval[0], analysisInterval[1],
+                    "AND EXTRACT(DOW FROM t_pickup) in (1, 2, 3, 4, 5)".format(journeyTime, zoneJoin1, zoneJoin2, analysisInterval[0], analysisInterval[1],
                                                                      timeInterval_Hour[0], timeInterval_Hour[1],
                                                                      timeInterval_Min[0], timeInterval_Min[1], od[0],
                                                                      od[1])
 
+        return query
 
-        print(query)
+    # --------------------------------------    Binary export to NumPy
+
+    def copyColumns(self, columns, tableName="trips", condition=None):
+        # Loads the columns of the table into NumPy arrays through COPY ... TO STDOUT (FORMAT binary):
+        # no Python object is created per row (fetchall), the rows are decoded with np.frombuffer
+        # columns: list of fixed width columns (double, real, smallint, integer, bigint, boolean, date, timestamp)
+        # condition: optional WHERE condition, e.g. "id > 0 and id <= 1000000"
+        # E.g.: t, arrays = P.copyColumns(["l_pickup_lon", "l_pickup_lat"], "day_2015_05_23")
+        # Returns timediff, {column: array}; timestamps as datetime64[us]; NULLs as NaN / NaT (see decodeBinaryCopy)
+        cur = self.conn.cursor()
+
+        query = "SELECT {} FROM {}".format(", ".join(columns), tableName)
+        if condition:
+            query += " WHERE {}".format(condition)
+
+        start_time = datetime.datetime.now()
+
+        # Types of the columns
+        cur.execute(query + " LIMIT 0")
+        typeOIDs = [column[1] for column in cur.description]
+
+        buffer = io.BytesIO()
+        cur.copy_expert("COPY ({}) TO STDOUT (FORMAT binary)".format(query), buffer)
+        arrays = decodeBinaryCopy(buffer.getbuffer(), typeOIDs)
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        self.conn.commit()
+        cur.close()
+
+        return timediff, dict(zip(columns, arrays))
+
+    # --------------------------------------    Range queries
+
+    def rangeQuery(self, bbox, interval, columns="id, t_pickup, l_pickup_lon, l_pickup_lat", batchSize=10000):
+        # Streams the trips picked up within the bounding box and the time interval
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        # interval: e.g. ('2015-01-01 10:00:00', '2015-01-01 12:00:00')
+        query = "SELECT {} \n" \
+                "FROM trips \n" \
+                "WHERE {}".format(columns, rangeCondition_Postgres(bbox, interval))
+
+        return self.streamQuery(query, batchSize)
+
+    def rangeCount(self, bbox, interval, approximate=False, exactBelow=1000000):
+        # How many trips are picked up within the bounding box and the time interval?
+        # approximate: False -> exact count
+        #              True -> grid aggregate (if built, see buildGridAggregate), otherwise the planner estimate
+        #              "auto" -> exact count if the planner estimate is below exactBelow
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        condition = rangeCondition_Postgres(bbox, interval)
+        if approximate == "auto":
+            result = self.plannerEstimate("SELECT 1 FROM trips WHERE {}".format(condition))
+        elif approximate:
+            cur.execute("select to_regclass('grid_agg')")
+            if cur.fetchone()[0] is not None:
+                t, (res, rows) = self.gridHeatmap(bbox, interval, maxCells=float("inf"))
+                result = sum(row[2] for row in rows)
+            else:
+                result = self.plannerEstimate("SELECT 1 FROM trips WHERE {}".format(condition))
+
+        if not approximate or (approximate == "auto" and result < exactBelow):
+            cur.execute("SELECT count(*) FROM trips WHERE {}".format(condition))
+            result = cur.fetchone()[0]
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, result
+
+    def plannerEstimate(self, query):
+        # Number of rows the planner expects the query to return (no execution)
+        cur = self.conn.cursor()
+        cur.execute("EXPLAIN (FORMAT JSON) " + query)
+        plan = cur.fetchone()[0]
+        cur.close()
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def streamQuery(self, query, batchSize=10000):
+        # The rows are fetched in batches of batchSize through a server side (named) cursor - see queryStream
+        return queryStream(self.conn, query, batchSize)
+
+    # --------------------------------------    OD matrix
+
+    def odMatrix(self, interval, durationStats=False, parallelWorkers=4):
+        # Origin x destination trip counts of all the trips picked up within the interval (e.g. see dayInterval)
+        # computed in a single set based query (instead of calling pip_TimeInterval for many small intervals)
+        # parallelWorkers: max_parallel_workers_per_gather for this query
+        # Returns timediff, counts: NUM_ZONES x NUM_ZONES array; counts[o - 1, d - 1] = number of trips from o to d
+        # If durationStats: timediff, (counts, {"mean", "min", "max"} arrays of the journey times in SECONDS)
+        cur = self.conn.cursor()
+
+        durationColumns = ""
+        if durationStats:
+            durationColumns = ", avg(extract(epoch from t.t_dropoff - t.t_pickup)), " \
+                              "min(extract(epoch from t.t_dropoff - t.t_pickup)), " \
+                              "max(extract(epoch from t.t_dropoff - t.t_pickup))"
+
+        query = "SELECT z1.gid, z2.gid, count(*){} \n" \
+                "FROM trips t \n" \
+                "{} \n" \
+                "{} \n" \
+                "WHERE t.t_pickup >= '{}' and t.t_pickup < '{}' \n" \
+                "GROUP BY z1.gid, z2.gid".format(durationColumns, self.zoneJoin("z1", "t.l_pickup", ""),
+                                                 self.zoneJoin("z2", "t.l_dropoff", ""), interval[0], interval[1])
 
+        start_time = datetime.datetime.now()
+        # SET LOCAL: only for the current transaction
+        cur.execute("SET LOCAL max_parallel_workers_per_gather = {}".format(int(parallelWorkers)))
         cur.execute(query)
+        rows = cur.fetchall()
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
 
-        results = cur.fetchall()
+        self.conn.commit()
+        cur.close()
+
+        counts = np.zeros((NUM_ZONES, NUM_ZONES), dtype=np.int64)
+        if durationStats:
+            durations = {"mean": np.full((NUM_ZONES, NUM_ZONES), np.nan),
+                         "min": np.full((NUM_ZONES, NUM_ZONES), np.nan),
+                         "max": np.full((NUM_ZONES, NUM_ZONES), np.nan)}
+
+        for row in rows:
+            counts[row[0] - 1, row[1] - 1] = row[2]
+            if durationStats:
+                durations["mean"][row[0] - 1, row[1] - 1] = row[3]
+                durations["min"][row[0] - 1, row[1] - 1] = row[4]
+                durations["max"][row[0] - 1, row[1] - 1] = row[5]
+
+        if durationStats:
+            return timediff, (counts, durations)
+
+        return timediff, counts
+
+    # --------------------------------------    Zone x hour rollups
+
+    @invalidatesCache
+    def buildZoneHourCounts(self, numWorkers=4, timeout=60):
+        # Builds zone_hour_counts (zone, hour, pickups, dropoffs) from scratch: the days are aggregated in parallel
+        # on pooled connections. The dropoffs are counted in their dropoff hour, hence two days could add to the same
+        # (zone, hour): the rows are upserted (see rollupZoneHours).
+        # The max id of the trips is kept as the watermark of updateZoneHourCounts (zone_hour_counts_meta).
+        # The ids are not assigned in commit order: the build first waits (at most timeout SECONDS) for the
+        # transactions writing at that time, otherwise the trips of them below the watermark would never be counted.
+        # Stall: the writers of this database (any table, see captureWatermark) are waited for; a long running
+        # one raises RuntimeError after timeout - retry when it has finished
+        # Returns timediff
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        cur.execute("drop table if exists zone_hour_counts")
+        cur.execute("drop table if exists zone_hour_counts_meta")
+        cur.execute("create table zone_hour_counts ( "
+                    "zone smallint, "
+                    "hour timestamp, "
+                    "pickups integer NOT NULL DEFAULT 0, "
+                    "dropoffs integer NOT NULL DEFAULT 0, "
+                    "primary key (zone, hour))")
+        cur.execute("create index zone_hour_counts_hour on zone_hour_counts (hour)")
+        cur.execute("create table zone_hour_counts_meta (watermark bigint, pending_id bigint, pending_xids bigint[])")
+        self.conn.commit()
 
+        watermark, xids = self.captureWatermark(cur, 0)
+        self.waitForTransactions(cur, xids, timeout)
+        cur.execute("select min(t_pickup)::date, max(t_pickup)::date from trips where id <= %s", (watermark or 0,))
+        first, last = cur.fetchone()
+        cur.execute("insert into zone_hour_counts_meta values (%s, null, null)", (watermark or 0,))
+        self.conn.commit()
+
+        if watermark is not None:
+            days = [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+            pool = self.connectionPool(numWorkers)
+
+            def rollupDay(day):
+                interval = dayInterval(day)
+                conn = pool.getconn()
+                try:
+                    c = conn.cursor()
+                    self.rollupZoneHours(c, "t.t_pickup >= '{}' and t.t_pickup < '{}' and t.id <= {}".format(interval[0], interval[1], watermark))
+                    conn.commit()
+                    c.close()
+                except:
+                    conn.rollback()
+                    raise
+                finally:
+                    pool.putconn(conn)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                list(executor.map(rollupDay, days))
+
+        cur.execute("analyze zone_hour_counts")
+        self.conn.commit()
 
         finish_time = datetime.datetime.now()
         timediff = (finish_time - start_time).total_seconds()
         cur.close()
 
-        return timediff, results
+        return timediff
+
+    @invalidatesCache
+    def updateZoneHourCounts(self):
+        # Adds the trips inserted since the last build/update (id above the watermark) to zone_hour_counts,
+        # in the same transaction as the new watermark
+        # The ids are not assigned in commit order (a transaction with lower ids could commit later): the max id
+        # is first recorded as pending, with the transactions writing at that time (pending_xids). The ids up to
+        # it are counted once all of these have finished - by this call if there are none, otherwise by a later one.
+        # Not covered: ids taken with nextval by a transaction that writes them only after the capture
+        # Stall: only the writers of this database are waited for (see captureWatermark), but of any table - while a
+        # long running transaction that has written in this database is open, the new trips stay pending
+        # (the watermark does not move; the call returns quickly)
+        # Returns timediff, new watermark
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        # The meta row is locked: concurrent updates do not count the same trips twice
+        cur.execute("select watermark, pending_id, pending_xids from zone_hour_counts_meta for update")
+        watermark, pendingID, pendingXids = cur.fetchone()
+        if pendingID is None:
+            pendingID, pendingXids = self.captureWatermark(cur, watermark)
+        if pendingID is not None and not self.runningTransactions(cur, pendingXids):
+            self.rollupZoneHours(cur, "t.id > {} and t.id <= {}".format(watermark, pendingID))
+            watermark = pendingID
+            pendingID, pendingXids = None, None
+        cur.execute("update zone_hour_counts_meta set watermark = %s, pending_id = %s, pending_xids = %s",
+                    (watermark, pendingID, pendingXids))
+        self.conn.commit()
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, watermark
+
+    def captureWatermark(self, cur, watermark):
+        # Max id above the watermark and the (writing) transactions in progress, read from the same snapshot
+        # The snapshot lists the writers of the whole cluster: the ones of the other databases (sessions and
+        # prepared transactions) are left out. The xids of pg_stat_activity are 32 bit: compared modulo 2^32
+        # Returns max id (None: no new trip), [xid]
+        cur.execute("select (select max(id) from trips where id > %s), "
+                    "array(select x from txid_snapshot_xip(txid_current_snapshot()) x "
+                    "      where x % 4294967296 not in ("
+                    "          select backend_xid::text::bigint from pg_stat_activity "
+                    "          where backend_xid is not null and datname <> current_database() "
+                    "          union all "
+                    "          select transaction::text::bigint from pg_prepared_xacts "
+                    "          where database <> current_database()))", (watermark,))
+        maxID, xids = cur.fetchone()
+        return maxID, xids
+
+    def runningTransactions(self, cur, xids):
+        # The transactions of xids still in progress (txid_status, Postgres >= 10)
+        if not xids:
+            return []
+        cur.execute("select x from unnest(%s::bigint[]) x where txid_status(x) = 'in progress'", (list(xids),))
+        return [row[0] for row in cur.fetchall()]
+
+    def waitForTransactions(self, cur, xids, timeout):
+        # Waits until the transactions xids have finished (polled every 0.1 SECONDS)
+        deadline = time.time() + timeout
+        while True:
+            running = self.runningTransactions(cur, xids)
+            self.conn.commit()
+            if not running:
+                return
+            if time.time() > deadline:
+                raise RuntimeError("Transactions still in progress after {} seconds: {}".format(timeout, running))
+            time.sleep(0.1)
+
+    def rollupZoneHours(self, cur, condition):
+        # Adds the pickups/dropoffs per (zone, hour) of the trips satisfying the condition (trips aliased as t)
+        # The rows are upserted in (zone, hour) order: concurrent upserts lock the rows in the same order
+        query = "INSERT INTO zone_hour_counts (zone, hour, pickups, dropoffs) \n" \
+                "SELECT zone, hour, sum(p), sum(d) FROM ( \n" \
+                "    SELECT z1.gid AS zone, date_trunc('hour', t.t_pickup) AS hour, 1 AS p, 0 AS d \n" \
+                "    FROM trips t {} \n" \
+                "    WHERE {} \n" \
+                "    UNION ALL \n" \
+                "    SELECT z2.gid, date_trunc('hour', t.t_dropoff), 0, 1 \n" \
+                "    FROM trips t {} \n" \
+                "    WHERE {} \n" \
+                ") x \n" \
+                "GROUP BY zone, hour \n" \
+                "ORDER BY zone, hour \n" \
+                "ON CONFLICT (zone, hour) DO UPDATE SET pickups = zone_hour_counts.pickups + excluded.pickups, " \
+                "dropoffs = zone_hour_counts.dropoffs + excluded.dropoffs".format(self.zoneJoin("z1", "t.l_pickup", ""), condition,
+                                                                                  self.zoneJoin("z2", "t.l_dropoff", ""), condition)
+        cur.execute(query)
+
+    def zoneHourMatrix(self, start, end, kind="pickups"):
+        # Dense zones x hours matrix of zone_hour_counts for the days start..end (datetime.date, both inclusive)
+        # kind: "pickups" or "dropoffs"
+        # Returns timediff, (hours: datetime64[h] array, counts: NUM_ZONES x len(hours) array; counts[zone - 1, i])
+        if kind not in ("pickups", "dropoffs"):
+            raise ValueError("Unknown kind: {} (pickups or dropoffs)".format(kind))
+
+        cur = self.conn.cursor()
+        query = "SELECT zone, hour, {} \n" \
+                "FROM zone_hour_counts \n" \
+                "WHERE hour >= %s and hour < %s".format(kind)
+
+        start_time = datetime.datetime.now()
+        cur.execute(query, (start, end + datetime.timedelta(days=1)))
+        rows = cur.fetchall()
+        hours, counts = zoneHourArray(rows, start, end)
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+
+        cur.close()
+        return timediff, (hours, counts)
+
+    # --------------------------------------    Grid aggregate (heatmaps)
+
+    def buildGridAggregate(self, resolutions=None, bucketMinutes=60, tableName="trips"):
+        # Precomputes the pickup/dropoff counts and the fare sums of each (grid cell, time bucket) into the table grid_agg
+        # The finest resolution is aggregated from the trips, the coarser ones are rolled up from it.
+        # resolutions: see GRID_RESOLUTIONS
+        # bucketMinutes: length of the time buckets
+        if resolutions is None:
+            resolutions = GRID_RESOLUTIONS
+        resolutions = sorted(resolutions, reverse=True)
+        finest = resolutions[0]
+        scale = 2 ** finest
+
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
+
+        cur.execute("drop table if exists grid_agg")
+        cur.execute("drop table if exists grid_agg_meta")
+        cur.execute("create table grid_agg ( "
+                    "res smallint, "
+                    "cx integer, "
+                    "cy integer, "
+                    "t_bucket timestamp without time zone, "
+                    "n_pickup integer, "
+                    "n_dropoff integer, "
+                    "fare_sum double precision)")
+        cur.execute("create table grid_agg_meta (resolutions smallint[], bucket_minutes integer)")
+        cur.execute("insert into grid_agg_meta values (%s, %s)", (resolutions, bucketMinutes))
+
+        query = "insert into grid_agg \n" \
+                "select {}, cx, cy, t_bucket, sum(n_pickup), sum(n_dropoff), sum(fare_sum) \n" \
+                "from ( \n" \
+                "   select floor(l_pickup_lon * {})::int as cx, floor(l_pickup_lat * {})::int as cy, \n" \
+                "          {} as t_bucket, 1 as n_pickup, 0 as n_dropoff, fare_amount as fare_sum \n" \
+                "   from {} \n" \
+                "   union all \n" \
+                "   select floor(l_dropoff_lon * {})::int, floor(l_dropoff_lat * {})::int, \n" \
+                "          {}, 0, 1, 0 \n" \
+                "   from {} \n" \
+                ") t \n" \
+                "group by cx, cy, t_bucket".format(finest,
+                                                   scale, scale, timeBucketSQL("t_pickup", bucketMinutes), tableName,
+                                                   scale, scale, timeBucketSQL("t_dropoff", bucketMinutes), tableName)
+        cur.execute(query)
+
+        # Coarser resolutions: floor division of the finer cell indices (>> is an arithmetic shift)
+        for res in resolutions[1:]:
+            shift = finest - res
+            query = "insert into grid_agg \n" \
+                    "select {}, cx >> {}, cy >> {}, t_bucket, sum(n_pickup), sum(n_dropoff), sum(fare_sum) \n" \
+                    "from grid_agg \n" \
+                    "where res = {} \n" \
+                    "group by 2, 3, 4".format(res, shift, shift, finest)
+            cur.execute(query)
+
+        cur.execute("create index grid_agg_idx on grid_agg (res, t_bucket, cx, cy)")
+        self.conn.commit()
+        cur.execute("analyze grid_agg")
+        self.conn.commit()
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff
+
+    def gridHeatmap(self, bbox, interval, maxCells=10000, res=None):
+        # Pickup/dropoff counts and fare sums of the cells within the bounding box and the time interval
+        # bbox: (minLon, minLat, maxLon, maxLat)
+        # interval: e.g. ('2015-01-01 10:00:00', '2015-01-01 12:00:00')
+        # maxCells: the finest resolution having at most maxCells cells within bbox is selected (unless res is given)
+        # Returns: timediff, (res, [(cx, cy, n_pickup, n_dropoff, fare_sum), ...]) - see gridHeatmapArray
+        cur = self.conn.cursor()
+        start_time = datetime.datetime.now()
 
+        cur.execute("select resolutions, bucket_minutes from grid_agg_meta")
+        resolutions, bucketMinutes = cur.fetchone()
+        if res is None:
+            res = chooseGridResolution(bbox, resolutions, maxCells)
+        cx0, cy0 = gridCell(bbox[0], bbox[1], res)
+        cx1, cy1 = gridCell(bbox[2], bbox[3], res)
+
+        # Buckets overlapping with the interval
+        query = "select cx, cy, sum(n_pickup), sum(n_dropoff), sum(fare_sum) \n" \
+                "from grid_agg \n" \
+                "where res = {} \n" \
+                "and t_bucket > timestamp '{}' - interval '{} minutes' and t_bucket < '{}' \n" \
+                "and cx between {} and {} and cy between {} and {} \n" \
+                "group by cx, cy".format(res, interval[0], bucketMinutes, interval[1], cx0, cx1, cy0, cy1)
 
+        cur.execute(query)
+        rows = cur.fetchall()
+
+        finish_time = datetime.datetime.now()
+        timediff = (finish_time - start_time).total_seconds()
+        cur.close()
+
+        return timediff, (res, rows)
+
+
+instrumentClass(postgres)
+
+
+# Streamed query results (see postgres.streamQuery)
+class queryStream():
+    # Iterating over the object executes the query and yields the rows; batches() yields the lists of rows.
+    # The rows are fetched in batches of batchSize through a server side (named) cursor: RAM usage does not
+    # depend on the number of rows. Each stream has its own cursor name, so that concurrent streams do not collide.
+    # Timing (SECONDS), available after the iteration:
+    #   firstRowLatency: execution of the query and fetch of the first batch
+    #   timediff: execution of the query and fetch of all the batches - the time the consumer spends on the rows
+    #             is excluded, hence comparable with the timediff of the other queries
+    #   numRows: number of rows
+    # A stream can be iterated once only (the cursor is closed at the end): run the query again for a new stream
+    # profileName: set by ST_Profiling.instrument to the method returning the stream; the iteration is recorded
+    # under that name (the creation of the stream takes no time)
+    profileName = None
+
+    def __init__(self, conn, query, batchSize=10000):
+        self.conn = conn
+        self.query = query
+        self.batchSize = batchSize
+
+        self.firstRowLatency = None
+        self.timediff = None
+        self.numRows = 0
+        self.started = False
+
+    def batches(self):
+        if self.started:
+            raise RuntimeError("queryStream can be iterated once only")
+        self.started = True
+        if self.profileName is not None:
+            return instrumentGenerator(queryStream.fetchBatches, self.profileName)(self)
+        return self.fetchBatches()
+
+    def fetchBatches(self):
+        cur = self.conn.cursor("st_cursor_" + uuid.uuid4().hex)
+        cur.itersize = self.batchSize
+        try:
+            start_time = datetime.datetime.now()
+            cur.execute(self.query)
+            fetchTime = 0.0
+            while True:
+                rows = cur.fetchmany(self.batchSize)
+                finish_time = datetime.datetime.now()
+                fetchTime += (finish_time - start_time).total_seconds()
+                if self.firstRowLatency is None:
+                    self.firstRowLatency = fetchTime
+                if not rows:
+                    break
+                self.numRows += len(rows)
+                addRows(len(rows))
+                yield rows
+                # The consumer's time is not counted
+                start_time = datetime.datetime.now()
+            self.timediff = fetchTime
+        finally:
+            cur.close()
+
+    def __iter__(self):
+        for rows in self.batches():
+            for row in rows:
+                yield row
 
 
         # --------------------------------------    Common Functions    --------------------------------------
@@ -1541,67 +3549,423 @@ def generateRandomInterval(start, end, unit):
     # Unit: in minutes
 
     # E.g. s = generateRandomInterval(datetime.date(2015,1,1), datetime.date(2015,1,31), 1440) # One day! OK
-    # This qould generate a random day between 1 Jan 2015 and 31 Dec 2015
-    
-
-    startYear = start.year
-    startMonth = start.month
-    startDay = start.day
+    # This qould generate a random day between 1 Jan 2015 and 31 Jan 2015
 
-    endYear = end.year
-    endMonth =  end.month
-    endDay = end.day
+    # Not reproducible! For the benchmarks use ST_Workload.workload with a seed and save the workload to disk.
+    w = workload()
+    w.generateIntervals(1, start, end, unit)
 
-    validDate = False
+    return w.intervalStrings()[0]
 
-    # It is possible to randomly generate an invalid date (e.g. 31 April, 29 Feb 2017 etc.)
-    # So make sure that the random date is a valid date!
 
-    while not validDate:
-        try:
-            generatedYear = random.randint(startYear, endYear) # inclusive of the start/end year - no need to increment by 1
-            generatedMonth = random.randint(startMonth, endMonth)
-            generatedDay = random.randint(1, 31)
-            # check if the generated day is a valid date
-            date = datetime.date(generatedYear, generatedMonth, generatedDay)
-        except:
-            validDate = False
+def generateRandomID_List(totalNumbers,maxID):
+    # totalNumbers: how many random IDs are going to be generated?
+    # maxID: max ID
+    # We have not included the Postgres IDs: [8M1 - 10M]
+
+    # Not reproducible! For the benchmarks use ST_Workload.workload with a seed and save the workload to disk.
+    w = workload()
+
+    return w.generateIDs(totalNumbers, defaultIDRanges(maxID)).tolist()
+
+# --- Layouts of the MongoDB trip documents (see the 'layout' argument of mongoDB)
+# "geojson": written by postgres2GeoJSON - long field names, GeoJSON points, numeric codes as strings
+# "compact": written by postgres2CompactJSON or mongoDB.buildCompactCollection:
+#   _id: ID_Postgres, nid, v: VendorID, tp/td: pickup/dropoff time, pc: passenger_count, dist: trip_distance,
+#   pk/do: pickup/dropoff [lon, lat] (legacy coordinate pairs), rc: RatecodeID, sf: store_and_fwd_flag (bool),
+#   pt: payment_type, fa/ex/mta/tip/tol/sur/tot: amounts in CENTS (int32), ef: error flags
+# The query methods only use the field paths below; amounts are multiplied by amountScale
+# key: the field the trips are looked up with (see the 'keyedByID' argument of mongoDB)
+MONGO_LAYOUTS = {
+    "geojson": {"id": "properties.ID_Postgres",
+                "key": "properties.ID_Postgres",
+                "nid": "properties.nid",
+                "pickup": "geometry_pk",
+                "pickupCoords": "geometry_pk.coordinates",
+                "dropoffCoords": "geometry_do.coordinates",
+                "tPickup": "properties.tpep_pickup_datetime",
+                "tDropoff": "properties.tpep_dropoff_datetime",
+                "passengers": "properties.passenger_count",
+                "fare": "properties.fare_amount",
+                "total": "properties.total_amount",
+                "duration": "properties.duration_s",
+                "errorFlags": "ErrorFlags",
+                "amountScale": 1,
+                "documentProjection": {"geometry_pk.coordinates": 1.0,
+                                       "geometry_do.coordinates": 1.0,
+                                       "properties": 1.0}},
+    "compact": {"id": "_id",
+                "key": "_id",
+                "nid": "nid",
+                "pickup": "pk",
+                "pickupCoords": "pk",
+                "dropoffCoords": "do",
+                "tPickup": "tp",
+                "tDropoff": "td",
+                "passengers": "pc",
+                "fare": "fa",
+                "total": "tot",
+                "duration": "dur",
+                "errorFlags": "ef",
+                "amountScale": 100,
+                "documentProjection": None}
+}
+
+def getField(document, path):
+    # Value of a (dotted) field path, e.g. getField(doc, "geometry_pk.coordinates")
+    for key in path.split("."):
+        document = document[key]
+    return document
+
+def durationSeconds(tPickup, tDropoff):
+    # Journey time in SECONDS (the duration_s column / field, see addDuration)
+    if tPickup is None or tDropoff is None:
+        return None
+    return int((tDropoff - tPickup).total_seconds())
+
+def toCents(amount):
+    if amount is None:
+        return None
+    return int(round(amount * 100))
+
+def toInt(code):
+    # Numeric codes stored as text in Postgres (e.g. vendorid, ratecodeid, payment_type)
+    if code is None or str(code).strip() == "":
+        return None
+    return int(code)
+
+# Journey time in SECONDS (the generated duration_s column, see postgres.addDuration)
+DURATION_SQL = "extract(epoch from (t_dropoff - t_pickup))::integer"
+
+# --- Data quality rules and error flags
+# Each rule has a bit in the error flags (Postgres: trips.error_flags, MongoDB: ErrorFlags)
+# The bits follow the former Errors.Flag_1 .. Errors.Flag_5 fields of MongoDB
+ERROR_FLAGS = {"sameStartEndTime": 1,
+               "totalPrice_LTE2X": 2,
+               "numPassengers_Equal2X": 4,
+               "longTrips": 8,
+               "sameStartEndLocation": 16}
+
+def errorFlagBit(ruleName):
+    try:
+        return ERROR_FLAGS[ruleName]
+    except KeyError:
+        raise ValueError("Unknown rule: {} (known rules: {})".format(ruleName, ", ".join(ERROR_FLAGS)))
+
+def qualityCondition_Postgres(ruleName, x=None, alias="trips", duration=False):
+    # SQL condition of the rule; x: the parameter of the rule (longTrips: SECONDS)
+    # duration: True if the table has the duration_s column (see postgres.addDuration) - index range scan of longTrips
+    conditions = {"sameStartEndTime": "{0}.t_pickup = {0}.t_dropoff",
+                  "totalPrice_LTE2X": "{0}.total <= {1}",
+                  "numPassengers_Equal2X": "{0}.num_passengers = {1}",
+                  "longTrips": "{0}.t_dropoff - {0}.t_pickup >= interval '{1} seconds'",
+                  "sameStartEndLocation": "{0}.l_pickup = {0}.l_dropoff"}
+    if duration:
+        conditions["longTrips"] = "{0}.duration_s >= {1}"
+    errorFlagBit(ruleName)
+
+    return conditions[ruleName].format(alias, x)
+
+def qualityQuery_Mongo(ruleName, x=None, fields=MONGO_LAYOUTS["geojson"], duration=False):
+    # MongoDB query of the rule; x: the parameter of the rule (longTrips: MILI SECONDS)
+    # fields: the layout of the documents (see MONGO_LAYOUTS)
+    # duration: True if the documents have the duration field in SECONDS (see mongoDB.addDuration)
+    errorFlagBit(ruleName)
+
+    # $eq of two missing fields is true: the rules comparing two fields only match the trips having both,
+    # otherwise e.g. the zone documents stored in the same collection would be counted/flagged
+    query = {}
+    if ruleName == "sameStartEndTime":
+        query[fields["tPickup"]] = {u"$exists": True}
+        query[fields["tDropoff"]] = {u"$exists": True}
+        query["$expr"] = {u"$eq": [u"$" + fields["tPickup"], u"$" + fields["tDropoff"]]}
+    elif ruleName == "totalPrice_LTE2X":
+        query[fields["total"]] = {u"$lte": x * fields["amountScale"]}
+    elif ruleName == "numPassengers_Equal2X":
+        query[fields["passengers"]] = x
+    elif ruleName == "longTrips" and duration:
+        query[fields["duration"]] = {u"$gte": x / 1000.0}
+    elif ruleName == "longTrips":
+        query["$expr"] = {u"$gte": [{u"$subtract": [u"$" + fields["tDropoff"],
+                                                    u"$" + fields["tPickup"]]}, x]}
+    elif ruleName == "sameStartEndLocation":
+        query[fields["pickupCoords"]] = {u"$exists": True}
+        query[fields["dropoffCoords"]] = {u"$exists": True}
+        query["$expr"] = {u"$eq": [u"$" + fields["pickupCoords"], u"$" + fields["dropoffCoords"]]}
+
+    return query
+
+# --- Approximate counts (see approximateCount of the postgres and mongoDB classes)
+def sampleSizeFor(targetError, confidence=0.95):
+    # Sample size for which the confidence interval of any share is at most +-targetError (worst case: share = 0.5)
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+    return int(math.ceil(z * z * 0.25 / (targetError * targetError)))
+
+def countInterval(matched, sampleSize, total, confidence=0.95, designEffect=1.0):
+    # matched of the sampleSize sampled rows satisfy the condition: estimated count of the total rows
+    # with the Wilson score interval of the share (stays within [0, total] also for rare conditions)
+    # designEffect: variance of the sample relative to random rows (> 1 for cluster samples, see pageDesignEffect);
+    # the interval is computed for the effective sample size sampleSize / designEffect
+    if sampleSize == 0:
+        return {"count": 0, "low": 0, "high": total, "exact": False, "sampleSize": 0}
+
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+    share = matched / float(sampleSize)
+    n = sampleSize / max(1.0, designEffect)
+    center = (share + z * z / (2 * n)) / (1 + z * z / n)
+    halfWidth = z * math.sqrt(share * (1 - share) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+
+    return {"count": int(round(share * total)),
+            "low": int(math.floor(max(0.0, center - halfWidth) * total)),
+            "high": int(math.ceil(min(1.0, center + halfWidth) * total)),
+            "exact": False,
+            "sampleSize": sampleSize}
+
+def pageDesignEffect(pages):
+    # pages: [(sampled rows, matching rows)] of the pages of a SYSTEM sample (cluster sample of whole pages)
+    # Between-page variance of the ratio estimator / variance of random rows with the same share (at least 1)
+    numPages = len(pages)
+    sampleSize = sum(page[0] for page in pages)
+    if numPages < 2 or sampleSize == 0:
+        return 1.0
+
+    share = sum(page[1] for page in pages) / float(sampleSize)
+    if share <= 0.0 or share >= 1.0:
+        return 1.0
+    clusterVariance = numPages / (numPages - 1.0) * sum((m - share * n) ** 2 for n, m in pages) / (sampleSize * sampleSize)
+    randomVariance = share * (1 - share) / sampleSize
+
+    return max(1.0, clusterVariance / randomVariance)
+
+def rewriteIndexDef(indexdef, indexName, tableName):
+    # The CREATE INDEX statement of pg_indexes.indexdef for another index name and table (see postgres.rewriteUpdate)
+    # e.g. CREATE UNIQUE INDEX trips_pkey ON public.trips USING btree (id)
+    head, using = indexdef.split(" USING ", 1)
+    create = head.split(" INDEX ", 1)[0]
+    return "{} INDEX \"{}\" ON {} USING {}".format(create, indexName, tableName, using)
+
+# --- Binary COPY (see postgres.copyColumns)
+# Postgres type OID -> (big endian NumPy type, width in BYTES, struct format)
+BINARY_COPY_TYPES = {16: (">u1", 1, ">B"),     # boolean
+                     21: (">i2", 2, ">h"),     # smallint
+                     23: (">i4", 4, ">i"),     # integer
+                     20: (">i8", 8, ">q"),     # bigint
+                     700: (">f4", 4, ">f"),    # real
+                     701: (">f8", 8, ">d"),    # double precision
+                     1082: (">i4", 4, ">i"),   # date: days since 2000-01-01
+                     1114: (">i8", 8, ">q"),   # timestamp: micro seconds since 2000-01-01
+                     1184: (">i8", 8, ">q")}   # timestamp with time zone (UTC)
+
+BINARY_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+def decodeBinaryCopy(data, typeOIDs):
+    # Decodes the output of COPY ... TO STDOUT (FORMAT binary) into one NumPy array per column
+    # Fast path: without NULLs all the rows have the same length, i.e. the whole body is a single structured array
+    # Otherwise the rows are decoded one by one (NULL -> NaN for numbers, NaT for dates/timestamps)
+    for oid in typeOIDs:
+        if oid not in BINARY_COPY_TYPES:
+            raise ValueError("Column type (OID {}) is not a fixed width type".format(oid))
+
+    data = memoryview(data)
+    if bytes(data[:11]) != BINARY_COPY_SIGNATURE:
+        raise ValueError("Not a binary COPY output")
+    headerExtension = struct.unpack(">i", data[15:19])[0]
+    body = data[19 + headerExtension:-2]  # the trailer is a -1 field count
+
+    numColumns = len(typeOIDs)
+    fields = [("n", ">i2")]
+    for i, oid in enumerate(typeOIDs):
+        fields.append(("l%d" % i, ">i4"))
+        fields.append(("c%d" % i, BINARY_COPY_TYPES[oid][0]))
+    rowType = np.dtype(fields)
+
+    columns = None
+    if len(body) % rowType.itemsize == 0:
+        rows = np.frombuffer(body, dtype=rowType)
+        fixedWidth = (rows["n"] == numColumns).all()
+        for i, oid in enumerate(typeOIDs):
+            fixedWidth = fixedWidth and (rows["l%d" % i] == BINARY_COPY_TYPES[oid][1]).all()
+        if fixedWidth:
+            columns = [rows["c%d" % i] for i in range(numColumns)]
+
+    if columns is None:
+        columns = _decodeBinaryCopyRows(body, typeOIDs)
+
+    return [_binaryCopyColumn(values, oid) for values, oid in zip(columns, typeOIDs)]
+
+def _decodeBinaryCopyRows(body, typeOIDs):
+    # Slow path (NULLs): values as float64 (NaN = NULL), or int64 microseconds/days with the minimum value as NULL
+    columns = [[] for oid in typeOIDs]
+    formats = [struct.Struct(BINARY_COPY_TYPES[oid][2]) for oid in typeOIDs]
+    offset = 0
+    while offset < len(body):
+        offset += 2
+        for i, oid in enumerate(typeOIDs):
+            length = struct.unpack_from(">i", body, offset)[0]
+            offset += 4
+            if length < 0:
+                columns[i].append(None)
+            else:
+                columns[i].append(formats[i].unpack_from(body, offset)[0])
+                offset += length
+
+    result = []
+    for values, oid in zip(columns, typeOIDs):
+        if oid in (1082, 1114, 1184):
+            nat = np.iinfo(np.int64).min
+            result.append(np.array([nat if v is None else v for v in values], dtype=np.int64))
         else:
-            validDate = True
-            break
+            result.append(np.array([np.nan if v is None else v for v in values], dtype=np.float64))
+
+    return result
+
+def _binaryCopyColumn(values, oid):
+    # Big endian values -> native NumPy array
+    if oid == 1082:
+        days = values.astype(np.int64)
+        return np.where(days == np.iinfo(np.int64).min, np.datetime64("NaT"),
+                        np.datetime64("2000-01-01", "D") + days.astype("timedelta64[D]"))
+    if oid in (1114, 1184):
+        microseconds = values.astype(np.int64)
+        return np.where(microseconds == np.iinfo(np.int64).min, np.datetime64("NaT"),
+                        np.datetime64("2000-01-01", "us") + microseconds.astype("timedelta64[us]"))
+    if oid == 16 and values.dtype != np.float64:
+        return values.astype(bool)
+
+    return values.astype(values.dtype.newbyteorder("="))
+
+# --- Range queries
+def rangeCondition_Postgres(bbox, interval):
+    # WHERE condition: pickup within the bounding box (index on l_pickup) and the time interval
+    return "l_pickup && ST_MakeEnvelope({}, {}, {}, {}, 4326) " \
+           "AND t_pickup >= '{}' AND t_pickup < '{}'".format(bbox[0], bbox[1], bbox[2], bbox[3], interval[0], interval[1])
+
+def rangeQuery_Mongo(bbox, interval, fields=MONGO_LAYOUTS["geojson"]):
+    query = {}
+    query[fields["pickupCoords"]] = {
+        u"$geoWithin": {
+            u"$box": [[bbox[0], bbox[1]], [bbox[2], bbox[3]]]
+        }
+    }
+    query[fields["tPickup"]] = {
+        u"$gte": datetime.datetime.strptime(str(interval[0]), "%Y-%m-%d %H:%M:%S"),
+        u"$lt": datetime.datetime.strptime(str(interval[1]), "%Y-%m-%d %H:%M:%S")
+    }
+
+    return query
+
+# --- OD matrix (see odMatrix of the postgres and mongoDB classes)
+# Number of TLC zones; the zone IDs (zones.gid / LocationID) are 1..NUM_ZONES
+NUM_ZONES = 263
+
+def dayInterval(day):
+    # day: datetime.date -> the interval of the whole day, e.g. ('2015-05-23 00:00:00', '2015-05-24 00:00:00')
+    start = datetime.datetime(day.year, day.month, day.day)
+    return str(start), str(start + datetime.timedelta(days=1))
+
+def monthInterval(year, month):
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    return str(start), str(end)
+
+def zonePolygon(zoneID, geometry):
+    # GeoJSON Polygon/MultiPolygon -> (zoneID, (minX, minY, maxX, maxY), list of rings as (n, 2) arrays)
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    else:
+        polygons = geometry["coordinates"]
+
+    rings = [np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon]
+    allPoints = np.concatenate(rings)
+    bbox = (allPoints[:, 0].min(), allPoints[:, 1].min(), allPoints[:, 0].max(), allPoints[:, 1].max())
+
+    return zoneID, bbox, rings
+
+def pointsInRings(x, y, rings, blockSize=2000000):
+    # Vectorised ray casting (even-odd rule) - holes and multi polygons are handled by counting over all the rings
+    inside = np.zeros(len(x), dtype=bool)
+    for ring in rings:
+        x0, y0 = ring[:-1, 0], ring[:-1, 1]
+        x1, y1 = ring[1:, 0], ring[1:, 1]
+        # Points x edges matrices, in blocks to bound the memory
+        step = max(1, blockSize // max(1, len(x0)))
+        for i in range(0, len(x), step):
+            px = x[i:i + step, None]
+            py = y[i:i + step, None]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                crosses = ((y0 > py) != (y1 > py)) & (px < (x1 - x0) * (py - y0) / (y1 - y0) + x0)
+            inside[i:i + step] ^= (np.count_nonzero(crosses, axis=1) % 2 == 1)
+
+    return inside
+
+def assignZones(zones, x, y):
+    # Zone ID of each point (0 if the point is outside of all the zones)
+    # zones: list of zonePolygon outputs
+    result = np.zeros(len(x), dtype=np.int32)
+    for zoneID, bbox, rings in zones:
+        candidates = np.flatnonzero((result == 0) & (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3]))
+        if len(candidates) == 0:
+            continue
+        inside = pointsInRings(x[candidates], y[candidates], rings)
+        result[candidates[inside]] = zoneID
 
-    # Randomly generate the time:
-    tH = random.randint(0, 23)
-    tM = random.randint(0, 59)
-    tS = random.randint(0, 59)
+    return result
 
-    intervalStart = datetime.datetime(generatedYear, generatedMonth, generatedDay, tH, tM, tS)
-    intervalEnd = intervalStart + datetime.timedelta(minutes=unit)
+# --- Zone x hour rollups (see zoneHourMatrix of the postgres and mongoDB classes)
+def zoneHourArray(rows, start, end):
+    # rows: (zone, hour, count) -> hours of the days start..end (both inclusive) and the NUM_ZONES x hours matrix
+    hours = np.arange(np.datetime64(start, "h"), np.datetime64(end, "h") + np.timedelta64(24, "h"))
+    counts = np.zeros((NUM_ZONES, len(hours)), dtype=np.int64)
+    if rows:
+        zones = np.array([row[0] for row in rows], dtype=np.int64)
+        index = (np.array([row[1] for row in rows], dtype="datetime64[s]").astype("datetime64[h]") - hours[0]).astype(np.int64)
+        counts[zones - 1, index] = [row[2] for row in rows]
 
-    return str(intervalStart), str(intervalEnd)
+    return hours, counts
 
+# --- Grid aggregate (see buildGridAggregate / gridHeatmap of the postgres and mongoDB classes)
+# The cells of resolution 'res' are 1/2^res degrees wide:
+# res 7 ~ 650-870 m, res 9 ~ 160-220 m, res 11 ~ 40-55 m in New York
+GRID_RESOLUTIONS = (7, 9, 11)
 
-def generateRandomID_List(totalNumbers,maxID):
-    # totalNumbers: how many random IDs are going to be generated?
-    # maxID: max ID
+def gridCell(lon, lat, res):
+    # Index of the cell (cx, cy) of the point at the given resolution
+    scale = 2 ** res
+    return int(math.floor(lon * scale)), int(math.floor(lat * scale))
 
-    random_list = list()
+def chooseGridResolution(bbox, resolutions, maxCells):
+    # Finest resolution whose number of cells within the bounding box is at most maxCells
+    for res in sorted(resolutions, reverse=True):
+        cx0, cy0 = gridCell(bbox[0], bbox[1], res)
+        cx1, cy1 = gridCell(bbox[2], bbox[3], res)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= maxCells:
+            return res
 
-    count = 0
+    return min(resolutions)
 
-    while(count < totalNumbers):
-        id = random.randint(1, maxID)
-        # Check whether the ID is indeed valid:
-        # We have not included the Postgres IDs: [8M1 - 10M]
-        if(id >= 8000001 and id <= 10000000):
-            continue
-        else:
-            random_list.append(id)
-            count += 1
+def gridHeatmapArray(bbox, res, rows, column=2):
+    # Dense 2D array (rows: latitude, columns: longitude) of the gridHeatmap output
+    # column: 2 -> n_pickup, 3 -> n_dropoff, 4 -> fare_sum
+    cx0, cy0 = gridCell(bbox[0], bbox[1], res)
+    cx1, cy1 = gridCell(bbox[2], bbox[3], res)
+
+    heatmap = np.zeros((cy1 - cy0 + 1, cx1 - cx0 + 1))
+    for row in rows:
+        heatmap[row[1] - cy0, row[0] - cx0] = row[column]
+
+    return heatmap
+
+def timeBucketSQL(column, minutes):
+    # SQL expression truncating a timestamp to its bucket of 'minutes' length
+    if minutes == 60:
+        return "date_trunc('hour', {})".format(column)
+
+    return "(to_timestamp(floor(extract(epoch from {}) / {}) * {}) at time zone 'UTC')".format(column, minutes * 60, minutes * 60)
 
-    return random_list
 
 # In order to have a legit temporal attribute, 'Z' must be added to the end of the date in MongoDB.
+# rearrangeTimeFormat parses the string of the datetime again: the exporters use formatISOTime(s) instead
+# (see ST_Benchmark.timeFormatThroughput)
 def rearrangeTimeFormat(t):
     # print(t)
     date = datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
@@ -1612,5 +3976,14 @@ def rearrangeTimeFormat(t):
     # print(s)
     return s
 
-
-
+@functools.lru_cache(maxsize=65536)
+def formatISOTime(t):
+    # datetime (as returned by psycopg2) -> '2015-01-01T10:00:00Z'
+    # Memoised: the trips are clustered in time, the same second is formatted many times
+    return t.isoformat(timespec="seconds") + "Z"
+
+def formatISOTimes(values):
+    # Batch version for datetime64 arrays (e.g. the timestamps of postgres.copyColumns), formatted by NumPy at once
+    # (for lists of datetime objects formatISOTime is faster: the conversion to datetime64 is per object)
+    times = np.asarray(values, dtype="datetime64[s]")
+    return np.char.add(np.datetime_as_string(times, unit="s"), "Z").tolist()
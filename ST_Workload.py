@@ -0,0 +1,129 @@
+######################################################################
+# Project name: Open source library to analyse pickup/dropoff locations of taxi trips
+
+# Purpose: Reproducible (seeded) query workloads for the Postgres / MongoDB benchmarks.
+# A workload is generated once, saved to disk and then replayed on every backend,
+# so that all the DBMS answer exactly the same queries.
+
+######################################################################
+
+import datetime
+import json
+import numpy as np
+
+
+# The Postgres IDs [8M1 - 10M] were not loaded to the databases.
+# Used whenever the real ID ranges are not retrieved from the database (see postgres.idRanges)
+# maxID <= 8M (e.g. nid of a single day table): a single range
+def defaultIDRanges(maxID):
+    idRanges = [(1, min(8000000, maxID))]
+    if maxID > 10000000:
+        idRanges.append((10000001, maxID))
+    return idRanges
+
+
+class workload():
+    # seed: any integer. The same seed and the same generate* calls produce the same workload.
+    # seed = None results in a non-reproducible workload (fresh entropy from the OS)
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        self.tripIDs = np.empty(0, dtype=np.int64)
+        self.intervals = np.empty((0, 2), dtype="datetime64[s]")
+        self.odPairs = np.empty((0, 2), dtype=np.int16)
+        self.kValues = np.empty(0, dtype=np.int32)
+
+    def generateIDs(self, n, idRanges):
+        # n: how many trip IDs are going to be generated?
+        # idRanges: list of INCLUSIVE (min, max) ID ranges that exist in the database
+        # e.g. defaultIDRanges(maxID) or the output of postgres.idRanges()
+        # Every existing ID has the same probability: a range is selected proportional to its length
+        lo = np.array([r[0] for r in idRanges], dtype=np.int64)
+        lengths = np.array([r[1] - r[0] + 1 for r in idRanges], dtype=np.int64)
+        cumLengths = np.cumsum(lengths)
+
+        u = self.rng.integers(0, cumLengths[-1], size=n)
+        r = np.searchsorted(cumLengths, u, side="right")
+        self.tripIDs = lo[r] + u - (cumLengths[r] - lengths[r])
+
+        return self.tripIDs
+
+    def generateIntervals(self, n, start, end, unit, hourlyVolume=None, dailyVolume=None):
+        # n: number of intervals
+        # start/end: datetime.date, both inclusive (any day between them, across years, could be selected)
+        # unit: length of the interval in MINUTES (e.g. 5 min, 10 min, 30 min,... 1440 min)
+        # hourlyVolume: optional, 24 trip counts (e.g. postgres.hourlyVolume) - the starting hour is weighted by it
+        # dailyVolume: optional, one trip count per day between start and end - the day is weighted by it
+        numDays = (end - start).days + 1
+
+        days = self.rng.choice(numDays, size=n, p=_probabilities(dailyVolume, numDays))
+        hours = self.rng.choice(24, size=n, p=_probabilities(hourlyVolume, 24))
+        seconds = self.rng.integers(0, 3600, size=n)
+
+        intervalStart = np.datetime64(start, "D").astype("datetime64[s]") \
+                        + (days * 86400 + hours * 3600 + seconds).astype("timedelta64[s]")
+        intervalEnd = intervalStart + np.timedelta64(int(unit * 60), "s")
+
+        self.intervals = np.stack([intervalStart, intervalEnd], axis=1)
+
+        return self.intervals
+
+    def generateOD(self, n, numZones=263, odWeights=None):
+        # OD pairs of TLC zone IDs (1..numZones)
+        # odWeights: optional numZones x numZones matrix (e.g. the trip counts of postgres.odMatrix)
+        p = _probabilities(None if odWeights is None else np.asarray(odWeights).ravel(), numZones * numZones)
+        flat = self.rng.choice(numZones * numZones, size=n, p=p)
+
+        self.odPairs = np.stack([flat // numZones + 1, flat % numZones + 1], axis=1).astype(np.int16)
+
+        return self.odPairs
+
+    def generateK(self, n, kValues=(1, 5, 10, 50, 100), weights=None):
+        # k values of the k-NN queries
+        kValues = np.asarray(kValues, dtype=np.int32)
+        self.kValues = kValues[self.rng.choice(len(kValues), size=n, p=_probabilities(weights, len(kValues)))]
+
+        return self.kValues
+
+    def intervalStrings(self):
+        # The intervals as the string tuples the query methods expect: ('2015-01-01 10:00:00', '2015-01-01 10:05:00')
+        s = np.char.replace(np.datetime_as_string(self.intervals, unit="s"), "T", " ")
+        return [(row[0], row[1]) for row in s.tolist()]
+
+    def save(self, fileName):
+        # Saves the workload as a (compressed) .npz file. Replay it with workload.load(fileName)
+        meta = {"seed": self.seed,
+                "created": datetime.datetime.now().isoformat()}
+
+        np.savez_compressed(fileName,
+                            tripIDs=self.tripIDs,
+                            intervals=self.intervals.astype(np.int64),
+                            odPairs=self.odPairs,
+                            kValues=self.kValues,
+                            meta=np.array(json.dumps(meta)))
+
+    @staticmethod
+    def load(fileName):
+        data = np.load(fileName)
+        meta = json.loads(str(data["meta"]))
+
+        w = workload(meta["seed"])
+        w.tripIDs = data["tripIDs"]
+        w.intervals = data["intervals"].astype("datetime64[s]")
+        w.odPairs = data["odPairs"]
+        w.kValues = data["kValues"]
+
+        return w
+
+
+def _probabilities(weights, size):
+    # None -> uniform, otherwise the weights are normalised
+    if weights is None:
+        return None
+
+    p = np.asarray(weights, dtype=np.float64)
+    if p.shape != (size,):
+        raise ValueError("Expected {} weights, got {}".format(size, p.shape))
+
+    return p / p.sum()
@@ -0,0 +1,19 @@
+from ST_Workload import workload, defaultIDRanges
+from ST_Queries import generateRandomID_List
+
+
+def test_defaultIDRanges():
+    assert defaultIDRanges(400000) == [(1, 400000)]
+    assert defaultIDRanges(9000000) == [(1, 8000000)]
+    assert defaultIDRanges(12000000) == [(1, 8000000), (10000001, 12000000)]
+
+
+def test_generateRandomID_List_smallMaxID():
+    ids = generateRandomID_List(5, 400000)
+    assert len(ids) == 5
+    assert all(1 <= i <= 400000 for i in ids)
+
+
+def test_generateIDs_skipsGap():
+    ids = workload(seed=1).generateIDs(1000, defaultIDRanges(12000000))
+    assert not ((ids > 8000000) & (ids <= 10000000)).any()